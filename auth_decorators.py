@@ -12,51 +12,45 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+_ROLE_NAMES = {
+    UserRole.ADMIN: "👑 Администратор",
+    UserRole.CLIENT: "👤 Клиент"
+}
+
+_ACCESS_DENIED_MESSAGE = "❌ Доступ запрещен. Обратитесь к администратору для получения прав."
+
+_DENY_TEMPLATE = (
+    "❌ **Недостаточно прав**\n\n"
+    "Ваша роль: {user}\n"
+    "Требуется: {req}\n\n"
+    "Обратитесь к администратору для получения необходимых прав."
+)
+
 
 def require_role(required_role: UserRole):
     """Декоратор для проверки роли пользователя"""
+    # Админы имеют доступ ко всем командам
+    allowed_roles = frozenset({UserRole.ADMIN, required_role})
+    
     def decorator(func: Callable):
         @functools.wraps(func)
         async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-            user_id = str(update.effective_user.id)
-            telegram_user = update.effective_user
+            # Получаем (или создаем) пользователя и его роль одним запросом
+            user_role = await user_management.get_auth_context_async(update.effective_user)
             
-            # Получаем или создаем пользователя
-            bot_user = user_management.get_or_create_user(telegram_user)
-            
-            # Первый пользователь автоматически становится админом
-            if user_management.is_first_user():
-                user_management.set_user_role(user_id, UserRole.ADMIN, "system")
-                logger.info(f"Первый пользователь {user_id} автоматически назначен администратором")
-            
-            # Проверяем права доступа
-            user_role = user_management.get_user_role(user_id)
+            if user_role in allowed_roles:
+                return await func(self, update, context, *args, **kwargs)
             
             if not user_role:
-                await update.message.reply_text(
-                    "❌ Доступ запрещен. Обратитесь к администратору для получения прав."
-                )
+                await update.message.reply_text(_ACCESS_DENIED_MESSAGE)
                 return
             
-            # Админы имеют доступ ко всем командам
-            if user_role == UserRole.ADMIN:
-                return await func(self, update, context, *args, **kwargs)
-            
-            # Проверяем соответствие требуемой роли
-            if user_role == required_role:
-                return await func(self, update, context, *args, **kwargs)
-            
             # Доступ запрещен
-            role_names = {
-                UserRole.ADMIN: "👑 Администратор",
-                UserRole.CLIENT: "👤 Клиент"
-            }
-            
             await update.message.reply_text(
-                f"❌ **Недостаточно прав**\n\n"
-                f"Ваша роль: {role_names.get(user_role, 'Неизвестно')}\n"
-                f"Требуется: {role_names.get(required_role, 'Неизвестно')}\n\n"
-                f"Обратитесь к администратору для получения необходимых прав.",
+                _DENY_TEMPLATE.format(
+                    user=_ROLE_NAMES.get(user_role, 'Неизвестно'),
+                    req=_ROLE_NAMES.get(required_role, 'Неизвестно')
+                ),
                 parse_mode="Markdown"
             )
             
@@ -73,23 +67,12 @@ def client_or_admin(func: Callable):
     """Декоратор для команд доступных клиентам и админам"""
     @functools.wraps(func)
     async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user_id = str(update.effective_user.id)
-        telegram_user = update.effective_user
-        
-        # Получаем или создаем пользователя
-        bot_user = user_management.get_or_create_user(telegram_user)
-        
-        # Первый пользователь автоматически становится админом
-        if user_management.is_first_user():
-            user_management.set_user_role(user_id, UserRole.ADMIN, "system")
-        
-        # Проверяем, что пользователь активен
-        user_role = user_management.get_user_role(user_id)
+        # Получаем (или создаем) пользователя и его роль одним запросом;
+        # роль есть только у активных пользователей
+        user_role = await user_management.get_auth_context_async(update.effective_user)
         
         if not user_role:
-            await update.message.reply_text(
-                "❌ Доступ запрещен. Обратитесь к администратору для получения прав."
-            )
+            await update.message.reply_text(_ACCESS_DENIED_MESSAGE)
             return
         
         return await func(self, update, context, *args, **kwargs)
@@ -1,134 +1,338 @@
 """
 Интеграция с Bitrix24 REST API
 """
-import requests
-import json
-from typing import Dict, Any, Optional, List
+import asyncio
+import functools
+import os
+import random
+import aiohttp
+import orjson
+from urllib.parse import urlencode
+from typing import Dict, Any, Optional, List, Sequence, Tuple
 from config import settings
 from models import TaskType, TaskStatus
+from cache_utils import cache, cached, single_flight
+from rate_limiter import TokenBucket
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Возможные поля пользователя Bitrix24 с Telegram ID (в порядке приоритета)
+TELEGRAM_ID_FIELDS = ("UF_TELEGRAM_ID", "UF_TG_ID", "UF_TGID", "tgID", "UF_USR_1755866403098")
+
+# ТехАккаунт Битрикс24 - постановщик всех задач и исполнитель по умолчанию
+TECH_ACCOUNT_ID = 1269
+
+# Приоритет задачи по типу обращения
+TASK_PRIORITY = {
+    TaskType.BUG: "3",  # Высокий приоритет для багов
+    TaskType.REQUIREMENT: "1",  # Низкий приоритет для требований
+    TaskType.CONSULTATION: "2"  # Обычный приоритет для консультаций
+}
+
+# Маппинг наших статусов на статусы Bitrix24
+BITRIX_TASK_STATUS = {
+    TaskStatus.NEW: "2",  # Ждет выполнения
+    TaskStatus.IN_PROGRESS: "3",  # Выполняется
+    TaskStatus.COMPLETED: "5",  # Завершена
+    TaskStatus.CANCELLED: "4"  # Отложена
+}
+
+# Поля tasks.task.add в порядке: название, описание, приоритет, постановщик, исполнитель
+_TASK_FIELDS = ("fields[TITLE]", "fields[DESCRIPTION]", "fields[PRIORITY]", "fields[CREATED_BY]", "fields[RESPONSIBLE_ID]")
+_ACCOMPLICE_KEYS = tuple(f"fields[ACCOMPLICES][{i}]" for i in range(8))
+
+# Признаки ошибки Битрикс24 об удаленной или недоступной задаче
+TASK_NOT_FOUND_MARKERS = ("task not found", "задача не найдена", "access denied", "404", "not found")
+
+# Значки типов файлов из Telegram в комментариях к задачам
+FILE_TYPE_EMOJI = {
+    "photo": "🖼️",
+    "document": "📄",
+    "video": "🎥",
+    "audio": "🎵",
+    "voice": "🎤"
+}
+
+# HTTP-статусы временных ошибок, при которых запрос повторяется
+RETRY_STATUSES_GET = frozenset({429, 500, 502, 503, 504})
+RETRY_STATUSES_POST = frozenset({429, 503})
+
+# HTTP-статусы отказа по лимиту запросов (QUERY_LIMIT_EXCEEDED)
+LIMIT_STATUSES = frozenset({429, 503})
+
+# Загрузка файлов может длиться дольше общего таймаута сессии - ограничиваем только паузы в обмене
+UPLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+
+# MIME типы файлов по расширению (в порядке частоты: чаще всего из Telegram приходят фото)
+_MIME_ORDER = (
+    ('.jpg', 'image/jpeg'),
+    ('.jpeg', 'image/jpeg'),
+    ('.png', 'image/png'),
+    ('.pdf', 'application/pdf'),
+    ('.mp4', 'video/mp4'),
+    ('.ogg', 'audio/ogg'),
+    ('.docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    ('.doc', 'application/msword'),
+    ('.xls', 'application/vnd.ms-excel'),
+    ('.txt', 'text/plain'),
+    ('.gif', 'image/gif'),
+    ('.mp3', 'audio/mpeg'),
+    ('.wav', 'audio/wav'),
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def _mime_for(filename: str) -> str:
+    """MIME тип по расширению файла (имена файлов часто повторяются - результат кешируется)"""
+    name = filename.lower()
+    for suffix, mime_type in _MIME_ORDER:
+        if name.endswith(suffix):
+            return mime_type
+    return 'application/octet-stream'
+
 
 class Bitrix24API:
     """Класс для работы с Bitrix24 REST API"""
     
+    # Размер страницы списочных методов Bitrix24 (user.get и т.п.)
+    PAGE_SIZE = 50
+    
+    # Максимум команд в одном вызове batch
+    BATCH_SIZE = 50
+    
+    # Повторы при временных ошибках Bitrix24
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 0.3
+    MAX_RETRY_DELAY = 10.0
+    
+    # Сколько держать открытым простаивающее соединение с порталом (секунды)
+    KEEPALIVE_TIMEOUT = 60
+    
+    # Лимит Битрикс24 ("дырявое ведро"): 2 запроса в секунду, всплеск до 50 запросов
+    RATE_LIMIT = 2.0
+    RATE_BURST = 50
+    
     def __init__(self):
         self.domain = settings.bitrix24_domain
         self.access_token = settings.bitrix24_access_token
-        # Для входящих вебхуков используем прямой URL
-        if hasattr(settings, 'bitrix24_user_id'):
+        # Для входящих вебхуков используем прямой URL (токен уже в адресе)
+        self._is_webhook = bool(getattr(settings, 'bitrix24_user_id', None))
+        if self._is_webhook:
             self.base_url = f"https://{self.domain}/rest/{settings.bitrix24_user_id}/{self.access_token}/"
         else:
             self.base_url = f"https://{self.domain}/rest/"
+        
+        self._disk_upload_url = f"{self.base_url}disk.storage.uploadfile"
+        
+        # Общая HTTP-сессия создается в запущенном event loop (см. startup)
+        self._session: Optional[aiohttp.ClientSession] = None
+        
+        # Все запросы к порталу проходят через общий ограничитель частоты
+        self._limiter = TokenBucket(self.RATE_LIMIT, self.RATE_BURST)
     
-    def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None) -> Dict[str, Any]:
-        """Выполнение запроса к Bitrix24 API"""
+    async def startup(self) -> None:
+        """Создание общей HTTP-сессии с пулом keep-alive соединений"""
+        if self._session is None or self._session.closed:
+            # keepalive_timeout: простаивающие соединения держим дольше стандартных 15 с,
+            # чтобы запросы между проходами синхронизации не открывали TLS-соединение заново
+            connector = aiohttp.TCPConnector(limit=20, limit_per_host=16, ttl_dns_cache=300,
+                                             keepalive_timeout=self.KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+    
+    async def close(self) -> None:
+        """Закрытие HTTP-сессии при остановке бота"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Получение общей HTTP-сессии (создается при первом обращении)"""
+        if self._session is None or self._session.closed:
+            await self.startup()
+        return self._session
+    
+    @classmethod
+    def _flatten_params(cls, data: Dict[str, Any], prefix: str = "") -> Dict[str, str]:
+        """Преобразование вложенных параметров в формат key[sub]=value, который ожидает Bitrix24"""
+        flat = {}
+        for key, value in data.items():
+            name = f"{prefix}[{key}]" if prefix else str(key)
+            if isinstance(value, dict):
+                flat.update(cls._flatten_params(value, name))
+            elif isinstance(value, (list, tuple)):
+                flat.update(cls._flatten_params(dict(enumerate(value)), name))
+            elif isinstance(value, bool):
+                flat[name] = "Y" if value else "N"
+            elif value is not None:
+                flat[name] = str(value)
+        return flat
+    
+    async def _request(self, method: str, endpoint: str, data: Optional[Dict] = None) -> Dict[str, Any]:
+        """Выполнение запроса к Bitrix24 API с возвратом полного ответа (result, total, next)"""
         url = f"{self.base_url}{endpoint}"
         
         # Для входящих вебхуков токен уже в URL, не нужен в параметрах
-        params = data.copy() if data else {}
+        params = self._flatten_params(data) if data else {}
         
         # Только добавляем auth если НЕ используем входящий вебхук
-        if not (hasattr(settings, 'bitrix24_user_id') and settings.bitrix24_user_id):
+        if not self._is_webhook:
             params["auth"] = self.access_token
         
+        session = await self._get_session()
+        
+        is_get = method.upper() == "GET"
+        # POST повторяем только когда Битрикс24 явно отклонил запрос (лимит запросов),
+        # чтобы не создать задачу или комментарий дважды
+        retry_statuses = RETRY_STATUSES_GET if is_get else RETRY_STATUSES_POST
+        
         try:
-            logger.info(f"🔍 Bitrix24 запрос: {method} {url}")
-            logger.info(f"🔍 Параметры: {params}")
-            
-            if method.upper() == "GET":
-                response = requests.get(url, params=params)
-            else:
-                response = requests.post(url, data=params)
-            
-            logger.info(f"🔍 Ответ статус: {response.status_code}")
-            logger.info(f"🔍 Ответ текст: {response.text[:500]}...")
-            
-            response.raise_for_status()
-            result = response.json()
+            for attempt in range(self.MAX_RETRIES + 1):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("🔍 Bitrix24 запрос: %s %s params=%s", method, url, params)
+                
+                await self._limiter.acquire()
+                
+                try:
+                    if is_get:
+                        request = session.get(url, params=params)
+                    else:
+                        request = session.post(url, data=params)
+                    
+                    async with request as response:
+                        body = await response.read()
+                        
+                        if logger.isEnabledFor(logging.DEBUG):
+                            logger.debug("🔍 Ответ %s: %s...", response.status, body[:500].decode("utf-8", "replace"))
+                        
+                        if response.status in LIMIT_STATUSES or response.status in retry_statuses:
+                            delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+                            if response.status in LIMIT_STATUSES:
+                                # Портал ответил отказом по лимиту - притормаживаем все запросы
+                                self._limiter.throttle(delay)
+                        
+                        if response.status in retry_statuses and attempt < self.MAX_RETRIES:
+                            logger.warning(f"Bitrix24 вернул {response.status} для {endpoint}, повтор через {delay:.1f} с")
+                            await asyncio.sleep(delay)
+                            continue
+                        
+                        response.raise_for_status()
+                        self._limiter.recover()
+                        result = orjson.loads(body)
+                        break
+                    
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    # Запрос, который не удалось отправить, безопасно повторить и для POST
+                    retryable = is_get or isinstance(e, aiohttp.ClientConnectorError)
+                    if not retryable or attempt >= self.MAX_RETRIES:
+                        raise
+                    
+                    delay = self._retry_delay(attempt)
+                    logger.warning(f"Сбой соединения с Bitrix24 ({endpoint}): {e!r}, повтор через {delay:.1f} с")
+                    await asyncio.sleep(delay)
             
             if "error" in result:
                 logger.error(f"Ошибка Bitrix24 API: {result['error']}")
                 raise Exception(f"Bitrix24 API Error: {result['error']}")
             
-            return result.get("result", {})
+            return result
             
-        except requests.RequestException as e:
+        except aiohttp.ClientError as e:
             logger.error(f"Ошибка HTTP запроса к Bitrix24: {e}")
             raise
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.error(f"Ошибка декодирования JSON ответа Bitrix24: {e}")
             raise
     
-    def create_task(self, title: str, description: str, task_type: TaskType, 
-                   responsible_user_id: Optional[int] = None, co_executors: Optional[List[int]] = None) -> Dict[str, Any]:
-        """Создание задачи в Bitrix24"""
+    @classmethod
+    def _retry_delay(cls, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Пауза перед повтором: Retry-After от сервера или экспоненциальная задержка со случайным разбросом"""
+        if retry_after:
+            try:
+                return min(float(retry_after), cls.MAX_RETRY_DELAY)
+            except ValueError:
+                pass
+        return cls.RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+    
+    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None) -> Dict[str, Any]:
+        """Выполнение запроса к Bitrix24 API"""
+        result = await self._request(method, endpoint, data)
+        return result.get("result", {})
+    
+    async def _get_all_pages(self, endpoint: str, data: Optional[Dict] = None) -> List[Dict[str, Any]]:
+        """Получение всех страниц списочного метода: первая страница, затем остальные параллельно"""
+        first_page = await self._request("GET", endpoint, data)
+        items = list(first_page.get("result") or [])
+        
+        total = int(first_page.get("total") or 0)
+        if "next" not in first_page or total <= len(items):
+            return items
         
-        # Определяем приоритет по типу задачи
-        priority = "2"  # Обычный приоритет по умолчанию
+        pages = await asyncio.gather(*(
+            self._make_request("GET", endpoint, {**(data or {}), "start": start})
+            for start in range(self.PAGE_SIZE, total, self.PAGE_SIZE)
+        ))
         
-        if task_type == TaskType.BUG:
-            priority = "3"  # Высокий приоритет для багов
-        elif task_type == TaskType.REQUIREMENT:
-            priority = "1"  # Низкий приоритет для требований
-        elif task_type == TaskType.CONSULTATION:
-            priority = "2"  # Обычный приоритет для консультаций
+        for page in pages:
+            if isinstance(page, list):
+                items.extend(page)
+        
+        return items
+    
+    async def create_task(self, title: str, description: str, task_type: TaskType, 
+                   responsible_user_id: Optional[int] = None, co_executors: Optional[Sequence[int]] = None) -> Dict[str, Any]:
+        """Создание задачи в Bitrix24"""
         
         # Логика назначения:
-        # CREATED_BY (постановщик) - всегда ТехАккаунт (1269)
+        # CREATED_BY (постановщик) - всегда ТехАккаунт
         # RESPONSIBLE_ID (исполнитель) - как указано в параметре или ТехАккаунт по умолчанию
-        creator_id = 1269  # ТехАккаунт всегда постановщик
-        responsible_id = responsible_user_id or 1269  # Исполнитель по параметру или ТехАккаунт
-        
-        task_data = {
-            "fields[TITLE]": title,
-            "fields[DESCRIPTION]": description,
-            "fields[PRIORITY]": priority,
-            "fields[CREATED_BY]": creator_id,
-            "fields[RESPONSIBLE_ID]": responsible_id,
-        }
+        task_data = dict(zip(_TASK_FIELDS, (
+            title,
+            description,
+            TASK_PRIORITY.get(task_type, "2"),  # Обычный приоритет по умолчанию
+            TECH_ACCOUNT_ID,
+            responsible_user_id or TECH_ACCOUNT_ID
+        )))
         
         # Добавляем соисполнителей если указаны
         if co_executors:
-            for i, co_executor_id in enumerate(co_executors):
-                task_data[f"fields[ACCOMPLICES][{i}]"] = co_executor_id
+            if len(co_executors) <= len(_ACCOMPLICE_KEYS):
+                task_data.update(zip(_ACCOMPLICE_KEYS, co_executors))
+            else:
+                task_data.update({f"fields[ACCOMPLICES][{i}]": x for i, x in enumerate(co_executors)})
         
-        result = self._make_request("POST", "tasks.task.add", task_data)
+        result = await self._make_request("POST", "tasks.task.add", task_data)
         logger.info(f"Создана задача в Bitrix24 с ID: {result.get('task', {}).get('id')}")
         
         return result
     
-    def update_task_status(self, task_id: int, status: TaskStatus) -> Dict[str, Any]:
+    async def update_task_status(self, task_id: int, status: TaskStatus) -> Dict[str, Any]:
         """Обновление статуса задачи в Bitrix24"""
-        
-        # Маппинг наших статусов на статусы Bitrix24
-        bitrix_status_map = {
-            TaskStatus.NEW: "2",  # Ждет выполнения
-            TaskStatus.IN_PROGRESS: "3",  # Выполняется
-            TaskStatus.COMPLETED: "5",  # Завершена
-            TaskStatus.CANCELLED: "4"  # Отложена
-        }
-        
         update_data = {
             "taskId": task_id,
-            "fields[STATUS]": bitrix_status_map.get(status, "2")
+            "fields[STATUS]": BITRIX_TASK_STATUS.get(status, "2")
         }
         
-        result = self._make_request("POST", "tasks.task.update", update_data)
+        result = await self._make_request("POST", "tasks.task.update", update_data)
+        cache.pop(f"bx:task:{task_id}")
         logger.info(f"Обновлен статус задачи {task_id} на {status.value}")
         
         return result
     
-    def get_task(self, task_id: int) -> Optional[Dict[str, Any]]:
+    @cached(ttl=30, key="bx:task:{task_id}")
+    @single_flight(key="bx:task:{task_id}")
+    async def get_task(self, task_id: int) -> Optional[Dict[str, Any]]:
         """Получение информации о задаче"""
         try:
             data = {
                 "taskId": task_id
             }
             
-            result = self._make_request("GET", "tasks.task.get", data)
+            result = await self._make_request("GET", "tasks.task.get", data)
             
             # Обрабатываем случай, когда возвращается пустой список (задача не найдена)
             if isinstance(result, list) and len(result) == 0:
@@ -142,13 +346,7 @@ class Bitrix24API:
             error_text = str(e).lower()
             
             # Проверяем, является ли ошибка признаком удаленной задачи
-            if any(keyword in error_text for keyword in [
-                "task not found", 
-                "задача не найдена",
-                "access denied",
-                "404",
-                "not found"
-            ]):
+            if any(keyword in error_text for keyword in TASK_NOT_FOUND_MARKERS):
                 logger.info(f"Задача {task_id} не найдена в Битрикс24 (возможно удалена)")
                 return None
             else:
@@ -156,39 +354,92 @@ class Bitrix24API:
                 logger.error(f"Ошибка получения задачи {task_id}: {e}")
                 raise
     
-    def add_comment_to_task(self, task_id: int, comment: str) -> Dict[str, Any]:
+    async def batch_call(self, commands: Dict[str, Tuple[str, Optional[Dict[str, Any]]]],
+                         halt: bool = False) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Выполнение нескольких методов одним вызовом batch (не больше BATCH_SIZE команд).
+        
+        commands - {ключ: (метод, параметры)}; параметры могут ссылаться на результат
+        предыдущей команды: "$result[ключ][task][id]". halt - прервать выполнение
+        на первой ошибке. Возвращает (результаты, ошибки) по ключам команд
+        """
+        if len(commands) > self.BATCH_SIZE:
+            raise ValueError(f"В batch не больше {self.BATCH_SIZE} команд, передано {len(commands)}")
+        
+        cmd = {
+            key: f"{method}?{urlencode(self._flatten_params(params))}" if params else method
+            for key, (method, params) in commands.items()
+        }
+        batch = await self._make_request("POST", "batch", {"halt": int(halt), "cmd": cmd})
+        
+        # Пустые коллекции Битрикс24 возвращает списком, а не объектом
+        results = batch.get("result") or {}
+        errors = batch.get("result_error") or {}
+        return (results if isinstance(results, dict) else {}), (errors if isinstance(errors, dict) else {})
+    
+    async def get_tasks_batch(self, task_ids: List[int],
+                              select: Optional[List[str]] = None) -> Dict[int, Optional[Dict[str, Any]]]:
+        """Получение задач одним вызовом batch (не больше BATCH_SIZE задач).
+        
+        Возвращает {task_id: задача}; None - задача удалена или недоступна.
+        Задачи с прочими ошибками в результат не попадают.
+        """
+        commands = {
+            f"t{i}": ("tasks.task.get", {"taskId": task_id, "select": select})
+            for i, task_id in enumerate(task_ids[:self.BATCH_SIZE])
+        }
+        if not commands:
+            return {}
+        
+        results, errors = await self.batch_call(commands)
+        
+        tasks = {}
+        for i, task_id in enumerate(task_ids[:self.BATCH_SIZE]):
+            key = f"t{i}"
+            if key in errors:
+                error_text = str(errors[key]).lower()
+                if any(keyword in error_text for keyword in TASK_NOT_FOUND_MARKERS):
+                    tasks[task_id] = None
+                else:
+                    logger.error(f"Ошибка получения задачи {task_id} в batch: {errors[key]}")
+                continue
+            
+            result = results.get(key)
+            if isinstance(result, dict):
+                tasks[task_id] = result.get("task") or None
+            elif result is not None:
+                # Пустой список - задача не найдена
+                tasks[task_id] = None
+        
+        return tasks
+    
+    async def add_comment_to_task(self, task_id: int, comment: str) -> Dict[str, Any]:
         """Добавление комментария к задаче"""
         comment_data = {
             "taskId": task_id,
             "fields[POST_MESSAGE]": comment
         }
         
-        result = self._make_request("POST", "tasks.task.commentitem.add", comment_data)
+        result = await self._make_request("POST", "tasks.task.commentitem.add", comment_data)
         logger.info(f"Добавлен комментарий к задаче {task_id}")
         
         return result
     
-    def attach_telegram_file_to_task(self, task_id: int, file_info: Dict[str, Any], telegram_file_url: str) -> Dict[str, Any]:
-        """Прикрепление информации о файле из Telegram к задаче как ссылка"""
-        try:
-            filename = file_info.get("filename", "unknown_file")
-            file_size = file_info.get("size", 0)
-            file_type = file_info.get("type", "file")
-            
-            # Создаем красивое описание файла
-            type_emoji = {
-                "photo": "🖼️",
-                "document": "📄", 
-                "video": "🎥",
-                "audio": "🎵",
-                "voice": "🎤"
-            }
-            
-            emoji = type_emoji.get(file_type, "📎")
-            size_text = f"{round(file_size / (1024 * 1024), 2)} MB" if file_size > 1024*1024 else f"{round(file_size / 1024, 2)} KB"
-            
-            # Формируем комментарий с файлом как прикрепление
-            comment = f"""
+    async def add_comments_to_task(self, task_id: int, comments: List[str]) -> Dict[str, Any]:
+        """Добавление нескольких комментариев к задаче одним сообщением (один запрос к Битрикс24)"""
+        return await self.add_comment_to_task(task_id, "\n\n".join(comments))
+    
+    @staticmethod
+    def _format_file_comment(file_info: Dict[str, Any], telegram_file_url: str) -> str:
+        """Описание файла из Telegram для комментария к задаче"""
+        filename = file_info.get("filename", "unknown_file")
+        file_size = file_info.get("size", 0)
+        file_type = file_info.get("type", "file")
+        
+        emoji = FILE_TYPE_EMOJI.get(file_type, "📎")
+        size_text = f"{round(file_size / (1024 * 1024), 2)} MB" if file_size > 1024*1024 else f"{round(file_size / 1024, 2)} KB"
+        
+        # Формируем комментарий с файлом как прикрепление
+        return f"""
 {emoji} **ПРИКРЕПЛЕННЫЙ ФАЙЛ**
 
 📋 **Название:** {filename}
@@ -196,10 +447,15 @@ class Bitrix24API:
 🔗 **Ссылка для скачивания:** {telegram_file_url}
 
 💡 *Файл доступен по прямой ссылке из Telegram. Кликните на ссылку для скачивания.*
-            """.strip()
+        """.strip()
+    
+    async def attach_telegram_file_to_task(self, task_id: int, file_info: Dict[str, Any], telegram_file_url: str) -> Dict[str, Any]:
+        """Прикрепление информации о файле из Telegram к задаче как ссылка"""
+        try:
+            filename = file_info.get("filename", "unknown_file")
             
             # Добавляем комментарий к задаче
-            result = self.add_comment_to_task(task_id, comment)
+            await self.add_comment_to_task(task_id, self._format_file_comment(file_info, telegram_file_url))
             
             logger.info(f"✅ Информация о файле {filename} добавлена к задаче {task_id} как прикрепление")
             
@@ -209,74 +465,99 @@ class Bitrix24API:
             logger.error(f"Ошибка прикрепления файла к задаче: {e}")
             return {"success": False, "error": str(e)}
     
-    def _upload_via_disk(self, task_id: int, file_path: str, filename: str) -> Dict[str, Any]:
+    async def attach_telegram_files_to_task(self, task_id: int, files_info: List[Dict[str, Any]],
+                                            summary: Optional[str] = None) -> Dict[str, Any]:
+        """Прикрепление нескольких файлов из Telegram (и итогового текста) одним комментарием"""
+        try:
+            comments = [self._format_file_comment(info, info["telegram_file_url"]) for info in files_info]
+            if summary:
+                comments.append(summary)
+            
+            await self.add_comments_to_task(task_id, comments)
+            
+            filenames = [info.get("filename", "unknown_file") for info in files_info]
+            logger.info(f"✅ Информация о файлах ({len(filenames)}) добавлена к задаче {task_id} одним комментарием")
+            
+            return {"success": True, "method": "telegram_link", "filenames": filenames}
+            
+        except Exception as e:
+            logger.error(f"Ошибка прикрепления файлов к задаче: {e}")
+            return {"success": False, "error": str(e)}
+    
+    async def _post_file(self, url: str, data: Dict[str, Any], file_path: str, filename: str) -> Optional[Dict[str, Any]]:
+        """Отправка файла multipart-запросом. aiohttp читает файл частями в пуле потоков,
+        поэтому файл не загружается в память целиком и не блокирует event loop"""
+        form = aiohttp.FormData()
+        for name, value in data.items():
+            form.add_field(name, str(value))
+        if not self._is_webhook:
+            form.add_field("auth", self.access_token)
+        
+        session = await self._get_session()
+        await self._limiter.acquire()
+        
+        with open(file_path, 'rb') as file_content:
+            form.add_field('fileContent', file_content, filename=filename,
+                           content_type=self._get_mime_type(filename))
+            
+            async with session.post(url, data=form, timeout=UPLOAD_TIMEOUT) as response:
+                logger.info(f"🔍 Загрузка на диск: {response.status}")
+                
+                if response.status != 200:
+                    return None
+                return orjson.loads(await response.read())
+    
+    async def _upload_via_disk(self, task_id: int, file_path: str, filename: str) -> Dict[str, Any]:
         """Загрузка файла через диск Битрикс24"""
         try:
             # Сначала получаем доступные хранилища
-            storage_url = f"https://{self.domain}/rest/{settings.bitrix24_user_id}/{self.access_token}/disk.storage.getlist"
-            
-            storage_response = requests.get(storage_url)
+            storages = await self._make_request("GET", "disk.storage.getlist")
             
-            if storage_response.status_code == 200:
-                storage_result = storage_response.json()
+            if storages:
+                # Берем первое доступное хранилище
+                storage = storages[0]
+                storage_id = storage["ID"]
                 
-                if "result" in storage_result and storage_result["result"]:
-                    # Берем первое доступное хранилище
-                    storage = storage_result["result"][0]
-                    storage_id = storage["ID"]
-                    
-                    logger.info(f"📂 Используем хранилище: {storage.get('NAME', 'Unknown')} (ID: {storage_id})")
-                    
-                    # Загружаем файл в хранилище
-                    upload_url = f"https://{self.domain}/rest/{settings.bitrix24_user_id}/{self.access_token}/disk.storage.uploadfile"
+                logger.info(f"📂 Используем хранилище: {storage.get('NAME', 'Unknown')} (ID: {storage_id})")
+                
+                # Загружаем файл в хранилище
+                data = {
+                    'id': storage_id,
+                    'data[NAME]': filename
+                }
+                
+                upload_result = await self._post_file(self._disk_upload_url, data, file_path, filename)
+                
+                if upload_result and "result" in upload_result:
+                    file_data = upload_result["result"]
+                    file_id = file_data.get("ID")
+                    download_url = file_data.get("DOWNLOAD_URL", "")
                     
-                    with open(file_path, 'rb') as file_content:
-                        files = {
-                            'fileContent': (filename, file_content, self._get_mime_type(filename))
-                        }
-                        
-                        data = {
-                            'id': storage_id,
-                            'data[NAME]': filename
-                        }
-                        
-                        upload_response = requests.post(upload_url, data=data, files=files)
-                        
-                        logger.info(f"🔍 Загрузка на диск: {upload_response.status_code}")
-                        
-                        if upload_response.status_code == 200:
-                            upload_result = upload_response.json()
-                            
-                            if "result" in upload_result:
-                                file_data = upload_result["result"]
-                                file_id = file_data.get("ID")
-                                download_url = file_data.get("DOWNLOAD_URL", "")
-                                
-                                # Добавляем комментарий к задаче с прикрепленным файлом
-                                comment = f"""
+                    # Добавляем комментарий к задаче с прикрепленным файлом
+                    comment = f"""
 📎 **Файл прикреплен:** {filename}
 💾 **Размер:** {round(os.path.getsize(file_path) / 1024, 2)} KB
 🔗 **Скачать:** {download_url}
 📋 **ID файла:** {file_id}
 
 *Файл загружен из Telegram и сохранен в Битрикс24*
-                                """.strip()
-                                
-                                self.add_comment_to_task(task_id, comment)
-                                
-                                logger.info(f"✅ Файл {filename} загружен на диск Битрикс24 и прикреплен к задаче")
-                                return {"success": True, "method": "disk_upload", "file_id": file_id}
+                    """.strip()
+                    
+                    await self.add_comment_to_task(task_id, comment)
+                    
+                    logger.info(f"✅ Файл {filename} загружен на диск Битрикс24 и прикреплен к задаче")
+                    return {"success": True, "method": "disk_upload", "file_id": file_id}
             
             # Если все способы не сработали, добавляем хотя бы информацию о файле
-            self._add_file_info_fallback(task_id, file_path, filename)
+            await self._add_file_info_fallback(task_id, file_path, filename)
             return {"success": False, "method": "info_only"}
             
         except Exception as e:
             logger.error(f"Ошибка загрузки через диск: {e}")
-            self._add_file_info_fallback(task_id, file_path, filename)
+            await self._add_file_info_fallback(task_id, file_path, filename)
             return {"success": False, "error": str(e)}
     
-    def _add_file_info_fallback(self, task_id: int, file_path: str, filename: str):
+    async def _add_file_info_fallback(self, task_id: int, file_path: str, filename: str):
         """Добавление информации о файле если загрузка не удалась"""
         try:
             file_size_mb = round(os.path.getsize(file_path) / (1024 * 1024), 2)
@@ -289,7 +570,7 @@ class Bitrix24API:
 ❗ *Файл доступен администратору бота. При необходимости можно запросить отдельно.*
             """.strip()
             
-            self.add_comment_to_task(task_id, comment)
+            await self.add_comment_to_task(task_id, comment)
             logger.info(f"Добавлена информация о файле {filename} в комментарий к задаче")
             
         except Exception as e:
@@ -299,38 +580,28 @@ class Bitrix24API:
         """Альтернативный способ загрузки через диск и комментарий"""
         try:
             # Способ 1: Загружаем на диск Битрикс24
-            disk_url = f"https://{self.domain}/rest/{settings.bitrix24_user_id}/{self.access_token}/disk.storage.uploadfile"
+            data = {
+                'id': 1,  # ID хранилища (может потребоваться настройка)
+                'data[NAME]': filename
+            }
             
-            with open(file_path, 'rb') as file_content:
-                files = {
-                    'fileContent': (filename, file_content, self._get_mime_type(filename))
-                }
-                
-                data = {
-                    'id': 1,  # ID хранилища (может потребоваться настройка)
-                    'data[NAME]': filename
-                }
-                
-                response = requests.post(disk_url, data=data, files=files)
+            result = await self._post_file(self._disk_upload_url, data, file_path, filename)
+            
+            if result and "result" in result:
+                file_id = result["result"]["ID"]
+                download_url = result["result"]["DOWNLOAD_URL"]
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    
-                    if "result" in result:
-                        file_id = result["result"]["ID"]
-                        download_url = result["result"]["DOWNLOAD_URL"]
-                        
-                        # Добавляем комментарий с ссылкой на файл
-                        comment = f"""
+                # Добавляем комментарий с ссылкой на файл
+                comment = f"""
 📎 **Прикреплен файл:** {filename}
 🔗 **Ссылка для скачивания:** {download_url}
 📊 **Размер:** {round(os.path.getsize(file_path) / 1024, 2)} KB
-                        """.strip()
-                        
-                        self.add_comment_to_task(task_id, comment)
-                        
-                        logger.info(f"✅ Файл {filename} загружен на диск Битрикс24 и прикреплен к задаче")
-                        return {"success": True, "filename": filename, "file_id": file_id}
+                """.strip()
+                
+                await self.add_comment_to_task(task_id, comment)
+                
+                logger.info(f"✅ Файл {filename} загружен на диск Битрикс24 и прикреплен к задаче")
+                return {"success": True, "filename": filename, "file_id": file_id}
             
             # Способ 2: Если не получилось загрузить, добавляем информацию о файле
             file_size_mb = round(os.path.getsize(file_path) / (1024 * 1024), 2)
@@ -342,7 +613,7 @@ class Bitrix24API:
 ❗ *Для получения файла обратитесь к администратору бота*
             """.strip()
             
-            self.add_comment_to_task(task_id, comment)
+            await self.add_comment_to_task(task_id, comment)
             
             return {"success": False, "filename": filename, "local_only": True}
             
@@ -352,63 +623,74 @@ class Bitrix24API:
     
     def _get_mime_type(self, filename: str) -> str:
         """Определение MIME типа файла по расширению"""
-        extension = filename.lower().split('.')[-1] if '.' in filename else ''
-        
-        mime_types = {
-            'jpg': 'image/jpeg',
-            'jpeg': 'image/jpeg', 
-            'png': 'image/png',
-            'gif': 'image/gif',
-            'pdf': 'application/pdf',
-            'doc': 'application/msword',
-            'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'xls': 'application/vnd.ms-excel',
-            'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'txt': 'text/plain',
-            'mp4': 'video/mp4',
-            'mp3': 'audio/mpeg',
-            'ogg': 'audio/ogg',
-            'wav': 'audio/wav'
-        }
-        
-        return mime_types.get(extension, 'application/octet-stream')
+        return _mime_for(filename)
     
-    def get_users(self) -> List[Dict[str, Any]]:
-        """Получение списка пользователей"""
+    @cached(ttl=300, key="bx:users:all")
+    @single_flight(key="bx:users:all")
+    async def _fetch_users(self) -> List[Dict[str, Any]]:
+        """Загрузка всех пользователей (все страницы загружаются параллельно)"""
+        return await self._get_all_pages("user.get")
+
+    async def get_users(self) -> List[Dict[str, Any]]:
+        """Получение списка пользователей (кешируется на 5 минут)"""
         try:
-            result = self._make_request("GET", "user.get")
-            
-            if isinstance(result, list):
-                return result
-            elif isinstance(result, dict) and "result" in result:
-                return result["result"]
-            else:
-                return []
+            return await self._fetch_users()
                 
         except Exception as e:
             logger.error(f"Ошибка получения пользователей: {e}")
             return []
     
-    def get_active_users(self) -> List[Dict[str, Any]]:
+    @cached(ttl=300, key="bx:users:byid")
+    @single_flight(key="bx:users:byid")
+    async def _users_by_id(self) -> Dict[str, Dict[str, Any]]:
+        """Индекс ID пользователя -> пользователь (строится один раз на время жизни кеша)"""
+        return {str(user.get("ID")): user for user in await self._fetch_users()}
+
+    async def get_user_by_id(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Получение пользователя по ID из закешированного справочника"""
+        try:
+            return (await self._users_by_id()).get(str(user_id))
+                
+        except Exception as e:
+            logger.error(f"Ошибка получения пользователя {user_id}: {e}")
+            return None
+    
+    @cached(ttl=300, key="bx:users:staff")
+    @single_flight(key="bx:users:staff")
+    async def _staff_users(self) -> List[Dict[str, Any]]:
+        """Пользователи с именем и должностью (реальные сотрудники), отбираются один раз на время жизни кеша"""
+        return [
+            user for user in await self._fetch_users()
+            if (user.get("NAME") or "").strip() and (user.get("WORK_POSITION") or "").strip()
+        ]
+    
+    async def get_staff_users(self) -> List[Dict[str, Any]]:
+        """Сотрудники для выбора в проект (кешируется на 5 минут вместе со справочником)"""
+        try:
+            return await self._staff_users()
+                
+        except Exception as e:
+            logger.error(f"Ошибка получения сотрудников: {e}")
+            return []
+    
+    @cached(ttl=300, key="bx:users:active")
+    @single_flight(key="bx:users:active")
+    async def _fetch_active_users(self) -> List[Dict[str, Any]]:
+        """Загрузка активных пользователей (фильтрация на стороне Битрикс24)"""
+        return await self._get_all_pages("user.get", {"FILTER": {"ACTIVE": "Y"}})
+    
+    async def get_active_users(self) -> List[Dict[str, Any]]:
         """Получение списка активных пользователей"""
         try:
-            # Получаем всех пользователей и фильтруем активных
-            all_users = self.get_users()
-            
-            # Фильтруем только активных пользователей
-            active_users = [
-                user for user in all_users 
-                if user.get("ACTIVE") == "Y" or user.get("ACTIVE") == True
-            ]
-            
-            logger.info(f"Найдено {len(active_users)} активных пользователей из {len(all_users)}")
+            active_users = await self._fetch_active_users()
+            logger.info(f"Найдено {len(active_users)} активных пользователей")
             return active_users
                 
         except Exception as e:
             logger.error(f"Ошибка получения активных пользователей: {e}")
             return []
     
-    def search_user_by_name(self, search_term: str) -> List[Dict[str, Any]]:
+    async def search_user_by_name(self, search_term: str) -> List[Dict[str, Any]]:
         """Поиск пользователей по имени"""
         try:
             data = {
@@ -418,44 +700,55 @@ class Bitrix24API:
                 }
             }
             
-            result = self._make_request("GET", "user.get", data)
-            
-            if isinstance(result, list):
-                return result
-            elif isinstance(result, dict) and "result" in result:
-                return result["result"]
-            else:
-                return []
+            return await self._get_all_pages("user.get", data)
                 
         except Exception as e:
             logger.error(f"Ошибка поиска пользователей: {e}")
             return []
     
-    def get_user_by_telegram_id(self, telegram_id: str) -> Optional[Dict[str, Any]]:
+    @cached(ttl=300, key="bx:tgindex")
+    @single_flight(key="bx:tgindex")
+    async def _tg_index(self) -> Tuple[Dict[str, Dict[str, Any]], List[Dict[str, Any]]]:
+        """Индекс telegram_id -> пользователь и список пользователей с Telegram ID,
+        строятся за один проход по справочнику"""
+        index: Dict[str, Dict[str, Any]] = {}
+        users_with_tg: List[Dict[str, Any]] = []
+        fields = TELEGRAM_ID_FIELDS
+        
+        for user in await self._fetch_users():
+            get = user.get
+            first = True
+            for field in fields:
+                value = get(field)
+                if not value or not (telegram_id := str(value).strip()):
+                    continue
+                
+                if first:
+                    first = False
+                    # Копия: словари справочника общие для всех кешированных выборок
+                    # (TELEGRAM_ID - нормализованное поле, TELEGRAM_FIELD - какое поле использовалось)
+                    user = {**user, "TELEGRAM_ID": telegram_id, "TELEGRAM_FIELD": field}
+                    users_with_tg.append(user)
+                index.setdefault(telegram_id, user)
+        
+        return index, users_with_tg
+
+    async def get_user_by_telegram_id(self, telegram_id: str) -> Optional[Dict[str, Any]]:
         """Поиск пользователя по Telegram ID в поле tgID"""
         try:
-            # Получаем всех пользователей и ищем среди них
-            all_users = self.get_users()
-            
-            # Список возможных полей для Telegram ID
-            possible_fields = ["UF_TELEGRAM_ID", "UF_TG_ID", "UF_TGID", "tgID", "UF_USR_1755866403098"]
-            
-            for user in all_users:
-                for field in possible_fields:
-                    field_value = user.get(field, "")
-                    # Проверяем точное совпадение как строки
-                    if str(field_value).strip() == str(telegram_id).strip():
-                        logger.info(f"Найден пользователь по полю {field}: {user.get('NAME')} {user.get('LAST_NAME')} (ID: {user.get('ID')})")
-                        return user
-            
-            logger.info(f"Пользователь с Telegram ID {telegram_id} не найден")
-            return None
+            index, _ = await self._tg_index()
+            user = index.get(str(telegram_id).strip())
+            if user:
+                logger.info(f"Найден пользователь по полю {user.get('TELEGRAM_FIELD')}: {user.get('NAME')} {user.get('LAST_NAME')} (ID: {user.get('ID')})")
+            else:
+                logger.info(f"Пользователь с Telegram ID {telegram_id} не найден")
+            return user
                 
         except Exception as e:
             logger.error(f"Ошибка поиска пользователя по Telegram ID: {e}")
             return None
     
-    def update_user_telegram_id(self, user_id: int, telegram_id: str) -> bool:
+    async def update_user_telegram_id(self, user_id: int, telegram_id: str) -> bool:
         """Обновление поля tgID пользователя в Битрикс24"""
         try:
             # Пробуем разные возможные названия поля для Telegram ID
@@ -468,9 +761,12 @@ class Bitrix24API:
                         f"fields[{field}]": telegram_id
                     }
                     
-                    result = self._make_request("POST", "user.update", data)
+                    result = await self._make_request("POST", "user.update", data)
                     
                     if result:
+                        # Справочник пользователей изменился - сбрасываем кеш
+                        cache.delete_match("bx:users:*")
+                        cache.pop("bx:tgindex")
                         logger.info(f"Обновлен Telegram ID для пользователя {user_id}: {telegram_id} (поле: {field})")
                         return True
                         
@@ -485,42 +781,21 @@ class Bitrix24API:
             logger.error(f"Ошибка обновления Telegram ID пользователя: {e}")
             return False
     
-    def get_users_with_telegram_ids(self) -> List[Dict[str, Any]]:
+    async def get_users_with_telegram_ids(self) -> List[Dict[str, Any]]:
         """Получение всех пользователей, у которых заполнено поле tgID"""
         try:
-            all_users = self.get_users()
-            users_with_tg = []
-            
-            # Список возможных полей для Telegram ID
-            possible_fields = ["UF_TELEGRAM_ID", "UF_TG_ID", "UF_TGID", "tgID", "UF_USR_1755866403098"]
-            
-            for user in all_users:
-                # Проверяем различные возможные поля для Telegram ID
-                telegram_id = None
-                used_field = None
-                
-                for field in possible_fields:
-                    if field in user and user[field] and str(user[field]).strip():
-                        telegram_id = str(user[field]).strip()
-                        used_field = field
-                        break
-                
-                if telegram_id:
-                    user["TELEGRAM_ID"] = telegram_id  # Нормализуем поле
-                    user["TELEGRAM_FIELD"] = used_field  # Запоминаем, какое поле использовалось
-                    users_with_tg.append(user)
-                    logger.debug(f"Пользователь {user.get('NAME')} {user.get('LAST_NAME')} имеет Telegram ID {telegram_id} в поле {used_field}")
+            _, users_with_tg = await self._tg_index()
             
             logger.info(f"Найдено {len(users_with_tg)} пользователей с Telegram ID")
-            return users_with_tg
+            return list(users_with_tg)  # Копия, чтобы не менять закешированный список
                 
         except Exception as e:
             logger.error(f"Ошибка получения пользователей с Telegram ID: {e}")
             return []
     
-    def find_bitrix_user_by_telegram(self, telegram_id: str) -> Optional[int]:
+    async def find_bitrix_user_by_telegram(self, telegram_id: str) -> Optional[int]:
         """Поиск Bitrix24 ID пользователя по Telegram ID"""
-        user = self.get_user_by_telegram_id(telegram_id)
+        user = await self.get_user_by_telegram_id(telegram_id)
         if user:
             return int(user.get("ID", 0))
         return None
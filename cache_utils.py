@@ -0,0 +1,149 @@
+"""
+Кеширование результатов в памяти процесса
+"""
+import asyncio
+import fnmatch
+import functools
+import inspect
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Маркер отсутствия значения (None тоже может быть закешированным результатом)
+MISSING = object()
+
+
+class TTLCache:
+    """Кеш в памяти с временем жизни записей и ограничением по размеру"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: Dict[Any, Tuple[float, Any]] = {}  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """Получение значения, если запись существует и не устарела"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+
+            return value
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        """Сохранение значения (при переполнении вытесняется самая старая запись)"""
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+
+    def pop(self, key: Any, default: Any = None) -> Any:
+        """Удаление записи"""
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def delete_match(self, pattern: str) -> int:
+        """Удаление всех строковых ключей, подходящих под шаблон (например, "bx:users:*")"""
+        with self._lock:
+            keys = [key for key in self._data if isinstance(key, str) and fnmatch.fnmatchcase(key, pattern)]
+            for key in keys:
+                del self._data[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        """Очистка кеша"""
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, MISSING) is not MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# Общий кеш ответов внешних API
+cache = TTLCache(maxsize=10000)
+
+
+def _make_key(signature: inspect.Signature, template: str, args: tuple, kwargs: dict) -> str:
+    """Формирование ключа по шаблону из аргументов вызова"""
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return template.format(**bound.arguments)
+
+
+def cached(ttl: float, key: str) -> Callable:
+    """Декоратор для async-функций: результат кешируется на ttl секунд.
+
+    Ключ задается шаблоном с именами аргументов, например "bx:task:{task_id}".
+    Исключения не кешируются.
+    """
+    def decorator(func: Callable):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            cache_key = _make_key(signature, key, args, kwargs)
+
+            value = cache.get(cache_key, MISSING)
+            if value is not MISSING:
+                return value
+
+            value = await func(*args, **kwargs)
+            cache.set(cache_key, value, ttl)
+            return value
+
+        return wrapper
+    return decorator
+
+
+# Выполняющиеся вызовы: ключ -> future с результатом
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+def single_flight(key: str) -> Callable:
+    """Декоратор для async-функций: одновременные вызовы с одинаковым ключом
+    объединяются - функция выполняется один раз, остальные ждут ее результат.
+
+    Ставится под @cached, чтобы защитить момент промаха кеша.
+    """
+    def decorator(func: Callable):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            call_key = _make_key(signature, key, args, kwargs)
+
+            future = _inflight.get(call_key)
+            if future is not None:
+                # shield: отмена одного ожидающего не отменяет общий вызов
+                return await asyncio.shield(future)
+
+            future = asyncio.get_running_loop().create_future()
+            _inflight[call_key] = future
+            try:
+                result = await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                future.exception()  # Помечаем исключение как полученное, если ожидающих нет
+                raise
+            else:
+                future.set_result(result)
+                return result
+            finally:
+                _inflight.pop(call_key, None)
+
+        return wrapper
+    return decorator
@@ -24,6 +24,9 @@ class Settings(BaseSettings):
     # Logging
     log_level: str = "INFO"
     
+    # Отладка: создавать задачу по любому сообщению с "@", а не только по упоминанию бота
+    debug_accept_any_at: bool = False
+    
     class Config:
         env_file = ".env"
 
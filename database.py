@@ -1,8 +1,13 @@
 """
 Управление базой данных
 """
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from sqlalchemy.orm import sessionmaker, Session
+from typing import Iterator
 from sqlalchemy.ext.declarative import declarative_base
 from config import settings
 from models import Base
@@ -10,17 +15,119 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+
+def _engine_options(database_url: str) -> dict:
+    """Параметры движка: пул соединений, для SQLite - доступ к соединению из разных потоков"""
+    url = make_url(database_url)
+    # query_cache_size - кеш скомпилированных SQL-выражений SQLAlchemy 2.0
+    options = {"echo": False, "pool_pre_ping": True, "query_cache_size": 1200}
+    
+    if url.get_backend_name() == "postgresql":
+        # Пакетная вставка многих строк одним INSERT ... VALUES
+        options["insertmanyvalues_page_size"] = 1000
+        if url.get_driver_name() == "psycopg2":
+            # UPDATE/DELETE с executemany тоже отправляются пачками
+            options["executemany_mode"] = "values_plus_batch"
+    
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+        # Для базы в памяти SQLAlchemy использует собственный пул с одним соединением
+        if not url.database or url.database == ":memory:":
+            return options
+    
+    # Держим прогретые соединения; пересоздаем их раз в 30 минут
+    options.update(pool_size=20, max_overflow=10, pool_recycle=1800)
+    return options
+
+
 # Создание движка базы данных
-engine = create_engine(settings.database_url, echo=False)
+engine = create_engine(settings.database_url, **_engine_options(settings.database_url))
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    """WAL-журнал: читатели не блокируются записью, меньше fsync на транзакцию;
+    увеличенный кеш страниц и mmap сокращают чтения с диска"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")  # 64 МБ страничного кеша
+    cursor.execute("PRAGMA mmap_size=268435456")  # Чтение файла базы через mmap (256 МБ)
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", _set_sqlite_pragma)
 
 # Создание сессии
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False: объекты остаются заполненными после commit и закрытия сессии
+# (без повторного SELECT при обращении к атрибутам)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+
+# Колонки, добавленные после первого релиза: (таблица, колонка, DDL, заполнение существующих строк или None)
+_ADDED_COLUMNS = [
+    (
+        "chat_employees", "is_pending", "BOOLEAN NOT NULL DEFAULT FALSE",
+        "UPDATE chat_employees SET is_pending = (telegram_user_id LIKE 'pending\\_%' ESCAPE '\\')",
+    ),
+    ("tasks", "next_poll_at", "TIMESTAMP", None),
+]
+
+
+def _add_missing_columns():
+    """Добавление новых колонок в уже существующие таблицы (create_all их не создает)"""
+    existing_tables = inspect(engine).get_table_names()
+    
+    for table, column, ddl, backfill in _ADDED_COLUMNS:
+        if table not in existing_tables:
+            continue
+        
+        columns = {col["name"] for col in inspect(engine).get_columns(table)}
+        if column in columns:
+            continue
+        
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+            if backfill:
+                conn.execute(text(backfill))
+        logger.info(f"Добавлена колонка {table}.{column}")
+
+
+# Индексы, замененные более полными: (таблица, индекс)
+_DROPPED_INDEXES = [
+    # Левый префикс ix_chat_emp_bitrix_linked (bitrix24_user_id, is_active, is_pending)
+    ("chat_employees", "ix_chat_emp_bitrix_active"),
+]
+
+
+def _drop_replaced_indexes():
+    """Удаление из существующих таблиц индексов, которые заменены другими"""
+    existing_tables = inspect(engine).get_table_names()
+    
+    for table, index in _DROPPED_INDEXES:
+        if table not in existing_tables:
+            continue
+        
+        if index not in {idx["name"] for idx in inspect(engine).get_indexes(table)}:
+            continue
+        
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP INDEX {index}"))
+        logger.info(f"Удален индекс {table}.{index}")
 
 
 def create_tables():
     """Создание всех таблиц в базе данных"""
     try:
+        _add_missing_columns()
+        _drop_replaced_indexes()
         Base.metadata.create_all(bind=engine)
+        
+        # create_all не добавляет новые индексы в уже существующие таблицы
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
         logger.info("Таблицы базы данных успешно созданы")
     except Exception as e:
         logger.error(f"Ошибка при создании таблиц: {e}")
@@ -39,3 +146,27 @@ def get_db() -> Session:
 def get_db_session() -> Session:
     """Получение сессии базы данных (синхронная версия)"""
     return SessionLocal()
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """Сессия базы данных на время блока with: откат при ошибке и возврат соединения в пул.
+    Фиксация изменений (commit) остается за вызывающим кодом"""
+    db = SessionLocal()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def upsert(model):
+    """INSERT ... ON CONFLICT для текущей СУБД (поддерживаются SQLite и PostgreSQL).
+    Для других СУБД возвращает None - вызывающий код выполняет обычные SELECT и INSERT/UPDATE"""
+    if engine.dialect.name == "sqlite":
+        return sqlite_insert(model)
+    if engine.dialect.name == "postgresql":
+        return postgresql_insert(model)
+    return None
@@ -1,275 +1,387 @@
 """
 Сервис управления сотрудниками в чатах
 """
+import asyncio
+from datetime import datetime
 from typing import List, Optional, Dict, Any
+from sqlalchemy import select, bindparam, func, literal, union_all
 from sqlalchemy.orm import Session
 
-from models import ChatEmployee, BotUser, UserRole
-from database import get_db_session
+from models import ChatEmployee, BotUser, UserRole, PENDING_TELEGRAM_ID_PREFIX
+from database import session_scope, upsert
+from cache_utils import TTLCache, MISSING
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Запросы горячего пути собираются один раз; скомпилированный SQL берется из кеша движка
+_IS_EMPLOYEE_STMT = select(ChatEmployee.id).where(
+    ChatEmployee.telegram_chat_id == bindparam("chat_id"),
+    ChatEmployee.telegram_user_id == bindparam("user_id"),
+    ChatEmployee.is_active == True
+).limit(1)
+
+_EMPLOYEE_BITRIX_ID_STMT = select(ChatEmployee.bitrix24_user_id).where(
+    ChatEmployee.telegram_chat_id == bindparam("chat_id"),
+    ChatEmployee.telegram_user_id == bindparam("user_id"),
+    ChatEmployee.is_active == True
+).limit(1)
+
+# Кеш членства сотрудников: (chat_id, user_id) -> bool
+_membership_cache = TTLCache(maxsize=10_000, ttl=300)
+
+# Кеш привязки к Битрикс24: telegram_id -> bitrix24_user_id (или None)
+_bitrix_cache = TTLCache(maxsize=10_000, ttl=300)
+
+# Обратный кеш: bitrix24_user_id -> telegram_id (или None)
+_telegram_cache = TTLCache(maxsize=10_000, ttl=300)
+
 
 class EmployeeService:
     """Сервис для управления сотрудниками в чатах"""
     
+    @staticmethod
+    def _invalidate(telegram_chat_id: str, telegram_user_id: str) -> None:
+        """Сброс кешей после изменения сотрудника"""
+        _membership_cache.pop((telegram_chat_id, telegram_user_id))
+        _bitrix_cache.pop(telegram_user_id)
+        # Bitrix24 ID измененной строки здесь не известен - обратный кеш сбрасывается целиком
+        _telegram_cache.clear()
+    
     def add_employee_to_chat(self, telegram_chat_id: str, telegram_user_id: str, 
                            bitrix24_user_id: Optional[int] = None, added_by: str = "system") -> bool:
         """Добавление сотрудника в чат"""
-        db = get_db_session()
         try:
-            # Проверяем, не добавлен ли уже
-            existing = db.query(ChatEmployee).filter(
-                ChatEmployee.telegram_chat_id == telegram_chat_id,
-                ChatEmployee.telegram_user_id == telegram_user_id
-            ).first()
-            
-            if existing:
-                if not existing.is_active:
-                    # Реактивируем сотрудника
-                    existing.is_active = True
-                    existing.added_by = added_by
-                    db.commit()
-                    logger.info(f"Реактивирован сотрудник {telegram_user_id} в чате {telegram_chat_id}")
-                    return True
-                else:
-                    logger.info(f"Сотрудник {telegram_user_id} уже добавлен в чат {telegram_chat_id}")
-                    return False
-            
-            # Добавляем нового сотрудника
-            employee = ChatEmployee(
-                telegram_chat_id=telegram_chat_id,
-                telegram_user_id=telegram_user_id,
-                bitrix24_user_id=bitrix24_user_id,
-                added_by=added_by
-            )
-            
-            db.add(employee)
-            db.commit()
-            
-            logger.info(f"Добавлен сотрудник {telegram_user_id} в чат {telegram_chat_id}")
-            return True
-            
+            with session_scope() as db:
+                # Проверяем, не добавлен ли уже
+                existing = db.query(ChatEmployee).filter(
+                    ChatEmployee.telegram_chat_id == telegram_chat_id,
+                    ChatEmployee.telegram_user_id == telegram_user_id
+                ).first()
+                
+                if existing:
+                    if not existing.is_active:
+                        # Реактивируем сотрудника
+                        existing.is_active = True
+                        existing.added_by = added_by
+                        db.commit()
+                        self._invalidate(telegram_chat_id, telegram_user_id)
+                        logger.info("Реактивирован сотрудник %s в чате %s", telegram_user_id, telegram_chat_id)
+                        return True
+                    else:
+                        logger.info("Сотрудник %s уже добавлен в чат %s", telegram_user_id, telegram_chat_id)
+                        return False
+                
+                # Добавляем нового сотрудника
+                employee = ChatEmployee(
+                    telegram_chat_id=telegram_chat_id,
+                    telegram_user_id=telegram_user_id,
+                    bitrix24_user_id=bitrix24_user_id,
+                    added_by=added_by,
+                    is_pending=telegram_user_id.startswith(PENDING_TELEGRAM_ID_PREFIX)
+                )
+                
+                db.add(employee)
+                db.commit()
+                self._invalidate(telegram_chat_id, telegram_user_id)
+                
+                logger.info("Добавлен сотрудник %s в чат %s", telegram_user_id, telegram_chat_id)
+                return True
+                
         except Exception as e:
-            db.rollback()
-            logger.error(f"Ошибка добавления сотрудника: {e}")
+            logger.error("Ошибка добавления сотрудника: %s", e)
             return False
-        finally:
-            db.close()
     
     def get_chat_employees(self, telegram_chat_id: str) -> List[ChatEmployee]:
         """Получение списка сотрудников чата"""
-        db = get_db_session()
-        try:
+        with session_scope() as db:
             employees = db.query(ChatEmployee).filter(
                 ChatEmployee.telegram_chat_id == telegram_chat_id,
                 ChatEmployee.is_active == True
             ).all()
             
             return employees
-            
-        finally:
-            db.close()
+    
+    def get_employee_counts(self, telegram_chat_ids: List[str]) -> Dict[str, int]:
+        """Количество активных сотрудников по чатам одним GROUP BY (чаты без сотрудников - 0)"""
+        if not telegram_chat_ids:
+            return {}
+        
+        with session_scope() as db:
+            rows = db.execute(
+                select(ChatEmployee.telegram_chat_id, func.count()).where(
+                    ChatEmployee.telegram_chat_id.in_(telegram_chat_ids),
+                    ChatEmployee.is_active == True
+                ).group_by(ChatEmployee.telegram_chat_id)
+            ).all()
+        
+        counts = dict.fromkeys(telegram_chat_ids, 0)
+        counts.update(rows)
+        return counts
     
     def get_employee_bitrix_id(self, telegram_chat_id: str, telegram_user_id: str) -> Optional[int]:
         """Получение Bitrix24 ID сотрудника в конкретном чате"""
-        db = get_db_session()
-        try:
-            employee = db.query(ChatEmployee).filter(
-                ChatEmployee.telegram_chat_id == telegram_chat_id,
-                ChatEmployee.telegram_user_id == telegram_user_id,
-                ChatEmployee.is_active == True
+        with session_scope() as db:
+            # Загружаем только нужную колонку, а не всю строку
+            return db.execute(
+                _EMPLOYEE_BITRIX_ID_STMT,
+                {"chat_id": telegram_chat_id, "user_id": telegram_user_id}
+            ).scalar()
+
+    def get_active_employee(self, telegram_chat_id: str, telegram_user_id: str):
+        """Активный сотрудник чата (строка с bitrix24_user_id) или None, если его нет в чате"""
+        with session_scope() as db:
+            return db.execute(
+                _EMPLOYEE_BITRIX_ID_STMT,
+                {"chat_id": telegram_chat_id, "user_id": telegram_user_id}
             ).first()
-            
-            if employee:
-                return employee.bitrix24_user_id
-            
-            return None
-            
-        finally:
-            db.close()
-    
+
     def is_employee_in_chat(self, telegram_chat_id: str, telegram_user_id: str) -> bool:
-        """Проверка, является ли пользователь сотрудником в чате"""
-        db = get_db_session()
-        try:
-            employee = db.query(ChatEmployee).filter(
-                ChatEmployee.telegram_chat_id == telegram_chat_id,
-                ChatEmployee.telegram_user_id == telegram_user_id,
-                ChatEmployee.is_active == True
-            ).first()
-            
-            return employee is not None
-            
-        finally:
-            db.close()
+        """Проверка, является ли пользователь сотрудником в чате (кешируется на 5 минут)"""
+        key = (telegram_chat_id, telegram_user_id)
+        is_employee = _membership_cache.get(key)
+        if is_employee is not None:
+            return is_employee
+        
+        with session_scope() as db:
+            # SELECT id ... LIMIT 1 - строка целиком не нужна
+            employee_id = db.execute(
+                _IS_EMPLOYEE_STMT,
+                {"chat_id": telegram_chat_id, "user_id": telegram_user_id}
+            ).scalar()
+            
+            is_employee = employee_id is not None
+            _membership_cache.set(key, is_employee)
+            return is_employee
     
     def remove_employee_from_chat(self, telegram_chat_id: str, telegram_user_id: str, 
                                 removed_by: str = "system") -> bool:
         """Удаление сотрудника из чата"""
-        db = get_db_session()
         try:
-            employee = db.query(ChatEmployee).filter(
-                ChatEmployee.telegram_chat_id == telegram_chat_id,
-                ChatEmployee.telegram_user_id == telegram_user_id
-            ).first()
-            
-            if employee:
-                employee.is_active = False
-                employee.added_by = f"Удален: {removed_by}"
-                db.commit()
+            with session_scope() as db:
+                # UPDATE ... WHERE без предварительной загрузки строки
+                updated = db.query(ChatEmployee).filter(
+                    ChatEmployee.telegram_chat_id == telegram_chat_id,
+                    ChatEmployee.telegram_user_id == telegram_user_id
+                ).update(
+                    {ChatEmployee.is_active: False, ChatEmployee.added_by: f"Удален: {removed_by}"},
+                    synchronize_session=False
+                )
+                
+                if updated:
+                    db.commit()
+                    self._invalidate(telegram_chat_id, telegram_user_id)
+                    
+                    logger.info("Удален сотрудник %s из чата %s", telegram_user_id, telegram_chat_id)
+                    return True
+                
+                return False
                 
-                logger.info(f"Удален сотрудник {telegram_user_id} из чата {telegram_chat_id}")
-                return True
-            
-            return False
-            
         except Exception as e:
-            db.rollback()
-            logger.error(f"Ошибка удаления сотрудника: {e}")
+            logger.error("Ошибка удаления сотрудника: %s", e)
             return False
-        finally:
-            db.close()
     
     def update_employee_bitrix_id(self, telegram_chat_id: str, telegram_user_id: str, 
                                 bitrix24_user_id: int) -> bool:
         """Обновление Bitrix24 ID сотрудника"""
-        db = get_db_session()
         try:
-            employee = db.query(ChatEmployee).filter(
-                ChatEmployee.telegram_chat_id == telegram_chat_id,
-                ChatEmployee.telegram_user_id == telegram_user_id,
-                ChatEmployee.is_active == True
-            ).first()
-            
-            if employee:
-                employee.bitrix24_user_id = bitrix24_user_id
-                db.commit()
+            with session_scope() as db:
+                updated = db.query(ChatEmployee).filter(
+                    ChatEmployee.telegram_chat_id == telegram_chat_id,
+                    ChatEmployee.telegram_user_id == telegram_user_id,
+                    ChatEmployee.is_active == True
+                ).update({ChatEmployee.bitrix24_user_id: bitrix24_user_id}, synchronize_session=False)
+                
+                if updated:
+                    db.commit()
+                    self._invalidate(telegram_chat_id, telegram_user_id)
+                    
+                    logger.info("Обновлен Bitrix24 ID сотрудника %s: %s", telegram_user_id, bitrix24_user_id)
+                    return True
+                
+                return False
                 
-                logger.info(f"Обновлен Bitrix24 ID сотрудника {telegram_user_id}: {bitrix24_user_id}")
-                return True
-            
-            return False
-            
         except Exception as e:
-            db.rollback()
-            logger.error(f"Ошибка обновления Bitrix24 ID сотрудника: {e}")
+            logger.error("Ошибка обновления Bitrix24 ID сотрудника: %s", e)
             return False
-        finally:
-            db.close()
     
     def find_linked_telegram_id(self, bitrix24_user_id: int) -> Optional[str]:
-        """Поиск связанного Telegram ID для Bitrix24 пользователя"""
-        db = get_db_session()
-        try:
-            # Сначала ищем в глобальной таблице BotUser
-            bot_user = db.query(BotUser).filter(
-                BotUser.bitrix24_user_id == bitrix24_user_id
-            ).first()
-            
-            if bot_user:
-                return bot_user.telegram_user_id
-            
-            # Если в глобальной таблице нет, ищем в ChatEmployee
-            employee = db.query(ChatEmployee).filter(
-                ChatEmployee.bitrix24_user_id == bitrix24_user_id,
+        """Поиск связанного Telegram ID для Bitrix24 пользователя (кешируется на 5 минут)"""
+        telegram_id = _telegram_cache.get(bitrix24_user_id, MISSING)
+        if telegram_id is not MISSING:
+            return telegram_id
+        
+        telegram_id = self._load_linked_telegram_id(bitrix24_user_id)
+        _telegram_cache.set(bitrix24_user_id, telegram_id)
+        return telegram_id
+    
+    def find_linked_telegram_ids(self, bitrix24_user_ids: List[int]) -> Dict[int, Optional[str]]:
+        """Связанные Telegram ID для нескольких Bitrix24 пользователей: промахи кеша
+        загружаются одним запросом (нет связи - None)"""
+        result: Dict[int, Optional[str]] = {}
+        missing: List[int] = []
+        for bitrix24_user_id in bitrix24_user_ids:
+            telegram_id = _telegram_cache.get(bitrix24_user_id, MISSING)
+            if telegram_id is MISSING:
+                missing.append(bitrix24_user_id)
+            else:
+                result[bitrix24_user_id] = telegram_id
+
+        if missing:
+            # Приоритет источников тот же, что в _load_linked_telegram_id
+            from_profiles = select(
+                BotUser.bitrix24_user_id.label('bitrix_id'), BotUser.telegram_user_id.label('value'),
+                literal(0).label('src')
+            ).where(BotUser.bitrix24_user_id.in_(missing))
+            from_employees = select(
+                ChatEmployee.bitrix24_user_id, ChatEmployee.telegram_user_id, literal(1)
+            ).where(
+                ChatEmployee.bitrix24_user_id.in_(missing),
                 ChatEmployee.is_active == True,
-                ~ChatEmployee.telegram_user_id.like('pending_%')
-            ).first()
-            
-            if employee:
-                return employee.telegram_user_id
-            
-            return None
-            
-        finally:
-            db.close()
+                ChatEmployee.is_pending == False
+            )
+
+            loaded: Dict[int, str] = {}
+            with session_scope() as db:
+                for bitrix_id, telegram_id, _ in db.execute(union_all(from_profiles, from_employees).order_by('src')):
+                    loaded.setdefault(bitrix_id, telegram_id)
+
+            for bitrix24_user_id in missing:
+                telegram_id = loaded.get(bitrix24_user_id)
+                _telegram_cache.set(bitrix24_user_id, telegram_id)
+                result[bitrix24_user_id] = telegram_id
+
+        return result
+
+    def _load_linked_telegram_id(self, bitrix24_user_id: int) -> Optional[str]:
+        """Поиск Telegram ID по Bitrix24 ID в базе"""
+        # Глобальная таблица BotUser (src=0) имеет приоритет над ChatEmployee (src=1);
+        # оба источника проверяются одним запросом
+        from_profiles = select(BotUser.telegram_user_id.label('value'), literal(0).label('src')).where(
+            BotUser.bitrix24_user_id == bitrix24_user_id
+        )
+        from_employees = select(ChatEmployee.telegram_user_id, literal(1)).where(
+            ChatEmployee.bitrix24_user_id == bitrix24_user_id,
+            ChatEmployee.is_active == True,
+            ChatEmployee.is_pending == False
+        )
+        
+        with session_scope() as db:
+            return db.execute(
+                union_all(from_profiles, from_employees).order_by('src').limit(1)
+            ).scalar()
     
     def get_bitrix_id_by_telegram_id(self, telegram_id: str) -> Optional[int]:
-        """Получение Bitrix24 ID по Telegram ID"""
-        db = get_db_session()
-        try:
-            # Сначала ищем в глобальной таблице
-            bot_user = db.query(BotUser).filter(
-                BotUser.telegram_user_id == telegram_id
-            ).first()
-            
-            if bot_user and bot_user.bitrix24_user_id:
-                return bot_user.bitrix24_user_id
-            
-            # Если в глобальной таблице нет, ищем в ChatEmployee
-            employee = db.query(ChatEmployee).filter(
-                ChatEmployee.telegram_user_id == telegram_id,
-                ChatEmployee.is_active == True
-            ).first()
-            
-            if employee:
-                return employee.bitrix24_user_id
-            
-            return None
-            
-        finally:
-            db.close()
+        """Получение Bitrix24 ID по Telegram ID (кешируется на 5 минут)"""
+        bitrix_id = _bitrix_cache.get(telegram_id, MISSING)
+        if bitrix_id is not MISSING:
+            return bitrix_id
+        
+        bitrix_id = self._load_bitrix_id_by_telegram_id(telegram_id)
+        _bitrix_cache.set(telegram_id, bitrix_id)
+        return bitrix_id
+    
+    async def get_bitrix_id_by_telegram_id_async(self, telegram_id: str) -> Optional[int]:
+        """Bitrix24 ID для обработчиков бота: при попадании в кеш ответ сразу,
+        иначе обращение к базе выполняется в пуле потоков и не блокирует event loop"""
+        bitrix_id = _bitrix_cache.get(telegram_id, MISSING)
+        if bitrix_id is not MISSING:
+            return bitrix_id
+        
+        return await asyncio.to_thread(self.get_bitrix_id_by_telegram_id, telegram_id)
+    
+    def _load_bitrix_id_by_telegram_id(self, telegram_id: str) -> Optional[int]:
+        """Поиск Bitrix24 ID по Telegram ID в базе: сначала глобальный профиль, затем сотрудники чатов"""
+        from_profiles = select(BotUser.bitrix24_user_id.label('value'), literal(0).label('src')).where(
+            BotUser.telegram_user_id == telegram_id,
+            BotUser.bitrix24_user_id.isnot(None)
+        )
+        from_employees = select(ChatEmployee.bitrix24_user_id, literal(1)).where(
+            ChatEmployee.telegram_user_id == telegram_id,
+            ChatEmployee.is_active == True
+        )
+        
+        with session_scope() as db:
+            return db.execute(
+                union_all(from_profiles, from_employees).order_by('src').limit(1)
+            ).scalar()
     
     def update_global_user_profile(self, telegram_id: str, bitrix24_user_id: int) -> bool:
         """Обновление глобального профиля пользователя с Bitrix24 ID"""
-        db = get_db_session()
         try:
-            # Ищем существующего пользователя
-            bot_user = db.query(BotUser).filter(
-                BotUser.telegram_user_id == telegram_id
-            ).first()
-            
-            if bot_user:
-                # Обновляем существующего
-                bot_user.bitrix24_user_id = bitrix24_user_id
-            else:
-                # Создаем нового с ролью клиента по умолчанию
-                bot_user = BotUser(
-                    telegram_user_id=telegram_id,
-                    role=UserRole.CLIENT,
-                    bitrix24_user_id=bitrix24_user_id
-                )
-                db.add(bot_user)
-            
-            db.commit()
-            logger.info(f"Обновлен глобальный профиль: Telegram {telegram_id} -> Bitrix24 {bitrix24_user_id}")
-            return True
-            
+            stmt = upsert(BotUser)
+            
+            with session_scope() as db:
+                if stmt is not None:
+                    # Один атомарный запрос: новый пользователь создается с ролью клиента,
+                    # у существующего обновляется только Bitrix24 ID
+                    db.execute(
+                        stmt.values(
+                            telegram_user_id=telegram_id,
+                            role=UserRole.CLIENT.value,
+                            bitrix24_user_id=bitrix24_user_id
+                        ).on_conflict_do_update(
+                            index_elements=[BotUser.telegram_user_id],
+                            set_={"bitrix24_user_id": bitrix24_user_id, "updated_at": datetime.utcnow()}
+                        )
+                    )
+                else:
+                    # СУБД без ON CONFLICT: ищем существующего пользователя
+                    bot_user = db.query(BotUser).filter(
+                        BotUser.telegram_user_id == telegram_id
+                    ).first()
+                    
+                    if bot_user:
+                        bot_user.bitrix24_user_id = bitrix24_user_id
+                    else:
+                        # Создаем нового с ролью клиента по умолчанию
+                        db.add(BotUser(
+                            telegram_user_id=telegram_id,
+                            role=UserRole.CLIENT,
+                            bitrix24_user_id=bitrix24_user_id
+                        ))
+                
+                db.commit()
+                # Глобальный профиль приоритетнее записей в чатах - связь известна в обе стороны
+                _bitrix_cache.set(telegram_id, bitrix24_user_id)
+                _telegram_cache.set(bitrix24_user_id, telegram_id)
+                logger.info("Обновлен глобальный профиль: Telegram %s -> Bitrix24 %s", telegram_id, bitrix24_user_id)
+                return True
+                
         except Exception as e:
-            db.rollback()
-            logger.error(f"Ошибка обновления глобального профиля: {e}")
+            logger.error("Ошибка обновления глобального профиля: %s", e)
             return False
-        finally:
-            db.close()
     
     def update_employee_telegram_id(self, telegram_chat_id: str, old_telegram_id: str, 
                                   new_telegram_id: str) -> bool:
         """Обновление Telegram ID сотрудника в чате"""
-        db = get_db_session()
         try:
-            employee = db.query(ChatEmployee).filter(
-                ChatEmployee.telegram_chat_id == telegram_chat_id,
-                ChatEmployee.telegram_user_id == old_telegram_id,
-                ChatEmployee.is_active == True
-            ).first()
-            
-            if employee:
-                employee.telegram_user_id = new_telegram_id
-                db.commit()
+            with session_scope() as db:
+                updated = db.query(ChatEmployee).filter(
+                    ChatEmployee.telegram_chat_id == telegram_chat_id,
+                    ChatEmployee.telegram_user_id == old_telegram_id,
+                    ChatEmployee.is_active == True
+                ).update(
+                    {
+                        ChatEmployee.telegram_user_id: new_telegram_id,
+                        ChatEmployee.is_pending: new_telegram_id.startswith(PENDING_TELEGRAM_ID_PREFIX)
+                    },
+                    synchronize_session=False
+                )
+                
+                if updated:
+                    db.commit()
+                    self._invalidate(telegram_chat_id, old_telegram_id)
+                    self._invalidate(telegram_chat_id, new_telegram_id)
+                    
+                    logger.info("Обновлен Telegram ID сотрудника: %s -> %s", old_telegram_id, new_telegram_id)
+                    return True
+                
+                return False
                 
-                logger.info(f"Обновлен Telegram ID сотрудника: {old_telegram_id} -> {new_telegram_id}")
-                return True
-            
-            return False
-            
         except Exception as e:
-            db.rollback()
-            logger.error(f"Ошибка обновления Telegram ID сотрудника: {e}")
+            logger.error("Ошибка обновления Telegram ID сотрудника: %s", e)
             return False
-        finally:
-            db.close()
 
 
 # Создаем глобальный экземпляр сервиса
@@ -1,22 +1,42 @@
 """
 Основной файл запуска бота поддержки
 """
-import asyncio
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from telegram.ext import Application
 
 from config import settings
 from database import create_tables
 from telegram_bot import create_bot_application
-from status_sync_service import status_sync_service
+from status_sync_service import status_sync_service, SYNC_JOB_NAME
+
+
+def setup_logging():
+    """Настройка логирования через очередь: запись в поток вывода выполняется
+    в отдельном потоке и не блокирует event loop"""
+    log_queue = queue.SimpleQueue()
+    
+    # Сообщение форматируется в QueueHandler, поток вывода пишет его как есть
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=getattr(logging, settings.log_level.upper()),
+        handlers=[QueueHandler(log_queue)],
+        force=True  # Заменяем обработчик, установленный при импорте telegram_bot
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
 
 # Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=getattr(logging, settings.log_level.upper())
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Задержка первой синхронизации статусов с Битрикс24 после запуска (секунды)
+SYNC_FIRST_DELAY = 30
+
 
 def main():
     """Основная функция запуска бота"""
@@ -33,19 +53,15 @@ def main():
         # Настраиваем сервис синхронизации
         status_sync_service.set_telegram_app(application)
         
-        # Запускаем периодическую синхронизацию в фоне
-        async def start_sync():
-            await asyncio.sleep(30)  # Ждем 30 секунд после запуска бота
-            await status_sync_service.start_periodic_sync(interval_minutes=5)
-        
-        # Добавляем задачу синхронизации
+        # Периодическая синхронизация через JobQueue: каждый проход сам планирует следующий
         application.job_queue.run_once(
-            lambda context: asyncio.create_task(start_sync()),
-            when=1
+            status_sync_service.sync_job,
+            when=SYNC_FIRST_DELAY,
+            name=SYNC_JOB_NAME
         )
         
         logger.info("Бот запущен и готов к работе")
-        logger.info("Периодическая синхронизация с Битрикс24 будет запущена через 30 секунд")
+        logger.info(f"Периодическая синхронизация с Битрикс24 будет запущена через {SYNC_FIRST_DELAY} секунд")
         
         application.run_polling(
             allowed_updates=["message", "callback_query", "chat_member"]
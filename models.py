@@ -4,13 +4,16 @@
 from enum import Enum
 from typing import Optional, Dict, Any
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, create_engine, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, create_engine, UniqueConstraint, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from pydantic import BaseModel
 
 Base = declarative_base()
 
+# Префикс временного Telegram ID сотрудника, еще не связавшего свой аккаунт
+PENDING_TELEGRAM_ID_PREFIX = "pending_"
+
 
 class TaskType(str, Enum):
     """Типы задач"""
@@ -52,6 +55,28 @@ class Task(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     is_type_confirmed = Column(Boolean, default=False)
+    
+    # Когда задачу следующий раз опрашивать в Битрикс24 (None - при каждой синхронизации)
+    next_poll_at = Column(DateTime, nullable=True)
+    
+    # Составные индексы. Индекс используется запросом, только если условия запроса покрывают
+    # его колонки слева направо (без пропусков), поэтому порядок колонок важен:
+    # - чат + статус: агрегаты по проектам;
+    # - чат + дата создания: задачи проекта и чата по убыванию даты;
+    # - пользователь + статус + дата создания: задачи пользователя (get_user_tasks);
+    # - статус + время опроса: задачи, которые пора опросить в Битрикс24;
+    # - статус + Bitrix24 ID (только задачи, созданные в Битрикс24): активные задачи для синхронизации
+    __table_args__ = (
+        Index('ix_tasks_chat_status', 'telegram_chat_id', 'status'),
+        Index('ix_tasks_chat_created', 'telegram_chat_id', 'created_at', 'id'),
+        Index('ix_tasks_user_status_created', 'telegram_user_id', 'status', 'created_at'),
+        Index('ix_tasks_status_next_poll', 'status', 'next_poll_at'),
+        Index(
+            'ix_tasks_status_bitrix', 'status', 'bitrix24_task_id',
+            sqlite_where=text('bitrix24_task_id IS NOT NULL'),
+            postgresql_where=text('bitrix24_task_id IS NOT NULL')
+        ),
+    )
 
 
 class TaskCreateRequest(BaseModel):
@@ -104,6 +129,10 @@ class BotUser(Base):
     added_by = Column(String, nullable=True)  # Кто добавил пользователя
     notes = Column(Text, nullable=True)  # Заметки об пользователе
     bitrix24_user_id = Column(Integer, nullable=True)  # ID в Битрикс24
+    
+    __table_args__ = (
+        Index('ix_botuser_bitrix', 'bitrix24_user_id'),
+    )
 
 
 class ChatEmployee(Base):
@@ -118,8 +147,12 @@ class ChatEmployee(Base):
     is_active = Column(Boolean, default=True)
     added_at = Column(DateTime, default=datetime.utcnow)
     added_by = Column(String, nullable=True)  # Кто добавил сотрудника
+    is_pending = Column(Boolean, default=False, nullable=False)  # Telegram ID еще не привязан (pending_<bitrix_id>)
     
     # Уникальный индекс: один пользователь может быть сотрудником только один раз в чате
+    # (он же покрывает поиск по чату и пользователю)
     __table_args__ = (
         UniqueConstraint('telegram_chat_id', 'telegram_user_id', name='unique_employee_chat'),
+        Index('ix_chat_emp_bitrix_linked', 'bitrix24_user_id', 'is_active', 'is_pending'),
+        Index('ix_chat_emp_tg_active', 'telegram_user_id', 'is_active'),
     )
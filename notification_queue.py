@@ -0,0 +1,135 @@
+"""
+Очередь исходящих уведомлений Telegram с соблюдением лимитов отправки
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Any, Deque, Dict
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationQueue:
+    """Фоновая отправка уведомлений: код синхронизации только ставит сообщение в очередь,
+    а обработчики чатов отправляют его, соблюдая лимиты Telegram"""
+
+    # Не больше 30 сообщений в секунду от бота в целом
+    GLOBAL_INTERVAL = 1 / 30
+    # Не чаще одного сообщения в секунду в один чат
+    CHAT_INTERVAL = 1.0
+    # Сколько раз повторять отправку после ответа 429 (RetryAfter)
+    MAX_ATTEMPTS = 3
+    # Сколько ждать отправки оставшихся сообщений при остановке бота (секунды)
+    SHUTDOWN_TIMEOUT = 10
+
+    def __init__(self):
+        self.bot = None
+        # У каждого чата своя очередь и свой обработчик: занятый чат не задерживает остальные.
+        # Обработчик создается при первом сообщении в чат и завершается, когда очередь чата пуста
+        self._chat_queues: Dict[Any, Deque[Dict[str, Any]]] = {}
+        self._workers: Dict[Any, asyncio.Task] = {}
+        # Общий для всех чатов лимит: время следующего свободного слота и пауза после RetryAfter
+        self._global_ready_at = 0.0
+        self._paused_until = 0.0
+        self._chat_ready_at: Dict[Any, float] = {}  # chat_id -> время, с которого можно писать в чат
+
+    def set_bot(self, bot) -> None:
+        """Установка бота, через которого отправляются уведомления"""
+        self.bot = bot
+
+    async def put(self, chat_id: Any, text: str, **kwargs) -> None:
+        """Постановка сообщения в очередь чата (параметры - как у bot.send_message)"""
+        self._chat_queues.setdefault(chat_id, deque()).append({"chat_id": chat_id, "text": text, **kwargs})
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._run(chat_id))
+
+    async def _run(self, chat_id: Any) -> None:
+        """Обработчик очереди чата: отправляет сообщения чата по одному"""
+        queue = self._chat_queues[chat_id]
+        try:
+            while queue:
+                message = queue.popleft()
+                try:
+                    await self._send(message)
+                except Exception as e:
+                    logger.error(f"Ошибка отправки уведомления в чат {chat_id}: {e}")
+        finally:
+            # Между проверкой пустой очереди и удалением нет await - новое сообщение не потеряется
+            self._workers.pop(chat_id, None)
+            self._chat_queues.pop(chat_id, None)
+
+    async def _acquire_global_slot(self) -> None:
+        """Ожидание слота общего лимита бота (30 сообщений в секунду на все чаты)"""
+        while True:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            # Слот резервируется сразу, до ожидания, - чаты получают слоты по очереди
+            slot = max(now, self._global_ready_at)
+            self._global_ready_at = slot + self.GLOBAL_INTERVAL
+            if slot > now:
+                await asyncio.sleep(slot - now)
+
+            # Пока ждали слот, Telegram мог ответить 429 другому чату
+            if self._paused_until <= time.monotonic():
+                return
+
+    async def _send(self, message: Dict[str, Any]) -> None:
+        """Отправка сообщения с паузами по лимитам и повтором после RetryAfter"""
+        chat_id = message["chat_id"]
+
+        for attempt in range(self.MAX_ATTEMPTS + 1):
+            delay = self._chat_ready_at.get(chat_id, 0.0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._acquire_global_slot()
+
+            now = time.monotonic()
+            self._chat_ready_at[chat_id] = now + self.CHAT_INTERVAL
+            self._forget_idle_chats(now)
+
+            try:
+                await self.bot.send_message(**message)
+                logger.debug(f"Отправлено уведомление в чат {chat_id}")
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                if attempt >= self.MAX_ATTEMPTS:
+                    raise
+                logger.warning(f"Telegram ограничил отправку, повтор через {retry_after} с")
+                # Ограничение действует на весь бот - приостанавливаем отправку во все чаты
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def _forget_idle_chats(self, now: float) -> None:
+        """Удаление чатов, в которые уже можно писать (словарь не растет бесконечно)"""
+        if len(self._chat_ready_at) > 1000:
+            self._chat_ready_at = {
+                chat_id: ready_at for chat_id, ready_at in self._chat_ready_at.items() if ready_at > now
+            }
+
+    async def close(self) -> None:
+        """Отправка оставшихся сообщений и остановка обработчиков"""
+        if not self._workers:
+            return
+
+        _, pending = await asyncio.wait(list(self._workers.values()), timeout=self.SHUTDOWN_TIMEOUT)
+        if pending:
+            left = sum(len(queue) for queue in self._chat_queues.values()) + len(pending)
+            logger.warning(f"Не отправлено уведомлений при остановке: {left}")
+
+        for worker in pending:
+            worker.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._workers.clear()
+        self._chat_queues.clear()
+
+
+# Создаем глобальный экземпляр очереди
+notification_queue = NotificationQueue()
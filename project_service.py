@@ -2,56 +2,67 @@
 Сервис для работы с проектами (чатами)
 """
 from typing import List, Dict, Any, Optional
-from sqlalchemy.orm import Session
-from sqlalchemy import func, distinct
+from sqlalchemy.orm import Session, aliased, load_only
+from sqlalchemy import func, distinct, case, select, tuple_
 
 from models import Task, TaskStatus
-from database import get_db_session
+from database import session_scope
+from cache_utils import cache
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Строка расширенного описания задачи с названием чата
+CHAT_NAME_MARKER = "• Название:"
+
+# Время жизни закешированного названия чата (секунды), совпадает с интервалом синхронизации
+CHAT_NAME_TTL = 300
+
+# Для названия чата из задачи нужны только эти колонки
+_CHAT_NAME_COLUMNS = load_only(Task.telegram_chat_id, Task.description)
+
 
 class ProjectService:
     """Сервис для управления проектами (чатами) и задачами по проектам"""
     
     def get_user_projects(self, telegram_user_id: str, is_admin: bool = False) -> List[Dict[str, Any]]:
         """Получение списка проектов (чатов) пользователя"""
-        db = get_db_session()
-        try:
-            if is_admin:
-                # Админы видят все проекты
-                projects_query = db.query(
-                    Task.telegram_chat_id,
-                    func.max(Task.created_at).label('last_activity'),
-                    func.count(Task.id).label('total_tasks'),
-                    func.count(Task.id).filter(Task.status == TaskStatus.NEW.value).label('new_tasks'),
-                    func.count(Task.id).filter(Task.status == TaskStatus.IN_PROGRESS.value).label('in_progress_tasks'),
-                    func.count(Task.id).filter(Task.status == TaskStatus.COMPLETED.value).label('completed_tasks')
-                ).group_by(Task.telegram_chat_id)
-            else:
-                # Клиенты видят только свои проекты
-                projects_query = db.query(
-                    Task.telegram_chat_id,
-                    func.max(Task.created_at).label('last_activity'),
-                    func.count(Task.id).label('total_tasks'),
-                    func.count(Task.id).filter(Task.status == TaskStatus.NEW.value).label('new_tasks'),
-                    func.count(Task.id).filter(Task.status == TaskStatus.IN_PROGRESS.value).label('in_progress_tasks'),
-                    func.count(Task.id).filter(Task.status == TaskStatus.COMPLETED.value).label('completed_tasks')
-                ).filter(Task.telegram_user_id == telegram_user_id).group_by(Task.telegram_chat_id)
-            
-            projects_data = projects_query.order_by(func.max(Task.created_at).desc()).all()
+        with session_scope() as db:
+            projects_query = db.query(
+                Task.telegram_chat_id,
+                func.max(Task.created_at).label('last_activity'),
+                func.count(Task.id).label('total_tasks'),
+                func.sum(case((Task.status == TaskStatus.NEW.value, 1), else_=0)).label('new_tasks'),
+                func.sum(case((Task.status == TaskStatus.IN_PROGRESS.value, 1), else_=0)).label('in_progress_tasks'),
+                func.sum(case((Task.status == TaskStatus.COMPLETED.value, 1), else_=0)).label('completed_tasks'),
+                # Первая задача чата - из ее описания берется название чата
+                func.min(Task.id).label('sample_task_id')
+            )
+            
+            if not is_admin:
+                # Клиенты видят только свои проекты (админы видят все)
+                projects_query = projects_query.filter(Task.telegram_user_id == telegram_user_id)
+            
+            projects_data = projects_query.group_by(Task.telegram_chat_id).order_by(func.max(Task.created_at).desc()).all()
+            
+            # Названия чатов берем из кеша, недостающие задачи-образцы загружаем одним запросом
+            chat_names = {
+                project_data.telegram_chat_id: cache.get(f"chat_name:{project_data.telegram_chat_id}")
+                for project_data in projects_data
+            }
+            sample_ids = [
+                project_data.sample_task_id for project_data in projects_data
+                if chat_names[project_data.telegram_chat_id] is None
+            ]
+            if sample_ids:
+                for task in db.query(Task).options(_CHAT_NAME_COLUMNS).filter(Task.id.in_(sample_ids)).all():
+                    chat_names[task.telegram_chat_id] = self._remember_chat_name(task)
             
             projects = []
             for project_data in projects_data:
-                chat_id = project_data.telegram_chat_id
-                
-                # Получаем название чата из последней задачи
-                sample_task = db.query(Task).filter(Task.telegram_chat_id == chat_id).first()
-                
                 project_info = {
-                    "chat_id": chat_id,
-                    "chat_name": self._get_chat_name_from_task(sample_task),
+                    "chat_id": project_data.telegram_chat_id,
+                    "chat_name": chat_names[project_data.telegram_chat_id] or "Неизвестный проект",
                     "last_activity": project_data.last_activity,
                     "total_tasks": project_data.total_tasks,
                     "new_tasks": project_data.new_tasks or 0,
@@ -62,30 +73,45 @@ class ProjectService:
                 projects.append(project_info)
             
             return projects
-            
-        finally:
-            db.close()
     
     def get_project_tasks(self, telegram_chat_id: str, telegram_user_id: str, 
-                         is_admin: bool = False, page: int = 0, per_page: int = 5) -> Dict[str, Any]:
-        """Получение задач проекта с пагинацией"""
-        db = get_db_session()
-        try:
-            if is_admin:
-                # Админы видят все задачи проекта
-                query = db.query(Task).filter(Task.telegram_chat_id == telegram_chat_id)
+                         is_admin: bool = False, page: int = 0, per_page: int = 5,
+                         after_id: Optional[int] = None) -> Dict[str, Any]:
+        """Получение задач проекта с пагинацией.
+        
+        after_id - ID последней задачи предыдущей страницы (next_cursor): страница
+        читается по ключу (created_at, id) без OFFSET. Без него используется OFFSET по page.
+        """
+        with session_scope() as db:
+            # Количество считается оконной функцией в том же запросе, что и страница
+            query = db.query(Task, func.count().over().label('total')).filter(
+                Task.telegram_chat_id == telegram_chat_id
+            )
+            if not is_admin:
+                # Клиенты видят только свои задачи в проекте (админы - все задачи проекта)
+                query = query.filter(Task.telegram_user_id == telegram_user_id)
+            
+            if after_id is not None:
+                # Задачи, идущие после курсора в порядке (created_at, id) по убыванию
+                cursor_task = aliased(Task)
+                cursor = select(cursor_task.created_at, cursor_task.id).where(cursor_task.id == after_id)
+                page_query = query.filter(tuple_(Task.created_at, Task.id) < cursor.scalar_subquery())
+                offset, skipped = 0, page * per_page
             else:
-                # Клиенты видят только свои задачи в проекте
-                query = db.query(Task).filter(
-                    Task.telegram_chat_id == telegram_chat_id,
-                    Task.telegram_user_id == telegram_user_id
-                )
-            
-            # Подсчитываем общее количество
-            total_tasks = query.count()
-            
-            # Получаем задачи для текущей страницы
-            tasks = query.order_by(Task.created_at.desc()).offset(page * per_page).limit(per_page).all()
+                page_query = query
+                offset, skipped = page * per_page, 0
+            
+            rows = page_query.order_by(Task.created_at.desc(), Task.id.desc()).offset(offset).limit(per_page).all()
+            tasks = [row.Task for row in rows]
+            
+            if rows:
+                # С курсором окно видит только задачи после него - добавляем предыдущие страницы
+                total_tasks = rows[0].total + skipped
+            elif page > 0:
+                # Страница за пределами списка - количество нужно посчитать отдельно
+                total_tasks = query.with_entities(func.count(Task.id)).scalar()
+            else:
+                total_tasks = 0
             
             # Получаем информацию о чате
             chat_name = self._get_chat_name_from_task(tasks[0]) if tasks else "Неизвестный проект"
@@ -99,11 +125,9 @@ class ProjectService:
                 "total_tasks": total_tasks,
                 "total_pages": (total_tasks + per_page - 1) // per_page,
                 "has_next": (page + 1) * per_page < total_tasks,
-                "has_prev": page > 0
+                "has_prev": page > 0,
+                "next_cursor": tasks[-1].id if tasks else None
             }
-            
-        finally:
-            db.close()
     
     def _get_chat_name_from_task(self, task: Optional[Task]) -> str:
         """Извлечение названия чата из описания задачи"""
@@ -111,11 +135,13 @@ class ProjectService:
             return "Неизвестный проект"
         
         try:
-            # Ищем название чата в расширенном описании
-            lines = task.description.split('\n')
-            for line in lines:
-                if "• Название:" in line:
-                    return line.split("• Название:")[-1].strip()
+            # Ищем название чата в расширенном описании (строка "• Название: ...")
+            description = task.description
+            start = description.find(CHAT_NAME_MARKER)
+            if start >= 0:
+                end = description.find('\n', start)
+                line = description[start:end] if end >= 0 else description[start:]
+                return line.rpartition(CHAT_NAME_MARKER)[2].strip()
             
             # Если не найдено, возвращаем ID чата
             return f"Проект {task.telegram_chat_id[-4:]}"
@@ -123,57 +149,52 @@ class ProjectService:
         except Exception:
             return f"Проект {task.telegram_chat_id[-4:] if task.telegram_chat_id else 'Unknown'}"
     
+    def _remember_chat_name(self, task: Optional[Task]) -> str:
+        """Название чата из задачи с сохранением в кеш"""
+        chat_name = self._get_chat_name_from_task(task)
+        if task:
+            cache.set(f"chat_name:{task.telegram_chat_id}", chat_name, CHAT_NAME_TTL)
+        return chat_name
+    
     def _get_chat_name_from_task_by_chat_id(self, chat_id: str) -> str:
-        """Получение названия чата по ID чата"""
-        db = get_db_session()
-        try:
+        """Получение названия чата по ID чата (кешируется на CHAT_NAME_TTL секунд)"""
+        chat_name = cache.get(f"chat_name:{chat_id}")
+        if chat_name is not None:
+            return chat_name
+        
+        with session_scope() as db:
             # Находим любую задачу из этого чата
-            task = db.query(Task).filter(Task.telegram_chat_id == chat_id).first()
-            return self._get_chat_name_from_task(task)
-        finally:
-            db.close()
+            task = db.query(Task).options(_CHAT_NAME_COLUMNS).filter(Task.telegram_chat_id == chat_id).first()
+            return self._remember_chat_name(task)
     
     def get_project_statistics(self, telegram_chat_id: str) -> Dict[str, Any]:
         """Получение статистики по проекту"""
-        db = get_db_session()
-        try:
-            # Общее количество задач в проекте
-            total_tasks = db.query(Task).filter(Task.telegram_chat_id == telegram_chat_id).count()
+        with session_scope() as db:
+            # Все агрегаты проекта одним запросом
+            stats = db.query(
+                func.count(Task.id),
+                func.count(distinct(Task.telegram_user_id)),
+                func.max(Task.created_at),
+                *(func.sum(case((Task.status == status.value, 1), else_=0)) for status in TaskStatus)
+            ).filter(Task.telegram_chat_id == telegram_chat_id).one()
+            
+            total_tasks, unique_users, last_activity = stats[0], stats[1], stats[2]
             
             if total_tasks == 0:
                 return {"chat_id": telegram_chat_id, "total_tasks": 0}
             
             # Статистика по статусам
-            status_stats = {}
-            for status in TaskStatus:
-                count = db.query(Task).filter(
-                    Task.telegram_chat_id == telegram_chat_id,
-                    Task.status == status.value
-                ).count()
-                status_stats[status.value] = count
-            
-            # Уникальные пользователи в проекте
-            unique_users = db.query(distinct(Task.telegram_user_id)).filter(
-                Task.telegram_chat_id == telegram_chat_id
-            ).count()
-            
-            # Последняя активность
-            last_task = db.query(Task).filter(
-                Task.telegram_chat_id == telegram_chat_id
-            ).order_by(Task.created_at.desc()).first()
-            
-            return {
-                "chat_id": telegram_chat_id,
-                "chat_name": self._get_chat_name_from_task(last_task),
-                "total_tasks": total_tasks,
-                "status_stats": status_stats,
-                "unique_users": unique_users,
-                "last_activity": last_task.created_at if last_task else None,
-                "completion_rate": round((status_stats.get("completed", 0) / total_tasks) * 100, 2)
-            }
-            
-        finally:
-            db.close()
+            status_stats = {status.value: count or 0 for status, count in zip(TaskStatus, stats[3:])}
+        
+        return {
+            "chat_id": telegram_chat_id,
+            "chat_name": self._get_chat_name_from_task_by_chat_id(telegram_chat_id),
+            "total_tasks": total_tasks,
+            "status_stats": status_stats,
+            "unique_users": unique_users,
+            "last_activity": last_activity,
+            "completion_rate": round((status_stats.get("completed", 0) / total_tasks) * 100, 2)
+        }
 
 
 # Создаем глобальный экземпляр сервиса
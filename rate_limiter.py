@@ -0,0 +1,58 @@
+"""
+Ограничение частоты запросов к внешним API
+"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Ограничитель частоты "ведро токенов": в среднем не больше rate запросов в секунду,
+    после простоя допускается всплеск до capacity запросов подряд.
+
+    Если сервер все равно ответил отказом по лимиту, throttle() приостанавливает
+    запросы и вдвое снижает частоту; успешные запросы постепенно возвращают ее к rate.
+    """
+
+    def __init__(self, rate: float, capacity: int, min_rate: float = 0.1):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self._current_rate = rate
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        """Начисление токенов за время с последнего обращения"""
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self._current_rate)
+        self._updated_at = now
+
+    async def acquire(self) -> None:
+        """Ожидание свободного токена (запросы обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                delay = self._paused_until - now
+                if delay <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self._current_rate
+
+                await asyncio.sleep(delay)
+
+    def throttle(self, pause: float) -> None:
+        """Сервер отклонил запрос по лимиту: пауза для всех запросов и снижение частоты"""
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens = 0.0
+        self._paused_until = max(self._paused_until, now + pause)
+        self._current_rate = max(self.min_rate, self._current_rate / 2)
+
+    def recover(self) -> None:
+        """Успешный запрос: частота плавно возвращается к исходной"""
+        if self._current_rate < self.rate:
+            self._current_rate = min(self.rate, self._current_rate + self.rate / self.capacity)
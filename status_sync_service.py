@@ -2,250 +2,492 @@
 Сервис синхронизации статусов задач с Битрикс24 (без webhook)
 """
 import asyncio
+import html
 import logging
-from typing import List, Dict, Any
+import random
+from collections import defaultdict
+from typing import List, Dict, Any, NamedTuple, Optional
 from datetime import datetime, timedelta
 
+from sqlalchemy import or_
+
 from models import Task, TaskStatus
 from database import get_db_session
 from bitrix24_api import bitrix24_api
 from task_service import TaskService
+from sync_scheduler import sync_scheduler
+from notification_queue import notification_queue
 
 logger = logging.getLogger(__name__)
 
+# Маппинг статусов Битрикс24 на наши статусы
+BITRIX_STATUS_MAP = {
+    "1": TaskStatus.NEW,          # Новая
+    "2": TaskStatus.NEW,          # Ждет выполнения
+    "3": TaskStatus.IN_PROGRESS,  # Выполняется
+    "4": TaskStatus.CANCELLED,    # Отложена
+    "5": TaskStatus.COMPLETED,    # Завершена
+    "6": TaskStatus.COMPLETED,    # Закрыта
+    "7": TaskStatus.CANCELLED,    # Отклонена
+}
+
+# Названия статусов в уведомлениях
+STATUS_NAMES = {
+    "new": "🆕 Новая",
+    "in_progress": "⏳ В работе",
+    "completed": "✅ Завершена",
+    "cancelled": "❌ Отменена"
+}
+
+# Шаблоны уведомлений (HTML; название задачи экранируется перед подстановкой)
+SYNC_NOTIFICATION = (
+    "🔄 <b>Статус задачи обновлен из Битрикс24</b>\n\n"
+    "📝 <b>Задача #{id}:</b> {title}\n"
+    "📊 <b>Статус изменен:</b> {old_status} → {new_status}\n"
+    "🔗 <b>Bitrix24 ID:</b> {bitrix_id}\n"
+    "⏰ <b>Время синхронизации:</b> {time}\n\n"
+    "Изменение было внесено в Битрикс24 и автоматически синхронизировано с ботом."
+)
+
+CHAT_SYNC_NOTIFICATION = (
+    "{icon} <b>Задача {action}!</b>\n\n"
+    "📝 <b>Задача #{id}:</b> {title}\n"
+    "📊 <b>Статус изменен:</b> {old_status} → {new_status}\n"
+    "🔗 <b>Bitrix24 ID:</b> {bitrix_id}\n"
+    "⏰ <b>Обновлено:</b> {time}{details}\n\n"
+    "🔄 <i>Изменение было внесено в Битрикс24 и автоматически синхронизировано.</i>"
+)
+
+# Иконка, действие и пояснение для уведомления в чат по новому статусу
+CHAT_STATUS_TEXT = {
+    "completed": ("🎉", "завершена в Битрикс24", "\n🏆 <b>Задача выполнена! Отличная работа команды.</b>"),
+    "in_progress": ("🚀", "взята в работу в Битрикс24", "\n⚡ <b>Задача в процессе выполнения.</b>"),
+    "cancelled": ("❌", "отменена в Битрикс24", "\n💭 <b>Задача отменена или не актуальна.</b>"),
+}
+DEFAULT_CHAT_STATUS_TEXT = ("🔄", "обновлена в Битрикс24", "")
+
+DELETION_NOTIFICATION = (
+    "🗑️ <b>Задача удалена из Битрикс24</b>\n\n"
+    "📝 <b>Задача #{id}:</b> {title}\n"
+    "❌ <b>Статус:</b> Отменена (удалена в системе)\n"
+    "🔗 <b>Bitrix24 ID:</b> {bitrix_id}\n"
+    "⏰ <b>Обновлено:</b> {time}\n\n"
+    "💭 <b>Задача была удалена из Битрикс24 и автоматически отменена в боте.</b>"
+)
+
+SUMMARY_HEADER = "🔄 <b>Обновлены статусы задач из Битрикс24: {count}</b>\n\n"
+SUMMARY_LINE = "• #{id} {title}: {transition}\n"
+SUMMARY_FOOTER = "\n⏰ <b>Обновлено:</b> {time}"
+
+# Формат времени в уведомлениях
+TIME_FORMAT = "%d.%m.%Y %H:%M"
+
+# Максимальная длина сводного сообщения (лимит Telegram - 4096 символов)
+SUMMARY_MESSAGE_LIMIT = 4000
+
+# Имя задачи периодической синхронизации в JobQueue
+SYNC_JOB_NAME = "status_sync"
+
+
+class StatusChange(NamedTuple):
+    """Изменение статуса задачи при синхронизации"""
+    task: Task
+    old_status: str
+    new_status: TaskStatus
+    deleted: bool  # Задача удалена в Битрикс24
+
 
 class StatusSyncService:
     """Сервис для синхронизации статусов задач с Битрикс24"""
     
+    # Интервал синхронизации (секунды): базовый и максимальный для периодов без изменений
+    SYNC_INTERVAL = 300
+    MAX_SYNC_INTERVAL = 1800
+    IDLE_BACKOFF = 1.3
+    
+    # На сколько секунд задача закрепляется за экземпляром бота, который взял ее в опрос:
+    # другие экземпляры ее пропускают, а если опрос сорвался - она вернется в очередь
+    CLAIM_LEASE = 300
+    
+    # Сколько секунд копятся изменения перед отправкой уведомлений: изменения из нескольких
+    # синхронизаций подряд уходят в чат одной сводкой
+    NOTIFY_DEBOUNCE = 0.5
+    
     def __init__(self):
         self.task_service = TaskService()
         self.telegram_app = None
+        self.sync_interval = self.SYNC_INTERVAL
+        self._pending_changes: Dict[int, StatusChange] = {}  # task_id -> изменение
+        self._flush_task: Optional[asyncio.Task] = None
     
     def set_telegram_app(self, app):
         """Установка экземпляра Telegram приложения"""
         self.telegram_app = app
+        notification_queue.set_bot(app.bot)
     
-    async def sync_all_active_tasks(self):
-        """Синхронизация всех активных задач с Битрикс24"""
+    async def sync_all_active_tasks(self, due_only: bool = False) -> int:
+        """Синхронизация активных задач с Битрикс24.
+        
+        due_only - только задачи, которым по расписанию (sync_scheduler) пора опроса.
+        Возвращает количество задач с изменившимся статусом
+        """
+        changes: List[StatusChange] = []
         try:
-            # Получаем все задачи с Bitrix24 ID, которые не завершены
-            db = get_db_session()
-            try:
-                active_tasks = db.query(Task).filter(
-                    Task.bitrix24_task_id.isnot(None),
-                    Task.status.in_([TaskStatus.NEW.value, TaskStatus.IN_PROGRESS.value])
-                ).all()
-                
-                logger.info(f"Синхронизируем {len(active_tasks)} активных задач")
+            await asyncio.to_thread(sync_scheduler.refresh)
+            
+            # Задачи читаются и опрашиваются пачками по BATCH_SIZE (один вызов batch на пачку,
+            # частоту вызовов ограничивает bitrix24_api): в памяти только одна пачка,
+            # а соединение с БД не удерживается на время запросов к Битрикс24
+            now = datetime.utcnow()
+            synced_count = 0
+            last_id = 0
+            while True:
+                tasks = await asyncio.to_thread(
+                    self._load_active_tasks, last_id, bitrix24_api.BATCH_SIZE, now if due_only else None
+                )
+                if not tasks:
+                    break
                 
-                for task in active_tasks:
-                    await self.sync_single_task(task)
-                    # Небольшая пауза между запросами
-                    await asyncio.sleep(0.5)
-                    
-            finally:
-                db.close()
+                changes.extend(await self.sync_tasks_batch(tasks))
+                synced_count += len(tasks)
+                last_id = tasks[-1].id
+            
+            logger.info(f"Синхронизировано {synced_count} активных задач")
                 
         except Exception as e:
             logger.error(f"Ошибка при синхронизации задач: {e}")
+        
+        # Уведомления по всему проходу сразу: несколько изменений в одном чате - одно сообщение
+        await self.notify_changes(changes)
+        return len(changes)
     
-    async def sync_single_task(self, task: Task):
-        """Синхронизация одной задачи с Битрикс24"""
+    def _load_active_tasks(self, after_id: int, limit: int, due_at: Optional[datetime] = None) -> List[Task]:
+        """Очередная пачка незавершенных задач с Bitrix24 ID (по возрастанию id, после after_id).
+        
+        due_at - только задачи, опрос которых запланирован не позже этого момента. Такие задачи
+        забираются в опрос: next_poll_at сдвигается на CLAIM_LEASE в той же транзакции, поэтому
+        несколько экземпляров бота не опрашивают одни и те же задачи. В PostgreSQL строки
+        выбираются с FOR UPDATE SKIP LOCKED - параллельный экземпляр берет следующие задачи,
+        а не ждет. SQLite блокирует базу на запись целиком, там достаточно самого сдвига
+        """
+        db = get_db_session()
+        try:
+            query = db.query(Task).filter(
+                Task.bitrix24_task_id.isnot(None),
+                Task.status.in_([TaskStatus.NEW.value, TaskStatus.IN_PROGRESS.value]),
+                Task.id > after_id
+            )
+            if due_at is None:
+                return query.order_by(Task.id).limit(limit).all()
+            
+            query = query.filter(or_(Task.next_poll_at.is_(None), Task.next_poll_at <= due_at))
+            if db.bind.dialect.name == "postgresql":
+                query = query.with_for_update(skip_locked=True)
+            tasks = query.order_by(Task.id).limit(limit).all()
+            
+            if tasks:
+                db.query(Task).filter(Task.id.in_([task.id for task in tasks])).update(
+                    {Task.next_poll_at: datetime.utcnow() + timedelta(seconds=self.CLAIM_LEASE)},
+                    synchronize_session=False
+                )
+            db.commit()
+            return tasks
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    
+    async def sync_tasks_batch(self, tasks: List[Task]) -> List[StatusChange]:
+        """Синхронизация пачки задач одним запросом к Битрикс24 (без уведомлений).
+        Возвращает изменения статусов"""
         try:
-            # Получаем актуальную информацию о задаче из Битрикс24
-            bitrix_task = bitrix24_api.get_task(task.bitrix24_task_id)
+            bitrix_tasks = await bitrix24_api.get_tasks_batch(
+                [task.bitrix24_task_id for task in tasks],
+                select=["ID", "STATUS"]
+            )
+        except Exception as e:
+            logger.error(f"Ошибка получения пачки задач из Битрикс24: {e}")
+            return []
+        
+        # Задачи с ошибкой получения пропускаем до следующей синхронизации
+        changes = []
+        for task in tasks:
+            if task.bitrix24_task_id not in bitrix_tasks:
+                continue
             
+            bitrix_task = bitrix_tasks[task.bitrix24_task_id]
             if not bitrix_task:
                 logger.warning(f"Задача {task.bitrix24_task_id} не найдена в Битрикс24 - возможно удалена")
-                # Помечаем задачу как удаленную и уведомляем чат
-                await self.handle_deleted_task(task)
-                return
-            
-            # Получаем статус из Битрикс24
-            bitrix_status = bitrix_task.get("status")
-            
-            # Маппинг статусов Битрикс24 на наши статусы
-            status_map = {
-                "1": TaskStatus.NEW,        # Новая
-                "2": TaskStatus.NEW,        # Ждет выполнения  
-                "3": TaskStatus.IN_PROGRESS, # Выполняется
-                "4": TaskStatus.CANCELLED,   # Отложена
-                "5": TaskStatus.COMPLETED,   # Завершена
-                "6": TaskStatus.COMPLETED,   # Закрыта
-                "7": TaskStatus.CANCELLED,   # Отклонена
-            }
-            
-            mapped_status = status_map.get(bitrix_status)
+                changes.append(StatusChange(task, task.status, TaskStatus.CANCELLED, True))
+                continue
+            
+            mapped_status = BITRIX_STATUS_MAP.get(bitrix_task.get("status"))
             if not mapped_status:
-                logger.warning(f"Неизвестный статус Битрикс24: {bitrix_status}")
-                return
+                logger.warning(f"Неизвестный статус Битрикс24: {bitrix_task.get('status')}")
+            elif task.status != mapped_status.value:
+                changes.append(StatusChange(task, task.status, mapped_status, False))
+        
+        if changes:
+            # Все изменения статусов - одним UPDATE
+            try:
+                await asyncio.to_thread(
+                    self.task_service.bulk_update_statuses, {task.id: status for task, _, status, _ in changes}
+                )
+            except Exception as e:
+                logger.error(f"Ошибка сохранения статусов задач: {e}")
+                return []
             
-            # Проверяем, изменился ли статус
-            if task.status != mapped_status.value:
-                old_status = task.status
-                
-                # Обновляем статус в нашей БД
-                self.task_service.update_task_status(task.id, mapped_status)
-                
-                logger.info(f"Синхронизирован статус задачи #{task.id}: {old_status} → {mapped_status.value}")
-                
-                # Отправляем уведомление пользователю
-                await self.send_sync_notification(task, old_status, mapped_status.value)
-                
-                # Отправляем уведомление в исходный чат
-                await self.send_chat_sync_notification(task, old_status, mapped_status.value)
-                
+            for task, old_status, status, deleted in changes:
+                task.status = status.value
+                if deleted:
+                    logger.info(f"Задача #{task.id} помечена как отмененная (удалена в Битрикс24)")
+                else:
+                    logger.info(f"Синхронизирован статус задачи #{task.id}: {old_status} → {status.value}")
+        
+        # Планируем следующий опрос оставшихся активными задач
+        try:
+            await asyncio.to_thread(sync_scheduler.save_plan, sync_scheduler.plan(tasks, datetime.utcnow()))
         except Exception as e:
-            logger.error(f"Ошибка синхронизации задачи #{task.id}: {e}")
+            logger.error(f"Ошибка сохранения расписания опроса задач: {e}")
+        
+        return changes
     
-    async def send_sync_notification(self, task: Task, old_status: str, new_status: str):
+    async def sync_single_task(self, task: Task) -> bool:
+        """Синхронизация одной задачи с Битрикс24"""
+        changes = await self.sync_tasks_batch([task])
+        await self.notify_changes(changes)
+        return bool(changes)
+    
+    async def notify_changes(self, changes: List[StatusChange]):
+        """Постановка изменений статусов в отправку уведомлений. Изменения копятся
+        NOTIFY_DEBOUNCE секунд и отправляются вместе; несколько изменений одной задачи
+        сворачиваются в одно (исходный статус -> последний)"""
+        for change in changes:
+            previous = self._pending_changes.get(change.task.id)
+            if previous is not None:
+                change = change._replace(old_status=previous.old_status)
+            self._pending_changes[change.task.id] = change
+        
+        if self._pending_changes and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_after_debounce())
+    
+    async def _flush_after_debounce(self):
+        """Отправка накопленных уведомлений после паузы NOTIFY_DEBOUNCE. Изменения,
+        пришедшие во время отправки, отправляются следующим кругом того же обработчика"""
+        while self._pending_changes:
+            await asyncio.sleep(self.NOTIFY_DEBOUNCE)
+            changes = [
+                change for change in self._pending_changes.values()
+                # Статус вернулся к исходному - сообщать не о чем
+                if change.deleted or change.new_status.value != change.old_status
+            ]
+            self._pending_changes = {}
+            
+            try:
+                await self._send_notifications(changes)
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомлений об изменениях статусов: {e}")
+    
+    async def flush_notifications(self):
+        """Ожидание отправки накопленных уведомлений (при остановке бота)"""
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+    
+    async def _send_notifications(self, changes: List[StatusChange]):
+        """Уведомления об изменениях статусов: если у пользователя или в чате изменилась
+        одна задача - подробное сообщение, если несколько - одна общая сводка.
+        Сообщения ставятся в очередь и отправляются в фоне с соблюдением лимитов Telegram"""
+        by_user: Dict[str, List[StatusChange]] = defaultdict(list)
+        by_chat: Dict[str, List[StatusChange]] = defaultdict(list)
+        for change in changes:
+            # Об удалении задачи сообщаем только в исходный чат
+            if not change.deleted:
+                by_user[change.task.telegram_user_id].append(change)
+            by_chat[change.task.telegram_chat_id].append(change)
+        
+        # Время в уведомлениях одно на весь проход - форматируем один раз
+        synced_at = datetime.now().strftime(TIME_FORMAT)
+        
+        for user_id, user_changes in by_user.items():
+            if len(user_changes) == 1:
+                change = user_changes[0]
+                await self.send_sync_notification(change.task, change.old_status, change.new_status.value, synced_at)
+            else:
+                await self.send_summary_notification(user_id, user_changes, synced_at)
+        
+        for chat_id, chat_changes in by_chat.items():
+            if len(chat_changes) == 1:
+                change = chat_changes[0]
+                if change.deleted:
+                    await self.send_deletion_notification_to_chat(change.task, synced_at)
+                else:
+                    await self.send_chat_sync_notification(change.task, change.old_status, change.new_status.value, synced_at)
+            else:
+                await self.send_summary_notification(chat_id, chat_changes, synced_at)
+    
+    async def send_summary_notification(self, chat_id: str, changes: List[StatusChange], synced_at: Optional[str] = None):
+        """Одно сообщение со списком изменений статусов (делится на части по лимиту длины Telegram)"""
+        if not self.telegram_app:
+            logger.warning("Telegram приложение не установлено для отправки уведомлений")
+            return
+        
+        if synced_at is None:
+            synced_at = datetime.now().strftime(TIME_FORMAT)
+        
+        header = SUMMARY_HEADER.format(count=len(changes))
+        footer = SUMMARY_FOOTER.format(time=synced_at)
+        
+        lines = []
+        for change in changes:
+            task = change.task
+            if change.deleted:
+                transition = "🗑️ удалена в Битрикс24"
+            else:
+                transition = (f"{STATUS_NAMES.get(change.old_status, change.old_status)} → "
+                              f"{STATUS_NAMES.get(change.new_status.value, change.new_status.value)}")
+            lines.append(SUMMARY_LINE.format(id=task.id, title=html.escape(task.title[:60]), transition=transition))
+        
+        messages = []
+        current = header
+        for line in lines:
+            if len(current) + len(line) + len(footer) > SUMMARY_MESSAGE_LIMIT:
+                messages.append(current)
+                current = ""
+            current += line
+        messages.append(current + footer)
+        
+        try:
+            for text in messages:
+                await notification_queue.put(chat_id=int(chat_id), text=text, parse_mode="HTML")
+            logger.info(f"Сводка по {len(changes)} задачам поставлена в очередь для чата {chat_id}")
+            
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки изменений статусов: {e}")
+    
+    async def send_sync_notification(self, task: Task, old_status: str, new_status: str, synced_at: Optional[str] = None):
         """Отправка уведомления о синхронизации статуса"""
         if not self.telegram_app:
             logger.warning("Telegram приложение не установлено для отправки уведомлений")
             return
         
-        status_names = {
-            "new": "🆕 Новая",
-            "in_progress": "⏳ В работе",
-            "completed": "✅ Завершена",
-            "cancelled": "❌ Отменена"
-        }
+        if synced_at is None:
+            synced_at = datetime.now().strftime(TIME_FORMAT)
         
-        message = f"""
-🔄 **Статус задачи обновлен из Битрикс24**
-
-📝 **Задача #{task.id}:** {task.title}
-📊 **Статус изменен:** {status_names.get(old_status, old_status)} → {status_names.get(new_status, new_status)}
-🔗 **Bitrix24 ID:** {task.bitrix24_task_id}
-⏰ **Время синхронизации:** {datetime.now().strftime('%d.%m.%Y %H:%M')}
-
-Изменение было внесено в Битрикс24 и автоматически синхронизировано с ботом.
-        """
+        message = SYNC_NOTIFICATION.format(
+            id=task.id,
+            title=html.escape(task.title),
+            old_status=STATUS_NAMES.get(old_status, old_status),
+            new_status=STATUS_NAMES.get(new_status, new_status),
+            bitrix_id=task.bitrix24_task_id,
+            time=synced_at
+        )
         
         try:
-            await self.telegram_app.bot.send_message(
+            await notification_queue.put(
                 chat_id=int(task.telegram_user_id),
                 text=message,
-                parse_mode="Markdown"
+                parse_mode="HTML"
             )
-            logger.info(f"Отправлено уведомление о синхронизации пользователю {task.telegram_user_id}")
+            logger.info(f"Уведомление о синхронизации поставлено в очередь для пользователя {task.telegram_user_id}")
             
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления о синхронизации: {e}")
     
-    async def send_chat_sync_notification(self, task: Task, old_status: str, new_status: str):
+    async def send_chat_sync_notification(self, task: Task, old_status: str, new_status: str, synced_at: Optional[str] = None):
         """Отправка уведомления в исходный чат об изменении статуса из Битрикс24"""
         if not self.telegram_app:
             logger.warning("Telegram приложение не установлено для отправки уведомлений в чат")
             return
         
-        status_names = {
-            "new": "🆕 Новая",
-            "in_progress": "⏳ В работе",
-            "completed": "✅ Завершена",
-            "cancelled": "❌ Отменена"
-        }
-        
-        # Определяем иконку и текст в зависимости от статуса
-        if new_status == "completed":
-            icon = "🎉"
-            action_text = "завершена в Битрикс24"
-            additional_info = "\n🏆 **Задача выполнена! Отличная работа команды.**"
-        elif new_status == "in_progress":
-            icon = "🚀"
-            action_text = "взята в работу в Битрикс24"
-            additional_info = "\n⚡ **Задача в процессе выполнения.**"
-        elif new_status == "cancelled":
-            icon = "❌"
-            action_text = "отменена в Битрикс24"
-            additional_info = "\n💭 **Задача отменена или не актуальна.**"
-        else:
-            icon = "🔄"
-            action_text = "обновлена в Битрикс24"
-            additional_info = ""
-        
-        message = f"""
-{icon} **Задача {action_text}!**
-
-📝 **Задача #{task.id}:** {task.title[:100]}
-📊 **Статус изменен:** {status_names.get(old_status, old_status)} → {status_names.get(new_status, new_status)}
-🔗 **Bitrix24 ID:** {task.bitrix24_task_id}
-⏰ **Обновлено:** {datetime.now().strftime('%d.%m.%Y %H:%M')}{additional_info}
-
-🔄 *Изменение было внесено в Битрикс24 и автоматически синхронизировано.*
-        """
+        if synced_at is None:
+            synced_at = datetime.now().strftime(TIME_FORMAT)
+        
+        icon, action, details = CHAT_STATUS_TEXT.get(new_status, DEFAULT_CHAT_STATUS_TEXT)
+        message = CHAT_SYNC_NOTIFICATION.format(
+            icon=icon,
+            action=action,
+            id=task.id,
+            title=html.escape(task.title[:100]),
+            old_status=STATUS_NAMES.get(old_status, old_status),
+            new_status=STATUS_NAMES.get(new_status, new_status),
+            bitrix_id=task.bitrix24_task_id,
+            time=synced_at,
+            details=details
+        )
         
         try:
-            await self.telegram_app.bot.send_message(
+            await notification_queue.put(
                 chat_id=int(task.telegram_chat_id),
                 text=message,
-                parse_mode="Markdown",
+                parse_mode="HTML",
                 reply_to_message_id=task.telegram_message_id
             )
-            logger.info(f"Отправлено уведомление о синхронизации в чат {task.telegram_chat_id}")
+            logger.info(f"Уведомление о синхронизации поставлено в очередь для чата {task.telegram_chat_id}")
             
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления синхронизации в чат: {e}")
     
-    async def start_periodic_sync(self, interval_minutes: int = 5):
-        """Запуск периодической синхронизации"""
-        logger.info(f"Запуск периодической синхронизации каждые {interval_minutes} минут")
+    async def sync_job(self, context):
+        """Задача JobQueue: опрос задач, которым пора по расписанию, и планирование следующего прохода.
         
-        while True:
-            try:
-                await self.sync_all_active_tasks()
-                await asyncio.sleep(interval_minutes * 60)  # Конвертируем минуты в секунды
-                
-            except Exception as e:
-                logger.error(f"Ошибка в периодической синхронизации: {e}")
-                await asyncio.sleep(60)  # Пауза 1 минута при ошибке
-    
-    async def handle_deleted_task(self, task: Task):
-        """Обработка удаленной задачи из Битрикс24"""
+        Пока статусы не меняются, интервал растет в IDLE_BACKOFF раз до MAX_SYNC_INTERVAL;
+        первое же изменение возвращает базовый SYNC_INTERVAL. Если чей-то опрос
+        по расписанию наступает раньше, проход запускается к этому моменту
+        """
+        # Следующий проход планируется в любом случае: без него опрос остановится до перезапуска
+        delay = self.sync_interval
+        changed = 0
         try:
-            # Помечаем задачу как удаленную в нашей БД
-            db = get_db_session()
+            changed = await self.sync_all_active_tasks(due_only=True)
+            
+            if changed:
+                self.sync_interval = self.SYNC_INTERVAL
+            else:
+                self.sync_interval = min(self.sync_interval * self.IDLE_BACKOFF, self.MAX_SYNC_INTERVAL)
+            
+            # Разброс ±10%, чтобы запросы нескольких экземпляров бота не совпадали по времени
+            delay = self.sync_interval * random.uniform(0.9, 1.1)
+            
+            # Не пропускаем запланированный опрос задачи, если он наступает раньше
             try:
-                task.status = TaskStatus.CANCELLED.value
-                db.commit()
-                
-                logger.info(f"Задача #{task.id} помечена как отмененная (удалена в Битрикс24)")
-                
-                # Отправляем уведомление в исходный чат
-                await self.send_deletion_notification_to_chat(task)
-                
-            finally:
-                db.close()
-                
+                next_poll = await asyncio.to_thread(sync_scheduler.seconds_until_next_poll)
+            except Exception as e:
+                logger.error(f"Ошибка получения расписания опроса задач: {e}")
+                next_poll = None
+            if next_poll is not None:
+                delay = max(min(delay, next_poll), sync_scheduler.MIN_POLL_GAP)
         except Exception as e:
-            logger.error(f"Ошибка при обработке удаленной задачи: {e}")
+            logger.error(f"Ошибка прохода синхронизации: {e}")
+        finally:
+            context.job_queue.run_once(self.sync_job, when=delay, name=SYNC_JOB_NAME)
+            logger.debug(f"Следующая синхронизация через {delay:.0f} с (изменено задач: {changed})")
     
-    async def send_deletion_notification_to_chat(self, task: Task):
+    async def send_deletion_notification_to_chat(self, task: Task, synced_at: Optional[str] = None):
         """Отправка уведомления об удалении задачи в исходный чат"""
         if not self.telegram_app:
             logger.warning("Telegram приложение не установлено для отправки уведомлений")
             return
         
+        if synced_at is None:
+            synced_at = datetime.now().strftime(TIME_FORMAT)
+        
         try:
-            notification_message = f"""
-🗑️ **Задача удалена из Битрикс24**
-
-📝 **Задача #{task.id}:** {task.title[:100]}
-❌ **Статус:** Отменена (удалена в системе)
-🔗 **Bitrix24 ID:** {task.bitrix24_task_id}
-⏰ **Обновлено:** {datetime.now().strftime('%d.%m.%Y %H:%M')}
-
-💭 **Задача была удалена из Битрикс24 и автоматически отменена в боте.**
-            """
+            notification_message = DELETION_NOTIFICATION.format(
+                id=task.id,
+                title=html.escape(task.title[:100]),
+                bitrix_id=task.bitrix24_task_id,
+                time=synced_at
+            )
             
-            await self.telegram_app.bot.send_message(
+            await notification_queue.put(
                 chat_id=int(task.telegram_chat_id),
                 text=notification_message,
-                parse_mode="Markdown",
+                parse_mode="HTML",
                 reply_to_message_id=task.telegram_message_id
             )
             
-            logger.info(f"Отправлено уведомление об удалении задачи #{task.id} в чат {task.telegram_chat_id}")
+            logger.info(f"Уведомление об удалении задачи #{task.id} поставлено в очередь для чата {task.telegram_chat_id}")
             
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления об удалении в чат: {e}")
@@ -0,0 +1,155 @@
+"""
+Планирование опроса задач в Битрикс24 по истории их жизненного цикла
+"""
+import bisect
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+
+from models import Task, TaskStatus
+from database import session_scope
+
+logger = logging.getLogger(__name__)
+
+# Статусы, в которых задача больше не опрашивается
+CLOSED_STATUSES = (TaskStatus.COMPLETED.value, TaskStatus.CANCELLED.value)
+
+# Ключ расписания для задач без типа и для общего расписания по всем типам
+DEFAULT_SCHEDULE_KEY = "*"
+
+
+class SyncScheduler:
+    """Расписание опроса задач: моменты опроса выбираются по распределению
+    времени жизни уже закрытых задач того же типа.
+
+    Моменты опроса - квантили этого распределения: между соседними опросами
+    закрывается одинаковая доля задач, поэтому опросы чаще там, где задачи
+    закрываются чаще всего. После последнего квантиля задача опрашивается
+    не реже чем раз в MAX_POLL_GAP секунд.
+    """
+
+    # Сколько опросов приходится на типичное время жизни задачи
+    POLLS_PER_LIFETIME = 8
+    # Минимальное количество закрытых задач для построения расписания
+    MIN_SAMPLES = 20
+    # Сколько последних закрытых задач учитывается
+    HISTORY_LIMIT = 2000
+    # Границы интервала между опросами (секунды)
+    MIN_POLL_GAP = 60
+    MAX_POLL_GAP = 3600
+    # Как часто пересчитывается расписание (секунды)
+    REFRESH_INTERVAL = 6 * 3600
+
+    def __init__(self):
+        # task_type -> смещения моментов опроса от создания задачи (секунды, по возрастанию)
+        self._schedules: Dict[str, List[float]] = {}
+        self._refreshed_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> None:
+        """Пересчет расписаний по истории закрытых задач (не чаще REFRESH_INTERVAL)"""
+        with self._lock:
+            if not force and self._refreshed_at is not None \
+                    and time.monotonic() - self._refreshed_at < self.REFRESH_INTERVAL:
+                return
+            self._refreshed_at = time.monotonic()
+
+        with session_scope() as db:
+            rows = db.query(Task.task_type, Task.created_at, Task.updated_at).filter(
+                Task.status.in_(CLOSED_STATUSES),
+                Task.bitrix24_task_id.isnot(None)
+            ).order_by(Task.id.desc()).limit(self.HISTORY_LIMIT).all()
+
+        lifetimes: Dict[str, List[float]] = {DEFAULT_SCHEDULE_KEY: []}
+        for task_type, created_at, updated_at in rows:
+            if not created_at or not updated_at:
+                continue
+            seconds = (updated_at - created_at).total_seconds()
+            if seconds <= 0:
+                continue
+            lifetimes.setdefault(task_type or DEFAULT_SCHEDULE_KEY, []).append(seconds)
+            if task_type:
+                lifetimes[DEFAULT_SCHEDULE_KEY].append(seconds)
+
+        schedules = {
+            key: self._build_schedule(values)
+            for key, values in lifetimes.items()
+            if len(values) >= self.MIN_SAMPLES
+        }
+
+        with self._lock:
+            self._schedules = schedules
+
+        logger.info(f"Расписание опроса задач пересчитано по {len(rows)} закрытым задачам "
+                    f"(типов с расписанием: {len(schedules)})")
+
+    def _build_schedule(self, lifetimes: List[float]) -> List[float]:
+        """Моменты опроса - квантили времени жизни с шагом не меньше MIN_POLL_GAP"""
+        lifetimes = sorted(lifetimes)
+        count = len(lifetimes)
+
+        schedule: List[float] = []
+        for k in range(1, self.POLLS_PER_LIFETIME + 1):
+            offset = lifetimes[min(count - 1, k * count // (self.POLLS_PER_LIFETIME + 1))]
+            previous = schedule[-1] if schedule else 0
+            if offset - previous >= self.MIN_POLL_GAP:
+                schedule.append(offset)
+
+        return schedule
+
+    def next_poll_at(self, task_type: Optional[str], created_at: datetime, now: datetime) -> Optional[datetime]:
+        """Следующий момент опроса задачи; None - расписания нет, задача опрашивается при каждой синхронизации"""
+        schedule = self._schedules.get(task_type or DEFAULT_SCHEDULE_KEY) \
+            or self._schedules.get(DEFAULT_SCHEDULE_KEY)
+        if not schedule or not created_at:
+            return None
+
+        age = (now - created_at).total_seconds()
+        index = bisect.bisect_right(schedule, age)
+        if index < len(schedule):
+            gap = schedule[index] - age
+        else:
+            # Задача живет дольше обычного - опрашиваем редко, но регулярно
+            gap = self.MAX_POLL_GAP
+
+        gap = min(max(gap, self.MIN_POLL_GAP), self.MAX_POLL_GAP)
+        return now + timedelta(seconds=gap)
+
+    def plan(self, tasks: List[Task], now: datetime) -> List[Tuple[int, Optional[datetime]]]:
+        """Следующие моменты опроса для задач, которые остались активными после синхронизации"""
+        return [
+            (task.id, self.next_poll_at(task.task_type, task.created_at, now))
+            for task in tasks
+            if task.status not in CLOSED_STATUSES
+        ]
+
+    def save_plan(self, plan: List[Tuple[int, Optional[datetime]]]) -> None:
+        """Сохранение моментов опроса одним пакетным UPDATE"""
+        if not plan:
+            return
+
+        with session_scope() as db:
+            db.bulk_update_mappings(Task, [
+                {"id": task_id, "next_poll_at": poll_at} for task_id, poll_at in plan
+            ])
+            db.commit()
+
+    def seconds_until_next_poll(self) -> Optional[float]:
+        """Через сколько секунд наступит ближайший запланированный опрос (None - запланированных нет)"""
+        with session_scope() as db:
+            next_poll_at = db.query(func.min(Task.next_poll_at)).filter(
+                Task.bitrix24_task_id.isnot(None),
+                Task.status.notin_(CLOSED_STATUSES)
+            ).scalar()
+
+        if next_poll_at is None:
+            return None
+        return max(0.0, (next_poll_at - datetime.utcnow()).total_seconds())
+
+
+# Создаем глобальный экземпляр планировщика
+sync_scheduler = SyncScheduler()
@@ -1,178 +1,253 @@
 """
 Сервис для работы с задачами
 """
-from typing import List, Optional
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import and_, func, case, update
 
 from models import Task, TaskCreateRequest, TaskUpdateRequest, TaskType, TaskStatus
-from database import get_db_session
+from database import session_scope
+from cache_utils import TTLCache
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Кеш задач по ID: task_id -> Task (отсоединенный от сессии объект)
+_task_cache = TTLCache(maxsize=10_000, ttl=300)
+
 
 class TaskService:
-    """Сервис для управления задачами"""
+    """Сервис для управления задачами.
+
+    Методы принимают необязательную сессию db: без нее операция выполняется
+    в собственной сессии и сразу фиксируется, с ней - в переданной сессии,
+    а фиксацию выполняет вызывающий код (см. unit_of_work).
+    """
+    
+    @contextmanager
+    def unit_of_work(self) -> Iterator[Session]:
+        """Одна сессия и одна транзакция на несколько операций: изменения фиксируются при выходе из блока"""
+        with session_scope() as db:
+            yield db
+            db.commit()
+    
+    @contextmanager
+    def _session(self, db: Optional[Session]) -> Iterator[Session]:
+        """Переданная сессия (изменения только отправляются в БД) или собственная с фиксацией"""
+        if db is not None:
+            yield db
+            db.flush()
+        else:
+            with self.unit_of_work() as db:
+                yield db
     
-    def create_task(self, task_request: TaskCreateRequest) -> Task:
+    def create_task(self, task_request: TaskCreateRequest, db: Optional[Session] = None) -> Task:
         """Создание новой задачи"""
-        db = get_db_session()
         try:
-            task = Task(
-                title=task_request.title,
-                description=task_request.description,
-                telegram_message_id=task_request.telegram_message_id,
-                telegram_chat_id=task_request.telegram_chat_id,
-                telegram_user_id=task_request.telegram_user_id,
-                task_type=task_request.task_type.value if task_request.task_type else None,
-                status=TaskStatus.NEW.value
-            )
-            
-            db.add(task)
-            db.commit()
-            db.refresh(task)
+            with self._session(db) as session:
+                task = Task(
+                    title=task_request.title,
+                    description=task_request.description,
+                    telegram_message_id=task_request.telegram_message_id,
+                    telegram_chat_id=task_request.telegram_chat_id,
+                    telegram_user_id=task_request.telegram_user_id,
+                    task_type=task_request.task_type.value if task_request.task_type else None,
+                    status=TaskStatus.NEW.value
+                )
+                session.add(task)
             
             logger.info(f"Создана задача #{task.id}")
             return task
             
         except Exception as e:
-            db.rollback()
             logger.error(f"Ошибка при создании задачи: {e}")
             raise
-        finally:
-            db.close()
     
-    def get_task(self, task_id: int) -> Optional[Task]:
-        """Получение задачи по ID"""
-        db = get_db_session()
-        try:
-            task = db.query(Task).filter(Task.id == task_id).first()
+    def get_task(self, task_id: int, db: Optional[Session] = None) -> Optional[Task]:
+        """Получение задачи по ID (кешируется на 5 минут; в переданной сессии - без кеша)"""
+        if db is not None:
+            return db.get(Task, task_id)
+        
+        task = _task_cache.get(task_id)
+        if task is not None:
             return task
-        finally:
-            db.close()
+        
+        with session_scope() as session:
+            task = session.get(Task, task_id)
+        
+        if task is not None:
+            _task_cache.set(task_id, task)
+        return task
     
-    def update_task_type(self, task_id: int, task_type: TaskType) -> Optional[Task]:
+    def update_task_type(self, task_id: int, task_type: TaskType, db: Optional[Session] = None) -> Optional[Task]:
         """Обновление типа задачи"""
-        db = get_db_session()
         try:
-            task = db.query(Task).filter(Task.id == task_id).first()
+            with self._session(db) as session:
+                task = session.get(Task, task_id)
+                if task:
+                    task.task_type = task_type.value
+                    task.is_type_confirmed = True
+            
             if task:
-                task.task_type = task_type.value
-                task.is_type_confirmed = True
-                db.commit()
-                db.refresh(task)
+                _task_cache.pop(task_id)
                 logger.info(f"Обновлен тип задачи #{task_id} на {task_type.value}")
             return task
         except Exception as e:
-            db.rollback()
             logger.error(f"Ошибка при обновлении типа задачи: {e}")
             raise
-        finally:
-            db.close()
     
-    def update_task_status(self, task_id: int, status: TaskStatus) -> Optional[Task]:
-        """Обновление статуса задачи"""
-        db = get_db_session()
+    def update_task_status(self, task_id: int, status: TaskStatus, db: Optional[Session] = None) -> Optional[Task]:
+        """Обновление статуса задачи (без изменений, если статус уже такой)"""
         try:
-            task = db.query(Task).filter(Task.id == task_id).first()
-            if task:
-                task.status = status.value
-                db.commit()
-                db.refresh(task)
+            changed = False
+            with self._session(db) as session:
+                task = session.get(Task, task_id)
+                if task and task.status != status.value:
+                    task.status = status.value
+                    changed = True
+            
+            if changed:
+                _task_cache.pop(task_id)
                 logger.info(f"Обновлен статус задачи #{task_id} на {status.value}")
             return task
         except Exception as e:
-            db.rollback()
             logger.error(f"Ошибка при обновлении статуса задачи: {e}")
             raise
-        finally:
-            db.close()
     
-    def update_bitrix_task_id(self, task_id: int, bitrix_task_id: int) -> Optional[Task]:
+    def bulk_update_statuses(self, statuses: Dict[int, TaskStatus], db: Optional[Session] = None) -> int:
+        """Обновление статусов нескольких задач одним UPDATE ... CASE id.
+        Возвращает количество обновленных задач"""
+        if not statuses:
+            return 0
+        
+        try:
+            with self._session(db) as session:
+                result = session.execute(
+                    update(Task).where(Task.id.in_(list(statuses))).values(
+                        status=case({task_id: status.value for task_id, status in statuses.items()}, value=Task.id)
+                    ),
+                    execution_options={"synchronize_session": False}
+                )
+            
+            for task_id in statuses:
+                _task_cache.pop(task_id)
+            
+            logger.info(f"Обновлены статусы задач: {len(statuses)}")
+            return result.rowcount
+        except Exception as e:
+            logger.error(f"Ошибка при массовом обновлении статусов задач: {e}")
+            raise
+    
+    def update_bitrix_task_id(self, task_id: int, bitrix_task_id: int,
+                              db: Optional[Session] = None) -> Optional[Task]:
         """Обновление ID задачи в Bitrix24"""
-        db = get_db_session()
         try:
-            task = db.query(Task).filter(Task.id == task_id).first()
+            with self._session(db) as session:
+                task = session.get(Task, task_id)
+                if task:
+                    task.bitrix24_task_id = bitrix_task_id
+            
             if task:
-                task.bitrix24_task_id = bitrix_task_id
-                db.commit()
-                db.refresh(task)
+                _task_cache.pop(task_id)
                 logger.info(f"Обновлен Bitrix24 ID для задачи #{task_id}: {bitrix_task_id}")
             return task
         except Exception as e:
-            db.rollback()
             logger.error(f"Ошибка при обновлении Bitrix24 ID: {e}")
             raise
-        finally:
-            db.close()
     
-    def get_user_tasks(self, telegram_user_id: str, 
-                      status_filter: Optional[List[TaskStatus]] = None) -> List[Task]:
-        """Получение задач пользователя"""
-        db = get_db_session()
+    def link_bitrix_task(self, task_id: int, bitrix_task_id: Optional[int],
+                         task_type: Optional[TaskType] = None, db: Optional[Session] = None) -> bool:
+        """Сохранение ID задачи в Bitrix24 и подтвержденного типа одним UPDATE
+        (None - соответствующее поле не меняется). Возвращает True, если задача найдена"""
+        values = {}
+        if bitrix_task_id is not None:
+            values[Task.bitrix24_task_id] = bitrix_task_id
+        if task_type is not None:
+            values[Task.task_type] = task_type.value
+            values[Task.is_type_confirmed] = True
+        if not values:
+            return False
+        
         try:
-            query = db.query(Task).filter(Task.telegram_user_id == telegram_user_id)
+            with self._session(db) as session:
+                result = session.execute(
+                    update(Task).where(Task.id == task_id).values(values),
+                    execution_options={"synchronize_session": False}
+                )
             
-            if status_filter:
-                status_values = [status.value for status in status_filter]
-                query = query.filter(Task.status.in_(status_values))
-            else:
-                # По умолчанию показываем только активные задачи
-                query = query.filter(Task.status.in_([
-                    TaskStatus.NEW.value,
-                    TaskStatus.IN_PROGRESS.value
-                ]))
+            _task_cache.pop(task_id)
+            logger.info(f"Обновлена задача #{task_id}: Bitrix24 ID {bitrix_task_id}, "
+                        f"тип {task_type.value if task_type else '-'}")
+            return result.rowcount > 0
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении связи задачи с Bitrix24: {e}")
+            raise
+    
+    def get_user_tasks(self, telegram_user_id: str, 
+                      status_filter: Optional[List[TaskStatus]] = None,
+                      db: Optional[Session] = None) -> List[Task]:
+        """Получение задач пользователя"""
+        with self._session(db) as session:
+            query = self._user_tasks_query(session.query(Task), telegram_user_id, status_filter)
+            return query.order_by(Task.created_at.desc()).all()
+    
+    def get_user_tasks_page(self, telegram_user_id: str, limit: int, offset: int = 0,
+                            status_filter: Optional[List[TaskStatus]] = None,
+                            db: Optional[Session] = None) -> Tuple[List[Task], int]:
+        """Страница задач пользователя и общее количество задач (LIMIT/OFFSET в БД;
+        количество считается оконной функцией в том же запросе)"""
+        with self._session(db) as session:
+            query = self._user_tasks_query(
+                session.query(Task, func.count().over().label('total')), telegram_user_id, status_filter
+            )
+            rows = query.order_by(Task.created_at.desc(), Task.id.desc()).offset(offset).limit(limit).all()
             
-            tasks = query.order_by(Task.created_at.desc()).all()
-            return tasks
-        finally:
-            db.close()
+            if rows:
+                return [row.Task for row in rows], rows[0].total
+            if offset:
+                # Страница за пределами списка - количество нужно посчитать отдельно
+                return [], query.with_entities(func.count(Task.id)).scalar()
+            return [], 0
+    
+    def _user_tasks_query(self, query, telegram_user_id: str, status_filter: Optional[List[TaskStatus]]):
+        """Фильтр задач пользователя по статусам (по умолчанию - только активные задачи)"""
+        if status_filter:
+            status_values = [status.value for status in status_filter]
+        else:
+            status_values = [TaskStatus.NEW.value, TaskStatus.IN_PROGRESS.value]
+        return query.filter(Task.telegram_user_id == telegram_user_id, Task.status.in_(status_values))
     
-    def get_tasks_by_chat(self, telegram_chat_id: str) -> List[Task]:
+    def get_tasks_by_chat(self, telegram_chat_id: str, db: Optional[Session] = None) -> List[Task]:
         """Получение задач из определенного чата"""
-        db = get_db_session()
-        try:
-            tasks = db.query(Task).filter(
+        with self._session(db) as session:
+            return session.query(Task).filter(
                 Task.telegram_chat_id == telegram_chat_id
             ).order_by(Task.created_at.desc()).all()
-            return tasks
-        finally:
-            db.close()
     
-    def get_all_tasks(self, limit: int = 100, offset: int = 0) -> List[Task]:
+    def get_all_tasks(self, limit: int = 100, offset: int = 0, db: Optional[Session] = None) -> List[Task]:
         """Получение всех задач с пагинацией"""
-        db = get_db_session()
-        try:
-            tasks = db.query(Task).order_by(
+        with self._session(db) as session:
+            return session.query(Task).order_by(
                 Task.created_at.desc()
             ).offset(offset).limit(limit).all()
-            return tasks
-        finally:
-            db.close()
     
-    def get_tasks_stats(self) -> dict:
+    def get_tasks_stats(self, db: Optional[Session] = None) -> dict:
         """Получение статистики по задачам"""
-        db = get_db_session()
-        try:
-            stats = {}
-            
-            # Статистика по статусам
-            for status in TaskStatus:
-                count = db.query(Task).filter(Task.status == status.value).count()
-                stats[f"status_{status.value}"] = count
-            
-            # Статистика по типам
-            for task_type in TaskType:
-                count = db.query(Task).filter(Task.task_type == task_type.value).count()
-                stats[f"type_{task_type.value}"] = count
-            
-            # Общее количество задач
-            stats["total_tasks"] = db.query(Task).count()
+        with self._session(db) as session:
+            # Все счетчики одним запросом
+            keys = [f"status_{status.value}" for status in TaskStatus] \
+                + [f"type_{task_type.value}" for task_type in TaskType] \
+                + ["confirmed_type"]
+            counts = session.query(
+                func.count(Task.id),
+                *(func.sum(case((Task.status == status.value, 1), else_=0)) for status in TaskStatus),
+                *(func.sum(case((Task.task_type == task_type.value, 1), else_=0)) for task_type in TaskType),
+                func.sum(case((Task.is_type_confirmed == True, 1), else_=0))
+            ).one()
             
-            # Задачи с подтвержденным типом
-            stats["confirmed_type"] = db.query(Task).filter(Task.is_type_confirmed == True).count()
+            # SUM по пустой таблице возвращает NULL
+            stats = {key: count or 0 for key, count in zip(keys, counts[1:])}
+            stats["total_tasks"] = counts[0]
             
             return stats
-        finally:
-            db.close()
@@ -1,9 +1,11 @@
 """
 Сервис для синхронизации Telegram ID с Bitrix24 пользователями по полю tgID
 """
-from typing import Optional, Dict, Any, List
+import time
+from typing import Optional, Dict, Any, List, Tuple
 import logging
 from bitrix24_api import bitrix24_api
+from cache_utils import MISSING, TTLCache, cache, single_flight
 from employee_service import employee_service
 
 logger = logging.getLogger(__name__)
@@ -12,27 +14,44 @@ logger = logging.getLogger(__name__)
 class TelegramBitrixSyncService:
     """Сервис для автоматического связывания Telegram пользователей с Bitrix24"""
     
+    # Время жизни кеша связей (секунды), как у справочника пользователей в bitrix24_api
+    CACHE_TTL = 300
+    
     def __init__(self):
         self._cached_users: Dict[str, int] = {}  # telegram_id -> bitrix_id
         self._cache_loaded = False
+        self._loaded_at = 0.0
+        # telegram_id -> (bitrix_id, имя) или None, если пользователь не сотрудник
+        self._resolved_users = TTLCache(maxsize=4096, ttl=self.CACHE_TTL)
+    
+    async def _ensure_cache(self) -> None:
+        """Загрузка кеша, если он не загружен или устарел"""
+        if not self._cache_loaded or time.monotonic() - self._loaded_at > self.CACHE_TTL:
+            await self.load_cache()
     
-    def load_cache(self) -> None:
-        """Загрузка кеша пользователей с заполненным tgID из Bitrix24"""
+    @single_flight(key="tgsync:load")
+    async def load_cache(self) -> None:
+        """Загрузка кеша пользователей с заполненным tgID из Bitrix24.
+        Одновременные вызовы объединяются в одну загрузку"""
         try:
             logger.info("Загружаем кеш пользователей с Telegram ID из Bitrix24...")
             
-            users_with_tg = bitrix24_api.get_users_with_telegram_ids()
-            self._cached_users.clear()
+            users_with_tg = await bitrix24_api.get_users_with_telegram_ids()
             
+            # Новый словарь подменяет старый целиком - читатели не видят частично заполненный кеш
+            cached_users: Dict[str, int] = {}
             for user in users_with_tg:
                 telegram_id = user.get("TELEGRAM_ID")
                 bitrix_id = int(user.get("ID", 0))
                 
                 if telegram_id and bitrix_id:
-                    self._cached_users[str(telegram_id)] = bitrix_id
+                    cached_users[str(telegram_id)] = bitrix_id
                     logger.debug(f"Кеширован: Telegram {telegram_id} -> Bitrix {bitrix_id}")
             
+            self._cached_users = cached_users
+            self._resolved_users.clear()
             self._cache_loaded = True
+            self._loaded_at = time.monotonic()
             logger.info(f"Загружено {len(self._cached_users)} пользователей с Telegram ID в кеш")
             
         except Exception as e:
@@ -40,17 +59,18 @@ class TelegramBitrixSyncService:
             self._cached_users.clear()
             self._cache_loaded = False
     
-    def refresh_cache(self) -> None:
+    async def refresh_cache(self) -> None:
         """Принудительное обновление кеша"""
         self._cache_loaded = False
-        self.load_cache()
+        cache.delete_match("bx:users:*")
+        cache.pop("bx:tgindex")
+        await self.load_cache()
     
-    def get_bitrix_user_id(self, telegram_id: str) -> Optional[int]:
+    async def get_bitrix_user_id(self, telegram_id: str) -> Optional[int]:
         """Получение Bitrix24 ID пользователя по Telegram ID"""
         try:
-            # Загружаем кеш если не загружен
-            if not self._cache_loaded:
-                self.load_cache()
+            # Загружаем кеш если не загружен или устарел
+            await self._ensure_cache()
             
             # Проверяем кеш
             if telegram_id in self._cached_users:
@@ -60,7 +80,7 @@ class TelegramBitrixSyncService:
             
             # Если не найдено в кеше, проверяем API Bitrix24 напрямую
             logger.debug(f"Поиск в Bitrix24 API для Telegram ID: {telegram_id}")
-            bitrix_id = bitrix24_api.find_bitrix_user_by_telegram(telegram_id)
+            bitrix_id = await bitrix24_api.find_bitrix_user_by_telegram(telegram_id)
             
             if bitrix_id:
                 # Добавляем в кеш
@@ -75,19 +95,37 @@ class TelegramBitrixSyncService:
             logger.error(f"Ошибка получения Bitrix ID для Telegram {telegram_id}: {e}")
             return None
     
-    def is_employee(self, telegram_id: str) -> bool:
+    async def resolve_user(self, telegram_id: str) -> Optional[Tuple[int, str]]:
+        """Bitrix24 ID и имя сотрудника по Telegram ID одним вызовом (кешируется);
+        None - пользователь не связан с Bitrix24"""
+        resolved = self._resolved_users.get(telegram_id, MISSING)
+        if resolved is not MISSING:
+            return resolved
+        
+        resolved = None
+        bitrix_id = await self.get_bitrix_user_id(telegram_id)
+        if bitrix_id:
+            user = await bitrix24_api.get_user_by_id(bitrix_id)
+            name = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip() if user else ""
+            resolved = (bitrix_id, name or f"ID: {bitrix_id}")
+        
+        self._resolved_users.set(telegram_id, resolved)
+        return resolved
+    
+    async def is_employee(self, telegram_id: str) -> bool:
         """Проверка, является ли пользователь сотрудником (есть ли он в Bitrix24 с tgID)"""
-        return self.get_bitrix_user_id(telegram_id) is not None
+        return await self.get_bitrix_user_id(telegram_id) is not None
     
-    def add_telegram_link(self, bitrix_user_id: int, telegram_id: str) -> bool:
+    async def add_telegram_link(self, bitrix_user_id: int, telegram_id: str) -> bool:
         """Добавление связи Telegram ID с пользователем Bitrix24"""
         try:
             # Обновляем поле tgID в Bitrix24
-            success = bitrix24_api.update_user_telegram_id(bitrix_user_id, telegram_id)
+            success = await bitrix24_api.update_user_telegram_id(bitrix_user_id, telegram_id)
             
             if success:
                 # Обновляем кеш
                 self._cached_users[telegram_id] = bitrix_user_id
+                self._resolved_users.pop(telegram_id)
                 
                 # Также обновляем глобальный профиль в локальной БД
                 employee_service.update_global_user_profile(telegram_id, bitrix_user_id)
@@ -102,21 +140,22 @@ class TelegramBitrixSyncService:
             logger.error(f"Ошибка связывания Telegram {telegram_id} с Bitrix {bitrix_user_id}: {e}")
             return False
     
-    def remove_telegram_link(self, telegram_id: str) -> bool:
+    async def remove_telegram_link(self, telegram_id: str) -> bool:
         """Удаление связи Telegram ID с Bitrix24"""
         try:
-            bitrix_id = self.get_bitrix_user_id(telegram_id)
+            bitrix_id = await self.get_bitrix_user_id(telegram_id)
             if not bitrix_id:
                 logger.warning(f"Связь для Telegram {telegram_id} не найдена")
                 return False
             
             # Очищаем поле в Bitrix24
-            success = bitrix24_api.update_user_telegram_id(bitrix_id, "")
+            success = await bitrix24_api.update_user_telegram_id(bitrix_id, "")
             
             if success:
                 # Удаляем из кеша
                 if telegram_id in self._cached_users:
                     del self._cached_users[telegram_id]
+                self._resolved_users.pop(telegram_id)
                 
                 logger.info(f"Удалена связь Telegram {telegram_id} с Bitrix {bitrix_id}")
                 return True
@@ -128,22 +167,19 @@ class TelegramBitrixSyncService:
             logger.error(f"Ошибка удаления связи для Telegram {telegram_id}: {e}")
             return False
     
-    def get_all_linked_users(self) -> Dict[str, int]:
+    async def get_all_linked_users(self) -> Dict[str, int]:
         """Получение всех связанных пользователей"""
-        if not self._cache_loaded:
-            self.load_cache()
+        await self._ensure_cache()
         return self._cached_users.copy()
     
-    def get_user_info(self, telegram_id: str) -> Optional[Dict[str, Any]]:
+    async def get_user_info(self, telegram_id: str) -> Optional[Dict[str, Any]]:
         """Получение полной информации о пользователе из Bitrix24 по Telegram ID"""
         try:
-            bitrix_id = self.get_bitrix_user_id(telegram_id)
+            bitrix_id = await self.get_bitrix_user_id(telegram_id)
             if not bitrix_id:
                 return None
             
-            # Получаем всех пользователей и ищем нужного
-            all_users = bitrix24_api.get_users()
-            user_info = next((u for u in all_users if u.get("ID") == str(bitrix_id)), None)
+            user_info = await bitrix24_api.get_user_by_id(bitrix_id)
             
             if user_info:
                 # Нормализуем информацию
@@ -163,11 +199,10 @@ class TelegramBitrixSyncService:
             logger.error(f"Ошибка получения информации о пользователе {telegram_id}: {e}")
             return None
     
-    def sync_with_local_database(self) -> int:
+    async def sync_with_local_database(self) -> int:
         """Синхронизация с локальной базой данных - обновление BotUser записей"""
         try:
-            if not self._cache_loaded:
-                self.load_cache()
+            await self._ensure_cache()
             
             synced_count = 0
             
@@ -186,14 +221,18 @@ class TelegramBitrixSyncService:
             logger.error(f"Ошибка синхронизации с локальной БД: {e}")
             return 0
     
-    def get_unlinked_bitrix_users(self) -> List[Dict[str, Any]]:
+    async def get_unlinked_bitrix_users(self) -> List[Dict[str, Any]]:
         """Получение пользователей Bitrix24 без заполненного tgID"""
         try:
-            all_users = bitrix24_api.get_users()
-            users_with_tg = bitrix24_api.get_users_with_telegram_ids()
+            await self._ensure_cache()
+            if not self._cache_loaded:
+                # Без списка связанных пользователей все оказались бы "несвязанными"
+                return []
+            
+            all_users = await bitrix24_api.get_users()
             
-            # Получаем ID пользователей с заполненным tgID
-            linked_ids = set(user.get("ID") for user in users_with_tg)
+            # ID пользователей с заполненным tgID берем из уже загруженного кеша
+            linked_ids = {str(bitrix_id) for bitrix_id in self._cached_users.values()}
             
             # Фильтруем пользователей без tgID
             unlinked_users = []
@@ -1,28 +1,33 @@
 """
 Основной модуль Telegram бота для интеграции с Битрикс24
 """
+import asyncio
 import json
 import logging
-from typing import Optional, Dict, Any
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, File
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, AsyncIterator
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, MessageEntity, File
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
 from telegram.constants import ParseMode
 import os
-import requests
 from datetime import datetime
 
 from config import settings
 from models import Task, TaskType, TaskStatus, TaskCreateRequest, UserSession
-from database import get_db_session
-from bitrix24_api import bitrix24_api
+from bitrix24_api import bitrix24_api, TECH_ACCOUNT_ID
 from task_service import TaskService
 from status_sync_service import status_sync_service
+from notification_queue import notification_queue
 from user_management_service import user_management
 from auth_decorators import admin_only, client_or_admin, log_user_action
-from models import UserRole
+from models import UserRole, PENDING_TELEGRAM_ID_PREFIX
 from project_service import project_service
 from employee_service import employee_service
 from telegram_bitrix_sync_service import telegram_bitrix_sync
@@ -34,36 +39,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Названия типов задач в уведомлениях
+TYPE_NAMES = {
+    TaskType.BUG: "🐛 Баг",
+    TaskType.REQUIREMENT: "📋 Требование",
+    TaskType.CONSULTATION: "💬 Консультация"
+}
 
-class SupportBot:
-    """Основной класс Telegram бота поддержки"""
-    
-    # ID Елены Зубатенко - координатор проектов (всегда соисполнитель)
-    ELENA_ZUBATENKO_ID = 809
-    
-    def __init__(self):
-        self.task_service = TaskService()
+# Названия статусов задач в уведомлениях
+STATUS_NAMES = {
+    TaskStatus.NEW: "🆕 Новая",
+    TaskStatus.IN_PROGRESS: "⏳ В работе",
+    TaskStatus.COMPLETED: "✅ Завершена",
+    TaskStatus.CANCELLED: "❌ Отменена"
+}
 
-        self.bot_username = None
-    
-    @client_or_admin
-    @log_user_action("start")
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик команды /start"""
-        user_id = str(update.effective_user.id)
-        telegram_user = update.effective_user
-        
-        # Получаем роль пользователя
-        user_role = user_management.get_user_role(user_id)
-        is_admin = user_role == UserRole.ADMIN
-        
-        welcome_message = f"""
+# Значки статусов и типов в списках задач. TaskStatus и TaskType - str-перечисления,
+# поэтому искать можно прямо по строке из БД, без создания члена перечисления
+STATUS_EMOJI = {
+    TaskStatus.NEW: "🆕",
+    TaskStatus.IN_PROGRESS: "⏳",
+    TaskStatus.COMPLETED: "✅",
+    TaskStatus.CANCELLED: "❌"
+}
+
+TYPE_EMOJI = {
+    TaskType.BUG: "🐛",
+    TaskType.REQUIREMENT: "📋",
+    TaskType.CONSULTATION: "💬"
+}
+
+
+# Экранирование спецсимволов Markdown в пользовательском тексте (один проход str.translate)
+MARKDOWN_ESCAPE = str.maketrans({"_": "\\_", "*": "\\*", "[": "\\[", "]": "\\]"})
+
+
+def shorten(text: str, limit: int) -> str:
+    """Текст не длиннее limit символов (обрезанный помечается "...")"""
+    return text if len(text) <= limit else text[:limit] + "..."
+
+
+# Приветствие /start
+WELCOME_TEMPLATE = """
 🤖 **Бот поддержки клиентов**
 
-Привет, {telegram_user.first_name}! Ваш Telegram ID: `{user_id}`
+Привет, {first_name}! Ваш Telegram ID: `{user_id}`
 
 🎯 **Как использовать:**
-1\\. Упомяните меня в чате с клиентом \\(@{self.bot_username or "supportbot"}\\) после описания проблемы
+1\\. Упомяните меня в чате с клиентом \\(@{bot_username}\\) после описания проблемы
 2\\. Задача автоматически создается в Битрикс24
 3\\. Отслеживайте статус через команды
 
@@ -73,9 +96,9 @@ class SupportBot:
 • `/tasks` \\- Мои задачи по проектам
 • `/my_role` \\- Информация о роли
         """
-        
-        if is_admin:
-            welcome_message += """
+
+# Дополнение приветствия для администраторов
+WELCOME_ADMIN_APPENDIX = """
 
 👑 **Команды администратора:**
 • `/users` \\- Список пользователей
@@ -91,25 +114,18 @@ class SupportBot:
 • `/sync_bitrix` \\- Синхронизация кеша с Битрикс24
 • `/daily_report` \\- Ежедневный отчет
             """
-        
-        welcome_message += """
+
+# Окончание приветствия: типы задач
+WELCOME_TASK_TYPES = """
 
 🎯 **Типы задач:**
 🐛 Баг \\- Ошибка в работе системы
 📋 Требование \\- Новая функциональность  
 💬 Консультация \\- Вопрос или консультация
         """
-        
-        await update.message.reply_text(
-            welcome_message,
-            parse_mode=ParseMode.MARKDOWN
-        )
-    
-    @client_or_admin
-    @log_user_action("help")
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Обработчик команды /help"""
-        help_message = """
+
+# Справка /help
+HELP_TEMPLATE = """
 📖 **Помощь по использованию бота**
 
 **Создание задачи:**
@@ -135,7 +151,161 @@ class SupportBot:
 **Примеры:**
 • `/task_status 123 in_progress` - Перевести задачу в работу
 • `/task_status 123 completed` - Завершить задачу
-        """.format(bot_username=self.bot_username or "supportbot")
+        """
+
+# Запрос уточнения типа задачи
+CLARIFICATION_TEMPLATE = """
+🔍 **Уточнение типа задачи #{task_id}**
+
+**Описание:** {description}...
+
+Пожалуйста, выберите тип задачи:
+
+🐛 **Баг** - Ошибка в работе системы
+📋 **Требование** - Новая функциональность  
+💬 **Консультация** - Вопрос или консультация
+        """
+
+# Единое уведомление о создании задачи по упоминанию
+TASK_CREATED_TEMPLATE = """
+🎯 **Задача создана и отправлена в Битрикс24!**
+
+📝 **Задача #{task_id}:** {title}
+👤 **Создатель:** {creator}
+🏷️ **Тип:** 📋 Требование (по умолчанию)
+👨‍💼 **Исполнитель:** {executor_text}
+👥 **Соисполнитель:** Елена Зубатенко (координатор проектов)
+🔗 **Bitrix24 ID:** {bitrix_task_id}
+⏰ **Время:** {time}
+
+✅ **Задача готова к выполнению!**
+            """
+
+# callback_data выбора проекта: "project_<chat_id>_<страница>[_<ID последней задачи>]"
+# и "all_my_tasks_<страница>"
+PROJECT_CALLBACK_RE = re.compile(r"project_(?P<chat_id>[^_]+)_(?P<page>\d+)(?:_(?P<after_id>\d+))?$")
+ALL_TASKS_CALLBACK_RE = re.compile(r"all_my_tasks_(?P<page>\d+)$")
+
+# callback_data управления сотрудниками: "<действие>_<аргументы через _>"
+EMPLOYEE_CALLBACK_RE = re.compile(r"(add_emp_project|emp_page|manage_emp|add_bitrix_user|remove_emp)_(.+)")
+
+# Список проектов в /tasks: заголовок и блок на каждый проект
+PROJECTS_HEADER_TEMPLATE = """
+📂 **Выберите проект** ({role_text})
+
+У вас есть задачи в {count} проектах:
+
+"""
+
+PROJECT_ENTRY_TEMPLATE = """
+📁 **{chat_name}**
+📊 Задач: {total_tasks} (🆕{new_tasks} ⏳{in_progress_tasks} ✅{completed_tasks})
+📅 Последняя: {last_activity:%d.%m.%Y}
+
+"""
+
+# Формат времени в сообщениях бота (с точностью до минуты)
+TIME_FORMAT = '%d.%m.%Y %H:%M'
+
+
+@lru_cache(maxsize=1)
+def _format_minute(minute: int) -> str:
+    return datetime.fromtimestamp(minute * 60).strftime(TIME_FORMAT)
+
+
+def current_time_text() -> str:
+    """Текущее время для сообщений: строка меняется раз в минуту, поэтому форматируется один раз"""
+    return _format_minute(int(time.time() // 60))
+
+
+# Кнопки выбора типа задачи: строки клавиатуры из (текст, шаблон callback_data)
+TYPE_SELECTION_ROWS = tuple(
+    tuple((text, f"type_{{task_id}}_{task_type.value}") for text, task_type in row)
+    for row in (
+        (("🐛 Баг", TaskType.BUG), ("📋 Требование", TaskType.REQUIREMENT)),
+        (("💬 Консультация", TaskType.CONSULTATION),),
+    )
+)
+
+
+def type_selection_keyboard(task_id: int) -> InlineKeyboardMarkup:
+    """Клавиатура выбора типа задачи (от задачи зависит только callback_data)"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=callback.format(task_id=task_id)) for text, callback in row]
+        for row in TYPE_SELECTION_ROWS
+    ])
+
+
+class SupportBot:
+    """Основной класс Telegram бота поддержки"""
+    
+    # ID Елены Зубатенко - координатор проектов (всегда соисполнитель)
+    ELENA_ZUBATENKO_ID = 809
+    # Соисполнители каждой задачи в Битрикс24
+    DEFAULT_CO_EXECUTORS = (ELENA_ZUBATENKO_ID,)
+    
+    # Сколько упоминаний обрабатывается одновременно (запросы к Битрикс24 и загрузка файлов)
+    MAX_CONCURRENT_MENTIONS = 8
+    
+    # Потоки для синхронных запросов к БД из обработчиков (asyncio.to_thread);
+    # не больше pool_size движка, чтобы не уходить в overflow-соединения
+    DB_THREADS = 20
+    
+    # Действия управления сотрудниками: действие -> (число аргументов, вызов).
+    # Последний аргумент забирает остаток строки: Telegram ID ожидающего сотрудника содержит "_"
+    EMPLOYEE_ACTIONS = {
+        "add_emp_project": (1, lambda bot, query, context, chat_id:
+                            bot.show_available_employees(query, chat_id)),
+        "emp_page": (2, lambda bot, query, context, chat_id, page:
+                     bot.show_available_employees(query, chat_id, int(page))),
+        "manage_emp": (1, lambda bot, query, context, chat_id:
+                       bot.show_project_employee_management(query, chat_id)),
+        "add_bitrix_user": (2, lambda bot, query, context, chat_id, bitrix_user_id:
+                            bot.add_bitrix_employee_to_chat(query, chat_id, bitrix_user_id, context)),
+        "remove_emp": (2, lambda bot, query, context, chat_id, user_id:
+                       bot.remove_employee_from_project(query, chat_id, user_id)),
+    }
+    
+    def __init__(self):
+        self.task_service = TaskService()
+
+        self.bot_username = None
+        self._mention_semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_MENTIONS)
+        # chat_id -> [блокировка, число ожидающих]: упоминания одного чата обрабатываются по порядку
+        self._chat_locks: Dict[int, list] = {}
+        self._mention_re: Optional[re.Pattern] = None
+        self._mention_re_username: Optional[str] = None
+    
+    @client_or_admin
+    @log_user_action("start")
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /start"""
+        user_id = str(update.effective_user.id)
+        telegram_user = update.effective_user
+        
+        # Получаем роль пользователя
+        user_role = await asyncio.to_thread(user_management.get_user_role, user_id)
+        is_admin = user_role == UserRole.ADMIN
+        
+        welcome_message = WELCOME_TEMPLATE.format(
+            first_name=telegram_user.first_name,
+            user_id=user_id,
+            bot_username=self.bot_username or "supportbot"
+        )
+        if is_admin:
+            welcome_message += WELCOME_ADMIN_APPENDIX
+        welcome_message += WELCOME_TASK_TYPES
+        
+        await update.message.reply_text(
+            welcome_message,
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    @client_or_admin
+    @log_user_action("help")
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /help"""
+        help_message = HELP_TEMPLATE.format(bot_username=self.bot_username or "supportbot")
         
         await update.message.reply_text(
             help_message,
@@ -146,33 +316,37 @@ class SupportBot:
         """Обработка упоминания бота в сообщении"""
         message = update.message
         
-        # Отладочная информация
-        logger.info(f"Получено сообщение в чате {message.chat.type}: {message.text or 'Медиа файл'}")
+        # Отладочная информация (форматирование только при включенном DEBUG)
+        logger.debug("Получено сообщение в чате %s: %s", message.chat.type, message.text or 'Медиа файл')
         
         # Проверяем, что это групповой чат и бот упомянут
         if message.chat.type in ['group', 'supergroup']:
-            bot_username = context.bot.username
-            logger.info(f"Имя бота: @{bot_username}")
-            
             # Проверяем упоминание в тексте или caption
             text_to_check = message.text or message.caption or ""
-            logger.info(f"Текст для проверки: {text_to_check}")
             
-            # Проверяем упоминание бота
-            mentioned = (f"@{bot_username}" in text_to_check or 
-                        any(entity.type == 'mention' and text_to_check[entity.offset:entity.offset + entity.length] == f"@{bot_username}" 
-                            for entity in (message.entities or message.caption_entities or [])))
+            # Без "@" в тексте нет ни упоминания, ни reply с ботом (в группах такие
+            # сообщения отсекает уже фильтр обработчика)
+            if "@" not in text_to_check:
+                return
+            
+            bot_username = context.bot.username
+            logger.debug("Имя бота: @%s, текст для проверки: %s", bot_username, text_to_check)
+            
+            # Проверяем упоминание бота (одним поиском по тексту или caption)
+            mentioned = bool(self._get_mention_re(bot_username).search(text_to_check))
             
             # Проверяем, является ли это reply на сообщение с упоминанием бота
             is_reply_with_bot = False
             reply_original_text = ""
             
-            if message.reply_to_message and f"@{bot_username}" in text_to_check:
+            if message.reply_to_message and mentioned:
                 is_reply_with_bot = True
                 reply_original_text = message.reply_to_message.text or message.reply_to_message.caption or ""
-                logger.info(f"Обнаружен reply с ботом на сообщение: {reply_original_text[:100]}")
+                logger.debug("Обнаружен reply с ботом на сообщение: %.100s", reply_original_text)
             
-            if mentioned or "@" in text_to_check or is_reply_with_bot:  # Временно принимаем любые @ для отладки
+            # Любое "@" (без упоминания бота) принимается только в режиме отладки DEBUG_ACCEPT_ANY_AT:
+            # иначе каждое сообщение с чужим @username или e-mail создавало бы задачу
+            if mentioned or is_reply_with_bot or settings.debug_accept_any_at:
                 logger.info(f"Бот упомянут! Создаем задачу... (username: @{bot_username})")
                 
                 # Извлекаем текст задачи
@@ -195,58 +369,72 @@ class SupportBot:
                     )
                     return
                 
-                # Создаем расширенное описание с информацией о создателе и чате
-                extended_description = await self.create_extended_description(message, task_text)
-                
-                # Создаем задачу
-                try:
-                    task_request = TaskCreateRequest(
-                        title=task_text[:100] + "..." if len(task_text) > 100 else task_text,
-                        description=extended_description,
-                        telegram_message_id=message.message_id,
-                        telegram_chat_id=str(message.chat_id),
-                        telegram_user_id=str(message.from_user.id)
-                    )
-                    
-                    task = self.task_service.create_task(task_request)
-                    
-                    # Сохраняем файлы если есть
-                    await self.save_message_files(message, task.id, context)
-                    
-                    # Сразу создаем задачу в Битрикс24 и отправляем одно общее уведомление
-                    await self.create_bitrix_task_immediately(context, task, message)
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка при создании задачи: {e}")
-                    await message.reply_text(
-                        "❌ Произошла ошибка при создании задачи. Попробуйте позже."
-                    )
+                async with self._chat_lock(message.chat_id), self._mention_semaphore:
+                    await self._process_mention(message, context, task_text)
+    
+    @asynccontextmanager
+    async def _chat_lock(self, chat_id: int) -> AsyncIterator[None]:
+        """Последовательная обработка в пределах одного чата (разные чаты - параллельно).
+        Блокировка удаляется, когда ее больше никто не ждет"""
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+    
+    def _get_mention_re(self, bot_username: str) -> re.Pattern:
+        """Скомпилированное выражение для поиска упоминания бота (пересоздается при смене имени)"""
+        if self._mention_re is None or self._mention_re_username != bot_username:
+            self._mention_re = re.compile(rf"@{re.escape(bot_username)}\b")
+            self._mention_re_username = bot_username
+        return self._mention_re
+    
+    async def _process_mention(self, message: Message, context: ContextTypes.DEFAULT_TYPE, task_text: str):
+        """Создание задачи по упоминанию: запись в БД, файлы, задача в Битрикс24 и уведомление"""
+        try:
+            # Создаем расширенное описание с информацией о создателе и чате
+            extended_description = await self.create_extended_description(message, task_text)
+            
+            task_request = TaskCreateRequest(
+                title=shorten(task_text, 100),
+                description=extended_description,
+                telegram_message_id=message.message_id,
+                telegram_chat_id=str(message.chat_id),
+                telegram_user_id=str(message.from_user.id),
+                task_type=TaskType.REQUIREMENT  # Тип по умолчанию записывается сразу при создании
+            )
+            
+            # Запросы к БД синхронные - выполняются в пуле потоков, чтобы не останавливать event loop
+            task = await asyncio.to_thread(self.task_service.create_task, task_request)
+            
+            # Файлы скачиваются из Telegram параллельно с созданием задачи в Битрикс24
+            # (которое ставит одно общее уведомление в очередь, не дожидаясь отправки)
+            files_info, bitrix_task_id = await asyncio.gather(
+                self.download_message_files(message, task.id, context),
+                self.create_bitrix_task_immediately(context, task, message)
+            )
+            if files_info and bitrix_task_id:
+                # Прикрепление файлов - в фоне: обработчик освобождает место для следующего
+                # упоминания (ошибки прикрепления логируются внутри)
+                context.application.create_task(self.attach_files_to_bitrix_task(bitrix_task_id, files_info))
+            
+        except Exception as e:
+            logger.error(f"Ошибка при создании задачи: {e}")
+            await message.reply_text(
+                "❌ Произошла ошибка при создании задачи. Попробуйте позже."
+            )
     
     async def send_type_clarification(self, context: ContextTypes.DEFAULT_TYPE, task: Task):
         """Отправка сообщения для уточнения типа задачи"""
-        keyboard = [
-            [
-                InlineKeyboardButton("🐛 Баг", callback_data=f"type_{task.id}_bug"),
-                InlineKeyboardButton("📋 Требование", callback_data=f"type_{task.id}_requirement")
-            ],
-            [
-                InlineKeyboardButton("💬 Консультация", callback_data=f"type_{task.id}_consultation")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        clarification_message = f"""
-🔍 **Уточнение типа задачи #{task.id}**
-
-**Описание:** {task.description[:300]}...
-
-Пожалуйста, выберите тип задачи:
-
-🐛 **Баг** - Ошибка в работе системы
-📋 **Требование** - Новая функциональность  
-💬 **Консультация** - Вопрос или консультация
-        """
+        reply_markup = type_selection_keyboard(task.id)
+        clarification_message = CLARIFICATION_TEMPLATE.format(task_id=task.id, description=task.description[:300])
         
         try:
             await context.bot.send_message(
@@ -257,7 +445,8 @@ class SupportBot:
             )
             
             # Сохраняем состояние пользователя
-            self.session_service.create_or_update_session(
+            await asyncio.to_thread(
+                self.session_service.create_or_update_session,
                 telegram_user_id=task.telegram_user_id,
                 current_task_id=task.id,
                 state="waiting_type_selection"
@@ -266,112 +455,98 @@ class SupportBot:
         except Exception as e:
             logger.error(f"Не удалось отправить личное сообщение пользователю {task.telegram_user_id}: {e}")
     
-    async def create_bitrix_task_immediately(self, context: ContextTypes.DEFAULT_TYPE, task: Task, original_message):
+    async def create_bitrix_task_immediately(self, context: ContextTypes.DEFAULT_TYPE, task: Task,
+                                             original_message) -> Optional[int]:
         """Немедленное создание задачи в Битрикс24 и отправка единого уведомления"""
         try:
             # Новая логика назначения исполнителя:
             # 1. Если это reply от сотрудника -> исполнитель = этот сотрудник
-            # 2. Иначе -> исполнитель = ТехАккаунт (ID 1269)
+            # 2. Иначе -> исполнитель = ТехАккаунт (TECH_ACCOUNT_ID)
             
             # Проверяем, есть ли reply_to_message
             if original_message.reply_to_message:
                 # Это reply - проверяем, кто отвечает
                 replier_user_id = str(original_message.from_user.id)
-                replier_bitrix_id = telegram_bitrix_sync.get_bitrix_user_id(replier_user_id)
+                replier = await telegram_bitrix_sync.resolve_user(replier_user_id)
                 
-                if replier_bitrix_id:
+                if replier:
                     # Reply от сотрудника - назначаем его исполнителем
-                    responsible_id = replier_bitrix_id
-                    user_info = telegram_bitrix_sync.get_user_info(replier_user_id)
-                    user_name = user_info.get('name', f'ID: {replier_bitrix_id}') if user_info else f'ID: {replier_bitrix_id}'
-                    executor_text = f"сотрудник {user_name} (ID: {replier_bitrix_id})"
+                    responsible_id, user_name = replier
+                    executor_text = f"сотрудник {user_name} (ID: {responsible_id})"
                     logger.info(f"Reply от сотрудника (tgID: {replier_user_id}) - назначаем сотрудника (ID: {responsible_id})")
                 else:
                     # Reply от клиента - назначаем ТехАккаунт
-                    responsible_id = 1269
+                    responsible_id = TECH_ACCOUNT_ID
                     executor_text = "ТехАккаунт"
-                    logger.info(f"Reply от клиента (без tgID) - назначаем ТехАккаунт (ID: 1269)")
+                    logger.info(f"Reply от клиента (без tgID) - назначаем ТехАккаунт (ID: {TECH_ACCOUNT_ID})")
             else:
                 # Обычное упоминание (не reply) - всегда ТехАккаунт
-                responsible_id = 1269
+                responsible_id = TECH_ACCOUNT_ID
                 executor_text = "ТехАккаунт"
-                logger.info(f"Обычное упоминание - назначаем ТехАккаунт (ID: 1269)")
-            
-            # Елена Зубатенко всегда соисполнитель
-            elena_id = self.ELENA_ZUBATENKO_ID
+                logger.info(f"Обычное упоминание - назначаем ТехАккаунт (ID: {TECH_ACCOUNT_ID})")
             
             # Создаем задачу в Битрикс24 с типом "Требование" по умолчанию
-            bitrix_result = bitrix24_api.create_task(
+            bitrix_result = await bitrix24_api.create_task(
                 title=task.title,
                 description=task.description,
                 task_type=TaskType.REQUIREMENT,  # Тип по умолчанию
                 responsible_user_id=responsible_id,
-                co_executors=[elena_id]  # Елена Зубатенко всегда соисполнитель
+                co_executors=self.DEFAULT_CO_EXECUTORS  # Елена Зубатенко всегда соисполнитель
             )
             
             # Обновляем задачу в БД
             bitrix_task_id = None
             if bitrix_result and "task" in bitrix_result:
                 bitrix_task_id = bitrix_result["task"]["id"]
-                self.task_service.update_bitrix_task_id(task.id, bitrix_task_id)
-                
-                # Устанавливаем тип по умолчанию
-                self.task_service.update_task_type(task.id, TaskType.REQUIREMENT)
+                # ID в Битрикс24 и тип по умолчанию сохраняются одним UPDATE
+                await asyncio.to_thread(self.task_service.link_bitrix_task, task.id, bitrix_task_id, TaskType.REQUIREMENT)
                 
                 logger.info(f"Задача #{task.id} создана в Битрикс24 с ID: {bitrix_task_id}")
             
             # Отправляем ОДНО общее уведомление
-            unified_message = f"""
-🎯 **Задача создана и отправлена в Битрикс24!**
-
-📝 **Задача #{task.id}:** {task.title[:100]}
-👤 **Создатель:** {original_message.from_user.first_name}
-🏷️ **Тип:** 📋 Требование (по умолчанию)
-👨‍💼 **Исполнитель:** {executor_text}
-👥 **Соисполнитель:** Елена Зубатенко (координатор проектов)
-🔗 **Bitrix24 ID:** {bitrix_task_id or 'Ошибка создания'}
-⏰ **Время:** {datetime.now().strftime('%d.%m.%Y %H:%M')}
-
-✅ **Задача готова к выполнению!**
-            """
+            unified_message = TASK_CREATED_TEMPLATE.format(
+                task_id=task.id,
+                title=task.title[:100],
+                creator=original_message.from_user.first_name,
+                executor_text=executor_text,
+                bitrix_task_id=bitrix_task_id or 'Ошибка создания',
+                time=current_time_text()
+            )
             
-            await original_message.reply_text(
-                unified_message,
-                parse_mode=ParseMode.MARKDOWN
+            # Через очередь уведомлений: она соблюдает лимиты Telegram (30 сообщений/с на бота,
+            # 1 сообщение/с в чат), и всплеск упоминаний не упирается в ответы 429.
+            # Очередь у каждого чата своя: подтверждение ждет только сообщений этого же чата
+            await notification_queue.put(
+                chat_id=original_message.chat_id,
+                text=unified_message,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_to_message_id=original_message.message_id,
+                allow_sending_without_reply=True  # Исходное сообщение могли удалить, пока ждали очереди
             )
+            return bitrix_task_id
             
         except Exception as e:
             logger.error(f"Ошибка при создании задачи в Битрикс24: {e}")
             await original_message.reply_text(
                 "❌ Произошла ошибка при создании задачи в Битрикс24."
             )
+            return None
     
     async def get_employee_bitrix_id(self, telegram_user_id: str, telegram_chat_id: str = None) -> Optional[int]:
         """Получение Bitrix24 ID сотрудника по Telegram ID через новый сервис синхронизации"""
         try:
             # Используем новый сервис синхронизации для поиска по tgID
-            bitrix_id = telegram_bitrix_sync.get_bitrix_user_id(telegram_user_id)
+            bitrix_id = await telegram_bitrix_sync.get_bitrix_user_id(telegram_user_id)
             
             if bitrix_id:
                 logger.debug(f"Найден Bitrix ID {bitrix_id} для Telegram ID {telegram_user_id}")
                 return bitrix_id
             
-            # Fallback: проверяем старые записи в локальной БД
-            db = get_db_session()
-            try:
-                from models import BotUser
-                bot_user = db.query(BotUser).filter(
-                    BotUser.telegram_user_id == telegram_user_id
-                ).first()
-                
-                if bot_user and bot_user.bitrix24_user_id:
-                    logger.debug(f"Найден в локальной БД: Telegram {telegram_user_id} -> Bitrix {bot_user.bitrix24_user_id}")
-                    return bot_user.bitrix24_user_id
-                
-                return None
-                
-            finally:
-                db.close()
+            # Fallback: проверяем старые записи в локальной БД (кешируется в employee_service)
+            bitrix_id = await employee_service.get_bitrix_id_by_telegram_id_async(telegram_user_id)
+            if bitrix_id:
+                logger.debug(f"Найден в локальной БД: Telegram {telegram_user_id} -> Bitrix {bitrix_id}")
+            return bitrix_id
                 
         except Exception as e:
             logger.error(f"Ошибка получения Bitrix24 ID сотрудника: {e}")
@@ -381,31 +556,26 @@ class SupportBot:
                                            task_type: TaskType, bitrix_task_id: Optional[int]):
         """Отправка уведомления в исходный чат о создании задачи в Битрикс24"""
         try:
-            type_names = {
-                TaskType.BUG: "🐛 Баг",
-                TaskType.REQUIREMENT: "📋 Требование", 
-                TaskType.CONSULTATION: "💬 Консультация"
-            }
-            
             notification_message = f"""
 🎯 **Задача отправлена в Битрикс24!**
 
 📝 **Задача #{task.id}** успешно создана в системе
-🏷️ **Тип:** {type_names[task_type]}
+🏷️ **Тип:** {TYPE_NAMES[task_type]}
 🔗 **Bitrix24 ID:** {bitrix_task_id or 'Создается...'}
-⏰ **Время:** {datetime.now().strftime('%d.%m.%Y %H:%M')}
+⏰ **Время:** {current_time_text()}
 
 ✅ Задача назначена ответственному и готова к выполнению.
             """
             
-            await context.bot.send_message(
+            await notification_queue.put(
                 chat_id=int(task.telegram_chat_id),
                 text=notification_message,
                 parse_mode=ParseMode.MARKDOWN,
-                reply_to_message_id=task.telegram_message_id
+                reply_to_message_id=task.telegram_message_id,
+                allow_sending_without_reply=True
             )
             
-            logger.info(f"Отправлено уведомление о создании задачи #{task.id} в чат {task.telegram_chat_id}")
+            logger.info(f"Поставлено в очередь уведомление о создании задачи #{task.id} в чат {task.telegram_chat_id}")
             
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления о создании задачи в чат: {e}")
@@ -414,13 +584,6 @@ class SupportBot:
                                             task: Task, new_status: TaskStatus):
         """Отправка уведомления в исходный чат об изменении статуса задачи"""
         try:
-            status_names = {
-                TaskStatus.NEW: "🆕 Новая",
-                TaskStatus.IN_PROGRESS: "⏳ В работе",
-                TaskStatus.COMPLETED: "✅ Завершена",
-                TaskStatus.CANCELLED: "❌ Отменена"
-            }
-            
             # Определяем иконку и сообщение в зависимости от статуса
             if new_status == TaskStatus.COMPLETED:
                 icon = "🎉"
@@ -443,19 +606,20 @@ class SupportBot:
 {icon} **Задача {action_text}!**
 
 📝 **Задача #{task.id}:** {task.title[:100]}
-📊 **Новый статус:** {status_names[new_status]}
+📊 **Новый статус:** {STATUS_NAMES[new_status]}
 🔗 **Bitrix24 ID:** {task.bitrix24_task_id or 'N/A'}
-⏰ **Обновлено:** {datetime.now().strftime('%d.%m.%Y %H:%M')}{additional_info}
+⏰ **Обновлено:** {current_time_text()}{additional_info}
             """
             
-            await context.bot.send_message(
+            await notification_queue.put(
                 chat_id=int(task.telegram_chat_id),
                 text=notification_message,
                 parse_mode=ParseMode.MARKDOWN,
-                reply_to_message_id=task.telegram_message_id
+                reply_to_message_id=task.telegram_message_id,
+                allow_sending_without_reply=True
             )
             
-            logger.info(f"Отправлено уведомление об изменении статуса задачи #{task.id} в чат {task.telegram_chat_id}")
+            logger.info(f"Поставлено в очередь уведомление об изменении статуса задачи #{task.id} в чат {task.telegram_chat_id}")
             
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления об изменении статуса в чат: {e}")
@@ -474,37 +638,32 @@ class SupportBot:
         task_type = TaskType(data_parts[2])
         
         try:
-            # Обновляем задачу
-            task = self.task_service.update_task_type(task_id, task_type)
+            task = await asyncio.to_thread(self.task_service.get_task, task_id)
             
             if task:
-                # Создаем задачу в Bitrix24 с Еленой как соисполнителем
-                elena_id = self.ELENA_ZUBATENKO_ID
-                bitrix_result = bitrix24_api.create_task(
-                    title=task.title,
-                    description=task.description,
-                    task_type=task_type,
-                    co_executors=[elena_id]
-                )
-                
-                # Обновляем ID задачи в Bitrix24
-                if bitrix_result and "task" in bitrix_result:
-                    bitrix_task_id = bitrix_result["task"]["id"]
-                    self.task_service.update_bitrix_task_id(task_id, bitrix_task_id)
+                bitrix_task_id = None
+                try:
+                    # Создаем задачу в Bitrix24 с Еленой как соисполнителем
+                    bitrix_result = await bitrix24_api.create_task(
+                        title=task.title,
+                        description=task.description,
+                        task_type=task_type,
+                        co_executors=self.DEFAULT_CO_EXECUTORS
+                    )
+                    
+                    if bitrix_result and "task" in bitrix_result:
+                        bitrix_task_id = bitrix_result["task"]["id"]
+                finally:
+                    # Тип и ID в Bitrix24 - одним UPDATE; тип сохраняется, даже если Битрикс24 недоступен
+                    await asyncio.to_thread(self.task_service.link_bitrix_task, task_id, bitrix_task_id, task_type)
                 
                 # Отправляем подтверждение
-                type_names = {
-                    TaskType.BUG: "🐛 Баг",
-                    TaskType.REQUIREMENT: "📋 Требование", 
-                    TaskType.CONSULTATION: "💬 Консультация"
-                }
-                
                 confirmation_message = f"""
 ✅ **Тип задачи установлен!**
 
 📝 **Задача #{task.id}**
-🏷️ **Тип:** {type_names[task_type]}
-🔗 **Bitrix24 ID:** {bitrix_task_id if 'bitrix_task_id' in locals() else 'Создается...'}
+🏷️ **Тип:** {TYPE_NAMES[task_type]}
+🔗 **Bitrix24 ID:** {bitrix_task_id or 'Создается...'}
 
 Задача создана в Битрикс24 и назначена ответственному.
                 """
@@ -515,10 +674,10 @@ class SupportBot:
                 )
                 
                 # Отправляем уведомление в исходный чат
-                await self.send_task_created_notification(context, task, task_type, bitrix_task_id if 'bitrix_task_id' in locals() else None)
+                await self.send_task_created_notification(context, task, task_type, bitrix_task_id)
                 
                 # Очищаем сессию пользователя
-                self.session_service.clear_session(str(query.from_user.id))
+                await asyncio.to_thread(self.session_service.clear_session, str(query.from_user.id))
                 
         except Exception as e:
             logger.error(f"Ошибка при обработке выбора типа: {e}")
@@ -535,11 +694,11 @@ class SupportBot:
         
         try:
             # Проверяем роль пользователя
-            user_role = user_management.get_user_role(user_id)
+            user_role = await asyncio.to_thread(user_management.get_user_role, user_id)
             is_admin = user_role == UserRole.ADMIN
             
             # Получаем проекты пользователя
-            projects = project_service.get_user_projects(user_id, is_admin)
+            projects = await asyncio.to_thread(project_service.get_user_projects, user_id, is_admin)
             
             if not projects:
                 await update.message.reply_text(
@@ -548,8 +707,11 @@ class SupportBot:
                 )
                 return
             
-            # Создаем inline клавиатуру с проектами
+            role_text = "👑 Администратор" if is_admin else "👤 Клиент"
+            
+            # Клавиатура и текст собираются за один проход; текст склеивается одним join
             keyboard = []
+            message_parts = [PROJECTS_HEADER_TEMPLATE.format(role_text=role_text, count=len(projects))]
             
             for project in projects:
                 # Формируем название кнопки с статистикой
@@ -569,6 +731,7 @@ class SupportBot:
                         callback_data=f"project_{project['chat_id']}_0"  # page 0
                     )
                 ])
+                message_parts.append(PROJECT_ENTRY_TEMPLATE.format(**project))
             
             # Добавляем кнопку "Все мои задачи" для быстрого доступа
             keyboard.append([
@@ -577,25 +740,8 @@ class SupportBot:
             
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            role_text = "👑 Администратор" if is_admin else "👤 Клиент"
-            
-            projects_message = f"""
-📂 **Выберите проект** ({role_text})
-
-У вас есть задачи в {len(projects)} проектах:
-
-            """
-            
-            for project in projects:
-                projects_message += f"""
-📁 **{project['chat_name']}**
-📊 Задач: {project['total_tasks']} (🆕{project['new_tasks']} ⏳{project['in_progress_tasks']} ✅{project['completed_tasks']})
-📅 Последняя: {project['last_activity'].strftime('%d.%m.%Y')}
-
-                """
-            
             await update.message.reply_text(
-                projects_message,
+                "".join(message_parts),
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -612,7 +758,7 @@ class SupportBot:
         """Показать персональную статистику пользователя"""
         try:
             user_id = str(update.effective_user.id)
-            user_stats = analytics_service.get_user_statistics(user_id)
+            user_stats = await asyncio.to_thread(analytics_service.get_user_statistics, user_id)
             
             if user_stats['total_tasks'] == 0:
                 await update.message.reply_text("У вас пока нет созданных задач.")
@@ -664,7 +810,7 @@ class SupportBot:
                     )
                     return
             
-            report = analytics_service.generate_daily_report(target_date)
+            report = await asyncio.to_thread(analytics_service.generate_daily_report, target_date)
             
             report_text = f"""
 📅 **Ежедневный отчет за {report['date']}**
@@ -737,7 +883,7 @@ class SupportBot:
             admin_user_id = str(update.effective_user.id)
             
             # Проверяем, существует ли пользователь
-            target_role = user_management.get_user_role(target_user_id)
+            target_role = await asyncio.to_thread(user_management.get_user_role, target_user_id)
             if not target_role:
                 await update.message.reply_text("❌ Пользователь не найден в системе.")
                 return
@@ -747,14 +893,14 @@ class SupportBot:
                 return
             
             # Назначаем роль администратора
-            success = user_management.set_user_role(target_user_id, UserRole.ADMIN, admin_user_id)
+            success = await asyncio.to_thread(user_management.set_user_role, target_user_id, UserRole.ADMIN, admin_user_id)
             
             if success:
                 await update.message.reply_text(
                     f"✅ **Пользователь назначен администратором**\n\n"
                     f"🆔 **ID:** {target_user_id}\n"
                     f"👑 **Новая роль:** Администратор\n"
-                    f"⏰ **Назначено:** {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+                    f"⏰ **Назначено:** {current_time_text()}",
                     parse_mode=ParseMode.MARKDOWN
                 )
             else:
@@ -786,20 +932,20 @@ class SupportBot:
                 return
             
             # Проверяем, является ли цель администратором
-            target_role = user_management.get_user_role(target_user_id)
+            target_role = await asyncio.to_thread(user_management.get_user_role, target_user_id)
             if target_role != UserRole.ADMIN:
                 await update.message.reply_text("❌ Пользователь не является администратором.")
                 return
             
             # Понижаем до клиента
-            success = user_management.set_user_role(target_user_id, UserRole.CLIENT, admin_user_id)
+            success = await asyncio.to_thread(user_management.set_user_role, target_user_id, UserRole.CLIENT, admin_user_id)
             
             if success:
                 await update.message.reply_text(
                     f"✅ **Права администратора отозваны**\n\n"
                     f"🆔 **ID:** {target_user_id}\n"
                     f"👤 **Новая роль:** Клиент\n"
-                    f"⏰ **Изменено:** {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+                    f"⏰ **Изменено:** {current_time_text()}",
                     parse_mode=ParseMode.MARKDOWN
                 )
             else:
@@ -814,13 +960,14 @@ class SupportBot:
     async def users_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Показать всех пользователей (только для админов)"""
         try:
-            users = user_management.get_all_users()
+            users = await asyncio.to_thread(user_management.get_all_users)
             
             if not users:
                 await update.message.reply_text("👥 Пользователи не найдены.")
                 return
             
-            users_text = "👥 **Все пользователи системы:**\n\n"
+            # Части сообщения собираются в список и склеиваются один раз
+            parts = ["👥 **Все пользователи системы:**\n\n"]
             
             for user in users:
                 role_emoji = "👑" if user.role == UserRole.ADMIN.value else "👤"
@@ -828,21 +975,21 @@ class SupportBot:
                 
                 username = f"@{user.username}" if user.username else f"{user.first_name} {user.last_name or ''}".strip()
                 
-                users_text += f"""
+                parts.append(f"""
 {role_emoji} **{username}**
 🆔 ID: `{user.telegram_user_id}`
 🏷️ Роль: {role_name}
 📅 Добавлен: {user.created_at.strftime('%d.%m.%Y %H:%M')}
-                """
+                """)
                 
                 if user.added_by:
-                    users_text += f"👤 Добавил: {user.added_by}\n"
+                    parts.append(f"👤 Добавил: {user.added_by}\n")
                 
-                users_text += "\n---\n"
+                parts.append("\n---\n")
             
-            users_text += f"\n📊 **Всего пользователей:** {len(users)}"
+            parts.append(f"\n📊 **Всего пользователей:** {len(users)}")
             
-            await update.message.reply_text(users_text, parse_mode=ParseMode.MARKDOWN)
+            await update.message.reply_text("".join(parts), parse_mode=ParseMode.MARKDOWN)
             
         except Exception as e:
             logger.error(f"Ошибка при получении списка пользователей: {e}")
@@ -854,7 +1001,7 @@ class SupportBot:
         """Показать информацию о своей роли"""
         try:
             user_id = str(update.effective_user.id)
-            user_stats = user_management.get_user_stats(user_id)
+            user_stats = await asyncio.to_thread(user_management.get_user_stats, user_id)
             
             if not user_stats:
                 await update.message.reply_text("❌ Информация о пользователе не найдена.")
@@ -866,7 +1013,7 @@ class SupportBot:
             
             username_display = f"@{user.username}" if user.username else "Не указан"
             # Экранируем специальные символы для Markdown
-            username_display = username_display.replace("_", "\\_").replace("*", "\\*").replace("[", "\\[").replace("]", "\\]")
+            username_display = username_display.translate(MARKDOWN_ESCAPE)
             
             info_text = f"""
 {role_emoji} **Информация о вашем профиле**
@@ -903,7 +1050,7 @@ class SupportBot:
         try:
             # Получаем все проекты (чаты) где есть задачи
             user_id = str(update.effective_user.id)
-            projects = project_service.get_user_projects(user_id, is_admin=True)
+            projects = await asyncio.to_thread(project_service.get_user_projects, user_id, is_admin=True)
             
             if not projects:
                 await update.message.reply_text(
@@ -912,12 +1059,17 @@ class SupportBot:
                 )
                 return
             
+            # Количество сотрудников по всем проектам - одним запросом
+            employee_counts = await asyncio.to_thread(
+                employee_service.get_employee_counts, [project['chat_id'] for project in projects]
+            )
+            
             # Создаем клавиатуру с проектами
             keyboard = []
             
             for project in projects:
                 project_name = project['chat_name'][:30]
-                employees_count = len(employee_service.get_chat_employees(project['chat_id']))
+                employees_count = employee_counts[project['chat_id']]
                 
                 button_text = f"📁 {project_name} ({employees_count} сотр.)"
                 
@@ -937,9 +1089,10 @@ class SupportBot:
 
             """
             
-            for project in projects:
-                employees_count = len(employee_service.get_chat_employees(project['chat_id']))
-                message_text += f"📁 **{project['chat_name']}** - {employees_count} сотрудников\n"
+            message_text += "".join(
+                f"📁 **{project['chat_name']}** - {employee_counts[project['chat_id']]} сотрудников\n"
+                for project in projects
+            )
             
             await update.message.reply_text(
                 message_text,
@@ -965,26 +1118,26 @@ class SupportBot:
         
         try:
             chat_id = context.args[0]
-            employees = employee_service.get_chat_employees(chat_id)
+            employees = await asyncio.to_thread(employee_service.get_chat_employees, chat_id)
             
             if not employees:
                 await update.message.reply_text(f"👥 В чате `{chat_id}` нет зарегистрированных сотрудников.")
                 return
             
-            employees_text = f"👥 **Сотрудники чата** `{chat_id}`\n\n"
+            parts = [f"👥 **Сотрудники чата** `{chat_id}`\n\n"]
             
             for employee in employees:
-                employees_text += f"""
+                parts.append(f"""
 👤 **Пользователь:** `{employee.telegram_user_id}`
 🔗 **Bitrix24 ID:** {employee.bitrix24_user_id or 'Не указан'}
 📅 **Добавлен:** {employee.added_at.strftime('%d.%m.%Y %H:%M')}
 👤 **Добавил:** {employee.added_by or 'Система'}
 
-                """
+                """)
             
-            employees_text += f"📊 **Всего сотрудников:** {len(employees)}"
+            parts.append(f"📊 **Всего сотрудников:** {len(employees)}")
             
-            await update.message.reply_text(employees_text, parse_mode=ParseMode.MARKDOWN)
+            await update.message.reply_text("".join(parts), parse_mode=ParseMode.MARKDOWN)
             
         except Exception as e:
             logger.error(f"Ошибка при получении сотрудников чата: {e}")
@@ -997,7 +1150,7 @@ class SupportBot:
         try:
             # Получаем все проекты
             user_id = str(update.effective_user.id)
-            projects = project_service.get_user_projects(user_id, is_admin=True)
+            projects = await asyncio.to_thread(project_service.get_user_projects, user_id, is_admin=True)
             
             if not projects:
                 await update.message.reply_text(
@@ -1005,12 +1158,17 @@ class SupportBot:
                 )
                 return
             
+            # Количество сотрудников по всем проектам - одним запросом
+            employee_counts = await asyncio.to_thread(
+                employee_service.get_employee_counts, [project['chat_id'] for project in projects]
+            )
+            
             # Создаем клавиатуру с проектами
             keyboard = []
             
             for project in projects:
                 project_name = project['chat_name'][:25]
-                employees_count = len(employee_service.get_chat_employees(project['chat_id']))
+                employees_count = employee_counts[project['chat_id']]
                 
                 keyboard.append([
                     InlineKeyboardButton(
@@ -1058,7 +1216,7 @@ class SupportBot:
                 # Пользователь удален из чата
                 logger.info(f"Пользователь {user.id} удален из чата {chat.id}")
                 # Деактивируем сотрудника если был
-                employee_service.remove_employee_from_chat(str(chat.id), str(user.id), "chat_leave")
+                await asyncio.to_thread(employee_service.remove_employee_from_chat, str(chat.id), str(user.id), "chat_leave")
                 
         except Exception as e:
             logger.error(f"Ошибка обработки изменения участников чата: {e}")
@@ -1104,27 +1262,32 @@ class SupportBot:
         
         try:
             # Парсим данные callback
-            data_parts = query.data.split("_")
+            project_match = PROJECT_CALLBACK_RE.match(query.data)
+            all_tasks_match = None if project_match else ALL_TASKS_CALLBACK_RE.match(query.data)
             
-            if len(data_parts) < 3:
+            if not project_match and not all_tasks_match:
                 await query.edit_message_text("❌ Неверные данные запроса.")
                 return
             
             user_id = str(query.from_user.id)
-            user_role = user_management.get_user_role(user_id)
+            user_role = await asyncio.to_thread(user_management.get_user_role, user_id)
             is_admin = user_role == UserRole.ADMIN
             
-            if data_parts[0] == "project":
+            if project_match:
                 # Просмотр задач конкретного проекта
-                chat_id = data_parts[1]
-                page = int(data_parts[2])
+                chat_id = project_match["chat_id"]
+                page = int(project_match["page"])
+                # Кнопка "Вперед" передает ID последней показанной задачи
+                after_id = int(project_match["after_id"]) if project_match["after_id"] else None
                 
-                project_data = project_service.get_project_tasks(chat_id, user_id, is_admin, page)
+                project_data = await asyncio.to_thread(
+                    project_service.get_project_tasks, chat_id, user_id, is_admin, page, after_id=after_id
+                )
                 await self.show_project_tasks(query, project_data)
                 
-            elif data_parts[0] == "all" and data_parts[1] == "my":
+            else:
                 # Просмотр всех задач пользователя
-                page = int(data_parts[3])
+                page = int(all_tasks_match["page"])
                 await self.show_all_user_tasks(query, user_id, is_admin, page)
                 
         except Exception as e:
@@ -1146,40 +1309,24 @@ class SupportBot:
                 )
                 return
             
-            # Формируем текст с задачами
-            tasks_text = f"""
+            # Формируем текст с задачами (части склеиваются один раз)
+            parts = [f"""
 📂 **{project_data['chat_name']}**
 📄 Страница {page + 1} из {total_pages} | 📊 Всего: {project_data['total_tasks']}
 
-            """
+            """]
             
             for task in tasks:
-                status_emoji = {
-                    TaskStatus.NEW: "🆕",
-                    TaskStatus.IN_PROGRESS: "⏳", 
-                    TaskStatus.COMPLETED: "✅",
-                    TaskStatus.CANCELLED: "❌"
-                }
-                
-                type_emoji = {
-                    TaskType.BUG: "🐛",
-                    TaskType.REQUIREMENT: "📋",
-                    TaskType.CONSULTATION: "💬"
-                }
-                
-                task_status = TaskStatus(task.status) if task.status else None
-                task_type = TaskType(task.task_type) if task.task_type else None
-                
-                tasks_text += f"""
-**#{task.id}** {status_emoji.get(task_status, '❓')} {type_emoji.get(task_type, '❓')}
-**{task.title[:50]}{'...' if len(task.title) > 50 else ''}**
+                parts.append(f"""
+**#{task.id}** {STATUS_EMOJI.get(task.status, '❓')} {TYPE_EMOJI.get(task.task_type, '❓')}
+**{shorten(task.title, 50)}**
 📅 {task.created_at.strftime('%d.%m %H:%M')}
-                """
+                """)
                 
                 if task.bitrix24_task_id:
-                    tasks_text += f" | 🔗 B24:{task.bitrix24_task_id}"
+                    parts.append(f" | 🔗 B24:{task.bitrix24_task_id}")
                 
-                tasks_text += "\n\n"
+                parts.append("\n\n")
             
             # Создаем клавиатуру пагинации
             keyboard = []
@@ -1197,7 +1344,9 @@ class SupportBot:
             
             if project_data['has_next']:
                 nav_buttons.append(
-                    InlineKeyboardButton("Вперед ➡️", callback_data=f"project_{chat_id}_{page+1}")
+                    InlineKeyboardButton(
+                        "Вперед ➡️", callback_data=f"project_{chat_id}_{page+1}_{project_data['next_cursor']}"
+                    )
                 )
             
             if nav_buttons:
@@ -1211,7 +1360,7 @@ class SupportBot:
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await query.edit_message_text(
-                tasks_text,
+                "".join(parts),
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -1226,12 +1375,10 @@ class SupportBot:
             per_page = 5
             offset = page * per_page
             
-            # Получаем задачи пользователя
-            tasks = self.task_service.get_user_tasks(user_id)
-            total_tasks = len(tasks)
-            
-            # Применяем пагинацию
-            paginated_tasks = tasks[offset:offset + per_page]
+            # Из БД читается только текущая страница (и общее количество в том же запросе)
+            paginated_tasks, total_tasks = await asyncio.to_thread(
+                self.task_service.get_user_tasks_page, user_id, per_page, offset
+            )
             total_pages = (total_tasks + per_page - 1) // per_page
             
             if not paginated_tasks:
@@ -1241,39 +1388,23 @@ class SupportBot:
             # Формируем текст
             role_text = "👑 Администратор" if is_admin else "👤 Клиент"
             
-            tasks_text = f"""
+            parts = [f"""
 📋 **Все мои задачи** ({role_text})
 📄 Страница {page + 1} из {total_pages} | 📊 Всего: {total_tasks}
 
-            """
+            """]
             
             for task in paginated_tasks:
-                status_emoji = {
-                    TaskStatus.NEW: "🆕",
-                    TaskStatus.IN_PROGRESS: "⏳", 
-                    TaskStatus.COMPLETED: "✅",
-                    TaskStatus.CANCELLED: "❌"
-                }
-                
-                type_emoji = {
-                    TaskType.BUG: "🐛",
-                    TaskType.REQUIREMENT: "📋",
-                    TaskType.CONSULTATION: "💬"
-                }
-                
-                task_status = TaskStatus(task.status) if task.status else None
-                task_type = TaskType(task.task_type) if task.task_type else None
-                
                 # Получаем название проекта
                 project_name = project_service._get_chat_name_from_task(task)
                 
-                tasks_text += f"""
-**#{task.id}** {status_emoji.get(task_status, '❓')} {type_emoji.get(task_type, '❓')}
-**{task.title[:40]}{'...' if len(task.title) > 40 else ''}**
+                parts.append(f"""
+**#{task.id}** {STATUS_EMOJI.get(task.status, '❓')} {TYPE_EMOJI.get(task.task_type, '❓')}
+**{shorten(task.title, 40)}**
 📁 {project_name[:20]}
 📅 {task.created_at.strftime('%d.%m %H:%M')}
 
-                """
+                """)
             
             # Создаем клавиатуру пагинации
             keyboard = []
@@ -1305,7 +1436,7 @@ class SupportBot:
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await query.edit_message_text(
-                tasks_text,
+                "".join(parts),
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -1324,11 +1455,11 @@ class SupportBot:
         
         try:
             # Проверяем роль пользователя
-            user_role = user_management.get_user_role(user_id)
+            user_role = await asyncio.to_thread(user_management.get_user_role, user_id)
             is_admin = user_role == UserRole.ADMIN
             
             # Получаем проекты пользователя
-            projects = project_service.get_user_projects(user_id, is_admin)
+            projects = await asyncio.to_thread(project_service.get_user_projects, user_id, is_admin)
             
             if not projects:
                 await query.edit_message_text(
@@ -1337,8 +1468,11 @@ class SupportBot:
                 )
                 return
             
-            # Создаем inline клавиатуру с проектами
+            role_text = "👑 Администратор" if is_admin else "👤 Клиент"
+            
+            # Клавиатура и текст собираются за один проход; текст склеивается одним join
             keyboard = []
+            message_parts = [PROJECTS_HEADER_TEMPLATE.format(role_text=role_text, count=len(projects))]
             
             for project in projects:
                 # Формируем название кнопки с статистикой
@@ -1358,6 +1492,7 @@ class SupportBot:
                         callback_data=f"project_{project['chat_id']}_0"  # page 0
                     )
                 ])
+                message_parts.append(PROJECT_ENTRY_TEMPLATE.format(**project))
             
             # Добавляем кнопку "Все мои задачи" для быстрого доступа
             keyboard.append([
@@ -1366,25 +1501,8 @@ class SupportBot:
             
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            role_text = "👑 Администратор" if is_admin else "👤 Клиент"
-            
-            projects_message = f"""
-📂 **Выберите проект** ({role_text})
-
-У вас есть задачи в {len(projects)} проектах:
-
-            """
-            
-            for project in projects:
-                projects_message += f"""
-📁 **{project['chat_name']}**
-📊 Задач: {project['total_tasks']} (🆕{project['new_tasks']} ⏳{project['in_progress_tasks']} ✅{project['completed_tasks']})
-📅 Последняя: {project['last_activity'].strftime('%d.%m.%Y')}
-
-                """
-            
             await query.edit_message_text(
-                projects_message,
+                "".join(message_parts),
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -1399,35 +1517,14 @@ class SupportBot:
         await query.answer()
         
         try:
-            data_parts = query.data.split("_")
+            # Действие выбирается по префиксу callback_data одним поиском в EMPLOYEE_ACTIONS
+            match = EMPLOYEE_CALLBACK_RE.match(query.data)
+            if match is None:
+                return
             
-            if data_parts[0] == "add" and data_parts[1] == "emp" and data_parts[2] == "project":
-                # Показать доступных сотрудников для добавления
-                chat_id = data_parts[3]
-                await self.show_available_employees(query, chat_id)
-                
-            elif data_parts[0] == "emp" and data_parts[1] == "page":
-                # Пагинация списка сотрудников
-                chat_id = data_parts[2]
-                page = int(data_parts[3])
-                await self.show_available_employees(query, chat_id, page)
-                
-            elif data_parts[0] == "manage" and data_parts[1] == "emp":
-                # Показать меню управления сотрудниками проекта
-                chat_id = data_parts[2]
-                await self.show_project_employee_management(query, chat_id)
-                
-            elif data_parts[0] == "add" and data_parts[1] == "bitrix" and data_parts[2] == "user":
-                # Добавить сотрудника из Битрикс24
-                chat_id = data_parts[3]
-                bitrix_user_id = data_parts[4]
-                await self.add_bitrix_employee_to_chat(query, chat_id, bitrix_user_id, context)
-                
-            elif data_parts[0] == "remove" and data_parts[1] == "emp":
-                # Удалить сотрудника из проекта
-                chat_id = data_parts[2]
-                user_id = data_parts[3]
-                await self.remove_employee_from_project(query, chat_id, user_id)
+            action, args = match.groups()
+            arg_count, handler = self.EMPLOYEE_ACTIONS[action]
+            await handler(self, query, context, *args.split("_", arg_count - 1))
                 
         except Exception as e:
             logger.error(f"Ошибка управления сотрудниками: {e}")
@@ -1436,29 +1533,18 @@ class SupportBot:
     async def show_available_employees(self, query, chat_id: str, page: int = 0):
         """Показать доступных сотрудников для добавления с пагинацией"""
         try:
-            # Получаем всех пользователей из Битрикс24 (включая неактивных, но работающих)
-            all_bitrix_users = bitrix24_api.get_users()
-            
-            # Фильтруем только тех, у кого есть имя и должность (реальные сотрудники)
-            bitrix_users = [
-                user for user in all_bitrix_users 
-                if user.get("NAME") and user.get("NAME").strip() and 
-                   user.get("WORK_POSITION") and user.get("WORK_POSITION").strip()
-            ]
+            # Сотрудники Битрикс24 - пользователи с именем и должностью, включая неактивных
+            # (список кешируется, листание страниц не повторяет отбор), и уже добавленные
+            # сотрудники чата загружаются одновременно
+            bitrix_users, existing_employees = await asyncio.gather(
+                bitrix24_api.get_staff_users(),
+                asyncio.to_thread(employee_service.get_chat_employees, chat_id)
+            )
             
-            # Получаем уже добавленных сотрудников
-            existing_employees = employee_service.get_chat_employees(chat_id)
-            existing_ids = [emp.bitrix24_user_id for emp in existing_employees if emp.bitrix24_user_id]
+            existing_ids = {emp.bitrix24_user_id for emp in existing_employees if emp.bitrix24_user_id}
             
-            # Фильтруем доступных для добавления и проверяем связанные Telegram ID
-            available_users = []
-            for user in bitrix_users:
-                user_id = int(user.get("ID", 0))
-                if user_id not in existing_ids:
-                    # Проверяем, есть ли уже связанный Telegram ID
-                    linked_telegram_id = employee_service.find_linked_telegram_id(user_id)
-                    user["linked_telegram_id"] = linked_telegram_id
-                    available_users.append(user)
+            # Фильтруем доступных для добавления
+            available_users = [user for user in bitrix_users if int(user.get("ID", 0)) not in existing_ids]
             
             if not available_users:
                 await query.edit_message_text(
@@ -1471,7 +1557,16 @@ class SupportBot:
             total_pages = (len(available_users) + page_size - 1) // page_size
             start_idx = page * page_size
             end_idx = start_idx + page_size
-            page_users = available_users[start_idx:end_idx]
+            # Связанные Telegram ID - только для показываемой страницы, одним запросом; словари
+            # из кеша пользователей Битрикс24 не изменяются - к странице добавляются копии
+            page_slice = available_users[start_idx:end_idx]
+            linked_ids = await asyncio.to_thread(
+                employee_service.find_linked_telegram_ids, [int(user.get("ID", 0)) for user in page_slice]
+            )
+            page_users = [
+                {**user, "linked_telegram_id": linked_ids.get(int(user.get("ID", 0)))}
+                for user in page_slice
+            ]
             
             # Создаем клавиатуру с сотрудниками
             keyboard = []
@@ -1525,7 +1620,7 @@ class SupportBot:
             
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            project_name = project_service._get_chat_name_from_task_by_chat_id(chat_id)
+            project_name = await asyncio.to_thread(project_service._get_chat_name_from_task_by_chat_id, chat_id)
             
             message_text = f"""
 👥 **Добавить сотрудника в проект**
@@ -1539,11 +1634,13 @@ class SupportBot:
 
             """
             
+            lines = []
             for user in page_users:
                 user_name = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip()
                 position = user.get("WORK_POSITION", "")
                 linked_status = "🔗 Связан" if user.get("linked_telegram_id") else "👤 Требует связывания"
-                message_text += f"{linked_status} **{user_name}** - {position}\n"
+                lines.append(f"{linked_status} **{user_name}** - {position}\n")
+            message_text += "".join(lines)
             
             await query.edit_message_text(
                 message_text,
@@ -1558,8 +1655,8 @@ class SupportBot:
     async def show_project_employee_management(self, query, chat_id: str):
         """Показать меню управления сотрудниками проекта"""
         try:
-            employees = employee_service.get_chat_employees(chat_id)
-            project_name = project_service._get_chat_name_from_task_by_chat_id(chat_id)
+            employees = await asyncio.to_thread(employee_service.get_chat_employees, chat_id)
+            project_name = await asyncio.to_thread(project_service._get_chat_name_from_task_by_chat_id, chat_id)
             
             if not employees:
                 # Если нет сотрудников, предлагаем добавить
@@ -1609,35 +1706,32 @@ class SupportBot:
             
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            employees_text = f"""
+            parts = [f"""
 👥 **Управление сотрудниками**
 📁 **Проект:** {project_name}
 
 **Текущие сотрудники ({len(employees)}):**
 
-            """
-            
-            # Получаем список всех пользователей Битрикс24 для отображения ФИО
-            all_bitrix_users = bitrix24_api.get_users()
+            """]
             
             for employee in employees:
-                # Ищем ФИО сотрудника в Битрикс24
+                # ФИО сотрудника - из закешированного справочника пользователей Битрикс24 (поиск по ID)
                 user_name = "Неизвестный"
                 if employee.bitrix24_user_id:
-                    user_info = next((u for u in all_bitrix_users if u.get("ID") == str(employee.bitrix24_user_id)), None)
+                    user_info = await bitrix24_api.get_user_by_id(employee.bitrix24_user_id)
                     if user_info:
                         user_name = f"{user_info.get('NAME', '')} {user_info.get('LAST_NAME', '')}".strip()
                 
-                employees_text += f"""
+                parts.append(f"""
 👤 **ФИО:** {user_name}
 📱 **Telegram ID:** `{employee.telegram_user_id}`
 🔗 **Bitrix24 ID:** {employee.bitrix24_user_id or 'Не указан'}
 📅 **Добавлен:** {employee.added_at.strftime('%d.%m.%Y')}
 
-                """
+                """)
             
             await query.edit_message_text(
-                employees_text,
+                "".join(parts),
                 reply_markup=reply_markup,
                 parse_mode=ParseMode.MARKDOWN
             )
@@ -1652,7 +1746,7 @@ class SupportBot:
             admin_id = str(query.from_user.id)
             
             # Получаем информацию о пользователе из Битрикс24
-            all_bitrix_users = bitrix24_api.get_users()
+            all_bitrix_users = await bitrix24_api.get_users()
             user_info = next((u for u in all_bitrix_users if u.get("ID") == bitrix_user_id), None)
             
             if not user_info:
@@ -1664,7 +1758,7 @@ class SupportBot:
             user_position = user_info.get('WORK_POSITION', '')
             
             # Проверяем, есть ли уже связанный Telegram ID
-            linked_telegram_id = employee_service.find_linked_telegram_id(int(bitrix_user_id))
+            linked_telegram_id = await asyncio.to_thread(employee_service.find_linked_telegram_id, int(bitrix_user_id))
             
             if linked_telegram_id:
                 # Используем уже связанный Telegram ID
@@ -1672,11 +1766,12 @@ class SupportBot:
                 logger.info(f"Используем уже связанный Telegram ID {linked_telegram_id} для Bitrix24 ID {bitrix_user_id}")
             else:
                 # Создаем pending запись для последующего связывания
-                telegram_id_to_use = f"pending_{bitrix_user_id}"
+                telegram_id_to_use = f"{PENDING_TELEGRAM_ID_PREFIX}{bitrix_user_id}"
                 logger.info(f"Создаем pending запись для Bitrix24 ID {bitrix_user_id}")
             
             # Добавляем сотрудника
-            success = employee_service.add_employee_to_chat(
+            success = await asyncio.to_thread(
+                employee_service.add_employee_to_chat,
                 chat_id, 
                 telegram_id_to_use,
                 int(bitrix_user_id), 
@@ -1684,7 +1779,7 @@ class SupportBot:
             )
             
             if success:
-                project_name = project_service._get_chat_name_from_task_by_chat_id(chat_id)
+                project_name = await asyncio.to_thread(project_service._get_chat_name_from_task_by_chat_id, chat_id)
                 
                 if linked_telegram_id:
                     # Сотрудник уже связан - показываем информацию
@@ -1703,7 +1798,7 @@ class SupportBot:
 🔗 **Bitrix24 ID:** {bitrix_user_id}
 📱 **Telegram ID:** `{linked_telegram_id}`
 📁 **Проект:** {project_name}
-⏰ **Добавлено:** {datetime.now().strftime('%d.%m.%Y %H:%M')}
+⏰ **Добавлено:** {current_time_text()}
 
 ✅ **Сотрудник готов к работе!** Telegram ID уже связан.
                     """
@@ -1766,32 +1861,20 @@ class SupportBot:
             logger.info(f"🗑️ Попытка удаления сотрудника {user_id} из чата {chat_id}")
             
             # Получаем информацию о сотруднике перед удалением
-            employee = None
-            db = get_db_session()
-            try:
-                from models import ChatEmployee
-                employee = db.query(ChatEmployee).filter(
-                    ChatEmployee.telegram_chat_id == chat_id,
-                    ChatEmployee.telegram_user_id == user_id,
-                    ChatEmployee.is_active == True
-                ).first()
-                
-                if not employee:
-                    await query.edit_message_text("❌ Сотрудник не найден в проекте.")
-                    return
-                
-            finally:
-                db.close()
+            employee = await asyncio.to_thread(employee_service.get_active_employee, chat_id, user_id)
+            if not employee:
+                await query.edit_message_text("❌ Сотрудник не найден в проекте.")
+                return
             
-            success = employee_service.remove_employee_from_chat(chat_id, user_id, admin_id)
+            success = await asyncio.to_thread(employee_service.remove_employee_from_chat, chat_id, user_id, admin_id)
             
             if success:
-                project_name = project_service._get_chat_name_from_task_by_chat_id(chat_id)
+                project_name = await asyncio.to_thread(project_service._get_chat_name_from_task_by_chat_id, chat_id)
                 
                 # Получаем имя сотрудника из Битрикс24 если есть ID
                 employee_name = f"ID: {user_id}"
                 if employee and employee.bitrix24_user_id:
-                    bitrix_users = bitrix24_api.get_users()
+                    bitrix_users = await bitrix24_api.get_users()
                     user_info = next((u for u in bitrix_users if u.get("ID") == str(employee.bitrix24_user_id)), None)
                     if user_info:
                         employee_name = f"{user_info.get('NAME', '')} {user_info.get('LAST_NAME', '')}".strip()
@@ -1809,7 +1892,7 @@ class SupportBot:
                     f"👤 **Сотрудник:** {employee_name}\n"
                     f"🆔 **Telegram ID:** `{user_id}`\n"
                     f"📁 **Проект:** {project_name}\n"
-                    f"⏰ **Удалено:** {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+                    f"⏰ **Удалено:** {current_time_text()}",
                     reply_markup=reply_markup,
                     parse_mode=ParseMode.MARKDOWN
                 )
@@ -1842,7 +1925,8 @@ class SupportBot:
             )
             
             # Сохраняем состояние для ожидания ввода
-            self.session_service.create_or_update_session(
+            await asyncio.to_thread(
+                self.session_service.create_or_update_session,
                 telegram_user_id=str(query.from_user.id),
                 state="waiting_telegram_id",
                 context={
@@ -1863,7 +1947,7 @@ class SupportBot:
         try:
             # Получаем все проекты
             user_id = str(query.from_user.id)
-            projects = project_service.get_user_projects(user_id, is_admin=True)
+            projects = await asyncio.to_thread(project_service.get_user_projects, user_id, is_admin=True)
             
             if not projects:
                 await query.edit_message_text(
@@ -1871,12 +1955,17 @@ class SupportBot:
                 )
                 return
             
+            # Количество сотрудников по всем проектам - одним запросом
+            employee_counts = await asyncio.to_thread(
+                employee_service.get_employee_counts, [project['chat_id'] for project in projects]
+            )
+            
             # Создаем клавиатуру с проектами
             keyboard = []
             
             for project in projects:
                 project_name = project['chat_name'][:25]
-                employees_count = len(employee_service.get_chat_employees(project['chat_id']))
+                employees_count = employee_counts[project['chat_id']]
                 
                 keyboard.append([
                     InlineKeyboardButton(
@@ -1924,7 +2013,7 @@ class SupportBot:
                 return
             
             # Проверяем, что этот Telegram ID не используется другим Bitrix ID
-            existing_bitrix_id = employee_service.get_bitrix_id_by_telegram_id(telegram_id)
+            existing_bitrix_id = await employee_service.get_bitrix_id_by_telegram_id_async(telegram_id)
             if existing_bitrix_id and str(existing_bitrix_id) != str(employee_data['bitrix_id']):
                 await message.reply_text(
                     f"❌ **Этот Telegram ID уже связан!**\n\n"
@@ -1935,12 +2024,13 @@ class SupportBot:
                 return
             
             # Обновляем глобальную связь
-            employee_service.update_global_user_profile(telegram_id, int(employee_data['bitrix_id']))
+            await asyncio.to_thread(employee_service.update_global_user_profile, telegram_id, int(employee_data['bitrix_id']))
             
             # Обновляем pending запись в текущем чате
-            success = employee_service.update_employee_telegram_id(
+            success = await asyncio.to_thread(
+                employee_service.update_employee_telegram_id,
                 employee_data['chat_id'], 
-                f"pending_{employee_data['bitrix_id']}", 
+                f"{PENDING_TELEGRAM_ID_PREFIX}{employee_data['bitrix_id']}", 
                 telegram_id
             )
             
@@ -1995,7 +2085,7 @@ class SupportBot:
                 return
             
             # Проверяем, существует ли пользователь в Bitrix24
-            all_users = bitrix24_api.get_users()
+            all_users = await bitrix24_api.get_users()
             bitrix_user = next((u for u in all_users if u.get("ID") == str(bitrix_user_id)), None)
             
             if not bitrix_user:
@@ -2003,7 +2093,7 @@ class SupportBot:
                 return
             
             # Проверяем, не связан ли уже этот Telegram ID с другим пользователем
-            existing_bitrix_id = telegram_bitrix_sync.get_bitrix_user_id(telegram_id)
+            existing_bitrix_id = await telegram_bitrix_sync.get_bitrix_user_id(telegram_id)
             if existing_bitrix_id and existing_bitrix_id != bitrix_user_id:
                 await update.message.reply_text(
                     f"❌ Telegram ID {telegram_id} уже связан с Bitrix24 ID {existing_bitrix_id}.\n"
@@ -2013,7 +2103,7 @@ class SupportBot:
                 return
             
             # Выполняем связывание
-            success = telegram_bitrix_sync.add_telegram_link(bitrix_user_id, telegram_id)
+            success = await telegram_bitrix_sync.add_telegram_link(bitrix_user_id, telegram_id)
             
             if success:
                 user_name = f"{bitrix_user.get('NAME', '')} {bitrix_user.get('LAST_NAME', '')}".strip()
@@ -2033,7 +2123,7 @@ class SupportBot:
                 )
                 
                 # Обновляем кеш
-                telegram_bitrix_sync.refresh_cache()
+                await telegram_bitrix_sync.refresh_cache()
                 
             else:
                 await update.message.reply_text("❌ Ошибка при связывании. Проверьте логи.")
@@ -2061,13 +2151,13 @@ class SupportBot:
             telegram_id = context.args[0]
             
             # Проверяем, что связь существует
-            user_info = telegram_bitrix_sync.get_user_info(telegram_id)
+            user_info = await telegram_bitrix_sync.get_user_info(telegram_id)
             if not user_info:
                 await update.message.reply_text(f"❌ Связь для Telegram ID {telegram_id} не найдена.")
                 return
             
             # Удаляем связь
-            success = telegram_bitrix_sync.remove_telegram_link(telegram_id)
+            success = await telegram_bitrix_sync.remove_telegram_link(telegram_id)
             
             if success:
                 await update.message.reply_text(
@@ -2082,7 +2172,7 @@ class SupportBot:
                 )
                 
                 # Обновляем кеш
-                telegram_bitrix_sync.refresh_cache()
+                await telegram_bitrix_sync.refresh_cache()
                 
             else:
                 await update.message.reply_text("❌ Ошибка при удалении связи. Проверьте логи.")
@@ -2097,50 +2187,47 @@ class SupportBot:
         """Показать все текущие связи Telegram ID с Bitrix24"""
         try:
             # Получаем все связи
-            linked_users = telegram_bitrix_sync.get_all_linked_users()
+            linked_users = await telegram_bitrix_sync.get_all_linked_users()
             
             if not linked_users:
                 await update.message.reply_text("📱 Связанные Telegram аккаунты не найдены.")
                 return
             
-            # Получаем информацию о пользователях из Bitrix24
-            all_bitrix_users = bitrix24_api.get_users()
-            
-            links_text = f"📱 **Связанные Telegram аккаунты** ({len(linked_users)})\n\n"
+            parts = [f"📱 **Связанные Telegram аккаунты** ({len(linked_users)})\n\n"]
             
             for telegram_id, bitrix_id in linked_users.items():
-                # Ищем пользователя в Bitrix24
-                user_info = next((u for u in all_bitrix_users if u.get("ID") == str(bitrix_id)), None)
+                # Ищем пользователя в закешированном справочнике Bitrix24 (по ID, без перебора списка)
+                user_info = await bitrix24_api.get_user_by_id(bitrix_id)
                 
                 if user_info:
                     user_name = f"{user_info.get('NAME', '')} {user_info.get('LAST_NAME', '')}".strip()
                     user_position = user_info.get('WORK_POSITION', '')
                     active_status = "🟢 Активен" if user_info.get('ACTIVE') == 'Y' else "🔴 Неактивен"
                     
-                    links_text += f"""
+                    parts.append(f"""
 👤 **{user_name}**
 💼 {user_position}
 🆔 Bitrix24: {bitrix_id}
 📱 Telegram: `{telegram_id}`
 📊 Статус: {active_status}
 
-"""
+""")
                 else:
-                    links_text += f"""
+                    parts.append(f"""
 ❓ **Неизвестный пользователь**
 🆔 Bitrix24: {bitrix_id}
 📱 Telegram: `{telegram_id}`
 ⚠️ Не найден в Bitrix24
 
-"""
+""")
             
             # Добавляем информацию о пользователях без связи
-            unlinked_users = telegram_bitrix_sync.get_unlinked_bitrix_users()
+            unlinked_users = await telegram_bitrix_sync.get_unlinked_bitrix_users()
             if unlinked_users:
-                links_text += f"\n🔍 **Пользователи без Telegram ID:** {len(unlinked_users)}\n"
-                links_text += "Используйте `/link_telegram` для связывания."
+                parts.append(f"\n🔍 **Пользователи без Telegram ID:** {len(unlinked_users)}\n")
+                parts.append("Используйте `/link_telegram` для связывания.")
             
-            await update.message.reply_text(links_text, parse_mode=ParseMode.MARKDOWN)
+            await update.message.reply_text("".join(parts), parse_mode=ParseMode.MARKDOWN)
             
         except Exception as e:
             logger.error(f"Ошибка показа связей: {e}")
@@ -2154,14 +2241,14 @@ class SupportBot:
             await update.message.reply_text("🔄 Начинаю синхронизацию с Bitrix24...")
             
             # Обновляем кеш связей
-            telegram_bitrix_sync.refresh_cache()
+            await telegram_bitrix_sync.refresh_cache()
             
             # Синхронизируем с локальной БД
-            synced_count = telegram_bitrix_sync.sync_with_local_database()
+            synced_count = await telegram_bitrix_sync.sync_with_local_database()
             
             # Получаем статистику
-            linked_users = telegram_bitrix_sync.get_all_linked_users()
-            unlinked_users = telegram_bitrix_sync.get_unlinked_bitrix_users()
+            linked_users = await telegram_bitrix_sync.get_all_linked_users()
+            unlinked_users = await telegram_bitrix_sync.get_unlinked_bitrix_users()
             
             await update.message.reply_text(
                 f"✅ **Синхронизация завершена!**\n\n"
@@ -2180,9 +2267,9 @@ class SupportBot:
     async def debug_all_messages(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Отладочный обработчик всех сообщений"""
         message = update.message
-        logger.info(f"🔍 DEBUG: Получено сообщение в чате {message.chat.type} (ID: {message.chat.id})")
-        logger.info(f"🔍 DEBUG: Текст: {message.text}")
-        logger.info(f"🔍 DEBUG: От пользователя: {message.from_user.id} ({message.from_user.first_name})")
+        logger.debug("🔍 DEBUG: Получено сообщение в чате %s (ID: %s)", message.chat.type, message.chat.id)
+        logger.debug("🔍 DEBUG: Текст: %s", message.text)
+        logger.debug("🔍 DEBUG: От пользователя: %s (%s)", message.from_user.id, message.from_user.first_name)
         
         # Не отвечаем на сообщения, просто логируем
     
@@ -2200,7 +2287,7 @@ class SupportBot:
         chat_id = chat.id
         
         # Форматируем дату создания
-        created_at = datetime.now().strftime("%d.%m.%Y %H:%M")
+        created_at = current_time_text()
         
         # Создаем расширенное описание
         extended_description = f"""
@@ -2224,108 +2311,91 @@ class SupportBot:
         
         return extended_description
     
-    async def save_message_files(self, message: Message, task_id: int, context: ContextTypes.DEFAULT_TYPE):
-        """Сохранение файлов из сообщения и прикрепление к задаче в Битрикс24"""
-        files_info = []
+    async def download_message_files(self, message: Message, task_id: int,
+                                     context: ContextTypes.DEFAULT_TYPE) -> List[Dict[str, Any]]:
+        """Скачивание файлов из сообщения в папку задачи (все вложения - параллельно)"""
+        # (file_id, имя файла, тип) для каждого вложения сообщения
+        attachments = []
+        if message.photo:
+            photo = message.photo[-1]  # Берем фото наибольшего размера
+            attachments.append((photo.file_id, "photo.jpg", "photo"))
+        if message.document:
+            doc = message.document
+            attachments.append((doc.file_id, doc.file_name or f"document_{doc.file_id[:8]}", "document"))
+        if message.video:
+            video = message.video
+            attachments.append((video.file_id, f"video_{video.file_id[:8]}.mp4", "video"))
+        if message.audio:
+            audio = message.audio
+            attachments.append((audio.file_id, audio.file_name or f"audio_{audio.file_id[:8]}.mp3", "audio"))
+        if message.voice:
+            voice = message.voice
+            attachments.append((voice.file_id, f"voice_{voice.file_id[:8]}.ogg", "voice"))
+        
+        if not attachments:
+            return []
         
         try:
             # Создаем папку для файлов если не существует
             files_dir = f"task_files/{task_id}"
             os.makedirs(files_dir, exist_ok=True)
             
-            # Обрабатываем фотографии
-            if message.photo:
-                photo = message.photo[-1]  # Берем фото наибольшего размера
-                file_info = await self.download_file(context, photo.file_id, files_dir, "photo.jpg")
-                if file_info:
-                    file_info["type"] = "photo"
-                    files_info.append(file_info)
-            
-            # Обрабатываем документы
-            if message.document:
-                doc = message.document
-                filename = doc.file_name or f"document_{doc.file_id[:8]}"
-                file_info = await self.download_file(context, doc.file_id, files_dir, filename)
-                if file_info:
-                    file_info["type"] = "document"
-                    files_info.append(file_info)
-            
-            # Обрабатываем видео
-            if message.video:
-                video = message.video
-                filename = f"video_{video.file_id[:8]}.mp4"
-                file_info = await self.download_file(context, video.file_id, files_dir, filename)
-                if file_info:
-                    file_info["type"] = "video"
-                    files_info.append(file_info)
-            
-            # Обрабатываем аудио
-            if message.audio:
-                audio = message.audio
-                filename = audio.file_name or f"audio_{audio.file_id[:8]}.mp3"
-                file_info = await self.download_file(context, audio.file_id, files_dir, filename)
-                if file_info:
-                    file_info["type"] = "audio"
-                    files_info.append(file_info)
-            
-            # Обрабатываем голосовые сообщения
-            if message.voice:
-                voice = message.voice
-                filename = f"voice_{voice.file_id[:8]}.ogg"
-                file_info = await self.download_file(context, voice.file_id, files_dir, filename)
-                if file_info:
-                    file_info["type"] = "voice"
-                    files_info.append(file_info)
-            
-            # Если есть файлы, загружаем их в Битрикс24
-            if files_info:
-                # Получаем задачу из БД для получения bitrix24_task_id
-                task = self.task_service.get_task(task_id)
-                if task and task.bitrix24_task_id:
-                    uploaded_files = []
-                    
-                    for file_info in files_info:
-                        try:
-                            # Прикрепляем файл к задаче в Битрикс24 через ссылку Telegram
-                            telegram_file_url = file_info.get('telegram_file_url', '')
-                            
-                            if telegram_file_url:
-                                upload_result = bitrix24_api.attach_telegram_file_to_task(
-                                    task.bitrix24_task_id, 
-                                    file_info,
-                                    telegram_file_url
-                                )
-                                
-                                if upload_result.get("success"):
-                                    uploaded_files.append(file_info['filename'])
-                                    logger.info(f"✅ Файл {file_info['filename']} прикреплен к задаче")
-                                else:
-                                    logger.warning(f"⚠️ Не удалось прикрепить файл {file_info['filename']}")
-                            else:
-                                logger.warning(f"⚠️ Нет URL для файла {file_info['filename']}")
-                            
-                        except Exception as e:
-                            logger.error(f"Ошибка прикрепления файла {file_info['filename']}: {e}")
-                    
-                    # Добавляем общий комментарий о файлах
-                    if uploaded_files:
-                        files_comment = f"📎 **Загружены файлы из Telegram:**\n" + "\n".join([
-                            f"• {filename}" for filename in uploaded_files
-                        ])
-                    else:
-                        files_comment = f"📎 **Файлы из Telegram:**\n" + "\n".join([
-                            f"• {info['filename']} ({info['size']} байт) - сохранен локально" 
-                            for info in files_info
-                        ])
-                    
-                    try:
-                        bitrix24_api.add_comment_to_task(task.bitrix24_task_id, files_comment)
-                        logger.info(f"Добавлен комментарий с файлами к задаче {task.bitrix24_task_id}")
-                    except Exception as e:
-                        logger.error(f"Ошибка добавления комментария о файлах: {e}")
-                
+            downloaded = await asyncio.gather(*(
+                self.download_file(context, file_id, files_dir, filename)
+                for file_id, filename, _ in attachments
+            ))
         except Exception as e:
             logger.error(f"Ошибка при сохранении файлов: {e}")
+            return []
+        
+        files_info = []
+        for file_info, (_, _, file_type) in zip(downloaded, attachments):
+            if file_info:
+                file_info["type"] = file_type
+                files_info.append(file_info)
+        return files_info
+    
+    async def attach_files_to_bitrix_task(self, bitrix_task_id: int, files_info: List[Dict[str, Any]]):
+        """Прикрепление скачанных файлов к задаче в Битрикс24"""
+        try:
+            attachable_files = []
+            for file_info in files_info:
+                if file_info.get('telegram_file_url'):
+                    attachable_files.append(file_info)
+                else:
+                    logger.warning(f"⚠️ Нет URL для файла {file_info['filename']}")
+            
+            # Все файлы сообщения и итоговый список отправляются одним комментарием
+            if attachable_files:
+                files_comment = f"📎 **Загружены файлы из Telegram:**\n" + "\n".join([
+                    f"• {info['filename']}" for info in attachable_files
+                ])
+                
+                upload_result = await bitrix24_api.attach_telegram_files_to_task(
+                    bitrix_task_id,
+                    attachable_files,
+                    summary=files_comment
+                )
+                
+                if upload_result.get("success"):
+                    logger.info(f"Добавлен комментарий с файлами к задаче {bitrix_task_id}")
+                    return
+                
+                logger.warning(f"⚠️ Не удалось прикрепить файлы к задаче {bitrix_task_id}")
+            
+            files_comment = f"📎 **Файлы из Telegram:**\n" + "\n".join([
+                f"• {info['filename']} ({info['size']} байт) - сохранен локально" 
+                for info in files_info
+            ])
+            
+            try:
+                await bitrix24_api.add_comment_to_task(bitrix_task_id, files_comment)
+                logger.info(f"Добавлен комментарий с файлами к задаче {bitrix_task_id}")
+            except Exception as e:
+                logger.error(f"Ошибка добавления комментария о файлах: {e}")
+                
+        except Exception as e:
+            logger.error(f"Ошибка при прикреплении файлов к задаче {bitrix_task_id}: {e}")
     
     async def download_file(self, context: ContextTypes.DEFAULT_TYPE, file_id: str, 
                            files_dir: str, filename: str) -> Optional[Dict[str, Any]]:
@@ -2337,15 +2407,14 @@ class SupportBot:
             # Скачиваем файл локально
             await file.download_to_drive(file_path)
             
-            # Получаем размер файла
-            file_size = os.path.getsize(file_path)
+            # Размер известен из ответа getFile - stat на диске нужен только если его нет
+            file_size = file.file_size or os.path.getsize(file_path)
             
-            # Формируем прямую ссылку на файл в Telegram
+            # Формируем прямую ссылку на файл в Telegram (содержит токен - в лог не пишем)
             bot_token = settings.telegram_bot_token
             telegram_file_url = f"https://api.telegram.org/file/bot{bot_token}/{file.file_path}"
             
             logger.info(f"Файл {filename} скачан в {file_path}")
-            logger.info(f"Прямая ссылка Telegram: {telegram_file_url}")
             
             return {
                 "filename": filename,
@@ -2389,23 +2458,27 @@ class SupportBot:
         application.add_handler(CommandHandler("show_links", self.show_links_command), group=-1)
         application.add_handler(CommandHandler("sync_bitrix", self.sync_bitrix_command), group=-1)
         
-        # Обработка упоминаний в группах (средний приоритет)
-        application.add_handler(MessageHandler(
-            filters.TEXT & (filters.ChatType.GROUP | filters.ChatType.SUPERGROUP) & filters.Regex(r'@\w+'), 
-            self.handle_mention
-        ), group=0)
-        
-        # Обработка медиафайлов с упоминанием бота
+        # Обработка упоминаний в группах (средний приоритет): текст и медиафайлы с подписью.
+        # Сообщения без упоминаний отсекаются по entities еще при диспетчеризации,
+        # обработчик проверяет только, что упомянут именно бот.
+        # block=False: создание задачи (БД, файлы, Битрикс24) выполняется в фоне
+        # и не задерживает обработку сообщений из других чатов
+        if settings.debug_accept_any_at:
+            mention_filter = filters.Regex(r'@') | filters.CaptionRegex(r'@')
+        else:
+            mention_filter = filters.Entity(MessageEntity.MENTION) | filters.CaptionEntity(MessageEntity.MENTION)
         application.add_handler(MessageHandler(
-            (filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.AUDIO | filters.VOICE) & 
-            (filters.ChatType.GROUP | filters.ChatType.SUPERGROUP), 
-            self.handle_mention
+            (filters.TEXT | filters.PHOTO | filters.Document.ALL | filters.VIDEO | filters.AUDIO | filters.VOICE) &
+            filters.ChatType.GROUPS & mention_filter,
+            self.handle_mention,
+            block=False
         ), group=0)
         
         # ВРЕМЕННО: обработка упоминаний в личных сообщениях для теста
         application.add_handler(MessageHandler(
             filters.TEXT & filters.ChatType.PRIVATE & filters.Regex(r'задача|task'), 
-            self.handle_mention
+            self.handle_mention,
+            block=False
         ), group=1)
         
         # Обработка ввода Telegram ID для связывания сотрудников
@@ -2416,11 +2489,12 @@ class SupportBot:
         
 
         
-        # Временно: отладка всех сообщений (самый низкий приоритет)
-        application.add_handler(MessageHandler(
-            filters.TEXT,
-            self.debug_all_messages
-        ), group=10)
+        # Временно: отладка всех сообщений (самый низкий приоритет; только при уровне DEBUG)
+        if logger.isEnabledFor(logging.DEBUG):
+            application.add_handler(MessageHandler(
+                filters.TEXT,
+                self.debug_all_messages
+            ), group=10)
         
         # Обработка callback запросов
         application.add_handler(CallbackQueryHandler(
@@ -2443,7 +2517,7 @@ class SupportBot:
         # Обработка управления сотрудниками
         application.add_handler(CallbackQueryHandler(
             self.handle_employee_management,
-            pattern="^(add_emp_project_|manage_emp_|add_bitrix_user_|remove_emp_|emp_page_)"
+            pattern=EMPLOYEE_CALLBACK_RE
         ))
         
         # Обработка связывания Telegram ID
@@ -2467,22 +2541,45 @@ class SupportBot:
     
     async def post_init(self, application: Application):
         """Инициализация после запуска бота"""
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self.DB_THREADS, thread_name_prefix="db")
+        )
+        
         bot_info = await application.bot.get_me()
         self.bot_username = bot_info.username
         logger.info(f"Бот запущен: @{self.bot_username}")
         
+        # Общая HTTP-сессия для запросов к Битрикс24
+        await bitrix24_api.startup()
+        
         # Инициализация кеша связей Telegram-Bitrix24
         logger.info("Инициализация кеша связей Telegram-Bitrix24...")
-        telegram_bitrix_sync.load_cache()
+        await telegram_bitrix_sync.load_cache()
         logger.info("Кеш связей загружен.")
+    
+    async def post_shutdown(self, application: Application):
+        """Освобождение ресурсов при остановке бота"""
+        await status_sync_service.flush_notifications()
+        await notification_queue.close()
+        await bitrix24_api.close()
 
 
 def create_bot_application() -> Application:
     """Создание и настройка приложения бота"""
-    application = Application.builder().token(settings.telegram_bot_token).build()
-    
     support_bot = SupportBot()
+    
+    application = (
+        Application.builder()
+        .token(settings.telegram_bot_token)
+        .post_shutdown(support_bot.post_shutdown)
+        # Обновления из разных чатов обрабатываются параллельно; порядок упоминаний
+        # внутри чата сохраняет SupportBot._chat_lock
+        .concurrent_updates(True)
+        .build()
+    )
+    
     support_bot.setup_handlers(application)
+    notification_queue.set_bot(application.bot)
     
     # Добавляем post_init
     application.job_queue.run_once(
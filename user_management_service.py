@@ -1,16 +1,21 @@
 """
 Сервис управления пользователями и ролями
 """
+import asyncio
 from typing import Optional, List
 from sqlalchemy.orm import Session
 from telegram import User as TelegramUser
 
 from models import BotUser, UserRole
 from database import get_db_session
+from cache_utils import cache, MISSING
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Время жизни закешированной роли пользователя (секунды)
+AUTH_CACHE_TTL = 60
+
 
 class UserManagementService:
     """Сервис для управления пользователями и их ролями"""
@@ -30,7 +35,6 @@ class UserManagementService:
                 user.first_name = telegram_user.first_name
                 user.last_name = telegram_user.last_name
                 db.commit()
-                db.refresh(user)
                 return user
             else:
                 # Создаем нового пользователя
@@ -45,7 +49,6 @@ class UserManagementService:
                 
                 db.add(user)
                 db.commit()
-                db.refresh(user)
                 
                 logger.info(f"Создан новый пользователь: {telegram_user.id} ({telegram_user.first_name})")
                 return user
@@ -57,22 +60,99 @@ class UserManagementService:
         finally:
             db.close()
     
-    def get_user_role(self, telegram_user_id: str) -> Optional[UserRole]:
-        """Получение роли пользователя"""
+    def get_auth_context(self, telegram_user: TelegramUser) -> Optional[UserRole]:
+        """Роль пользователя для проверки прав доступа (None - доступ запрещен).
+
+        Выполняется за одну сессию: пользователь создается при первом обращении,
+        первый пользователь в базе сразу получает роль администратора.
+        Результат кешируется на AUTH_CACHE_TTL секунд.
+        """
+        user_id = str(telegram_user.id)
+        cache_key = f"role:{user_id}"
+        
+        role = cache.get(cache_key, MISSING)
+        if role is not MISSING:
+            return role
+        
         db = get_db_session()
         try:
             user = db.query(BotUser).filter(
-                BotUser.telegram_user_id == telegram_user_id,
-                BotUser.is_active == True
+                BotUser.telegram_user_id == user_id
             ).first()
             
             if user:
-                return UserRole(user.role)
-            return None
+                # Обновляем информацию о пользователе только при изменениях
+                if (user.username, user.first_name, user.last_name) != (
+                        telegram_user.username, telegram_user.first_name, telegram_user.last_name):
+                    user.username = telegram_user.username
+                    user.first_name = telegram_user.first_name
+                    user.last_name = telegram_user.last_name
+                    db.commit()
+            else:
+                # Первый пользователь автоматически становится админом
+                is_first_user = db.query(BotUser.id).first() is None
+                
+                user = BotUser(
+                    telegram_user_id=user_id,
+                    username=telegram_user.username,
+                    first_name=telegram_user.first_name,
+                    last_name=telegram_user.last_name,
+                    role=(UserRole.ADMIN if is_first_user else UserRole.CLIENT).value,
+                    added_by="system" if is_first_user else None
+                )
+                db.add(user)
+                db.commit()
+                
+                if is_first_user:
+                    logger.info(f"Первый пользователь {user_id} автоматически назначен администратором")
+                else:
+                    logger.info(f"Создан новый пользователь: {user_id} ({telegram_user.first_name})")
             
+            role = UserRole(user.role) if user.is_active else None
+            cache.set(cache_key, role, AUTH_CACHE_TTL)
+            return role
+            
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Ошибка при работе с пользователем: {e}")
+            raise
         finally:
             db.close()
     
+    async def get_auth_context_async(self, telegram_user: TelegramUser) -> Optional[UserRole]:
+        """Роль пользователя для обработчиков бота: при попадании в кеш ответ сразу,
+        иначе обращение к базе выполняется в пуле потоков и не блокирует event loop"""
+        role = cache.get(f"role:{telegram_user.id}", MISSING)
+        if role is not MISSING:
+            return role
+        
+        return await asyncio.to_thread(self.get_auth_context, telegram_user)
+    
+    def get_user_role(self, telegram_user_id: str) -> Optional[UserRole]:
+        """Получение роли пользователя (общий кеш с get_auth_context на AUTH_CACHE_TTL секунд).
+        None не кешируется: get_auth_context должен создать пользователя при первом обращении"""
+        cache_key = f"role:{telegram_user_id}"
+        
+        role = cache.get(cache_key, MISSING)
+        if role is not MISSING:
+            return role
+        
+        db = get_db_session()
+        try:
+            user_role = db.query(BotUser.role).filter(
+                BotUser.telegram_user_id == telegram_user_id,
+                BotUser.is_active == True
+            ).scalar()
+        finally:
+            db.close()
+        
+        if user_role is None:
+            return None
+        
+        role = UserRole(user_role)
+        cache.set(cache_key, role, AUTH_CACHE_TTL)
+        return role
+    
     def is_admin(self, telegram_user_id: str) -> bool:
         """Проверка, является ли пользователь администратором"""
         role = self.get_user_role(telegram_user_id)
@@ -96,6 +176,7 @@ class UserManagementService:
                 old_role = user.role
                 user.role = new_role.value
                 db.commit()
+                cache.pop(f"role:{telegram_user_id}")
                 
                 logger.info(f"Роль пользователя {telegram_user_id} изменена с {old_role} на {new_role.value} пользователем {changed_by}")
                 return True
@@ -149,6 +230,7 @@ class UserManagementService:
                 user.is_active = False
                 user.notes = f"Деактивирован {deactivated_by}"
                 db.commit()
+                cache.pop(f"role:{telegram_user_id}")
                 
                 logger.info(f"Пользователь {telegram_user_id} деактивирован пользователем {deactivated_by}")
                 return True